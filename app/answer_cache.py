@@ -0,0 +1,75 @@
+import hashlib
+from typing import Optional
+
+from app.cache import KeyValueBackend, SQLiteBackend, TTLCache
+from app.env import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_MAX_SIZE,
+    ANSWER_CACHE_SQLITE_PATH,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_VERSION,
+)
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+class AnswerCache:
+    """
+    Answers to top-level questions without files, keyed by the Dify app and
+    the query with case and whitespace normalized, so that the same question
+    is answered again without a generation.
+
+    Entries are versioned: changing `version` (ANSWER_CACHE_VERSION), e.g.
+    after the knowledge base was updated, leaves all the previous answers
+    unused until they expire.
+    """
+
+    def __init__(
+        self,
+        cache: TTLCache,
+        version: str,
+        enabled: bool = True,
+        backend: Optional[KeyValueBackend] = None,
+    ):
+        self.cache = cache
+        self.version = version
+        self.enabled = enabled
+        self.backend = backend
+
+    def _key(self, api_key: str, query: str) -> str:
+        app_digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        query_digest = hashlib.sha256(normalize_query(query).encode()).hexdigest()
+        return f"{app_digest}:{self.version}:{query_digest}"
+
+    def get(self, api_key: str, query: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        key = self._key(api_key, query)
+        answer = self.cache.get(key)
+        if answer is None and self.backend is not None:
+            answer = self.backend.get(key)
+            if answer is not None:
+                self.cache.set(key, answer)
+        return answer
+
+    def set(self, api_key: str, query: str, answer: str) -> None:
+        if not self.enabled or not answer:
+            return
+        key = self._key(api_key, query)
+        self.cache.set(key, answer)
+        if self.backend is not None:
+            self.backend.set(key, answer, self.cache.ttl)
+
+
+answer_cache = AnswerCache(
+    cache=TTLCache(ANSWER_CACHE_MAX_SIZE, ANSWER_CACHE_TTL_SECONDS),
+    version=ANSWER_CACHE_VERSION,
+    enabled=ANSWER_CACHE_ENABLED,
+    backend=(
+        SQLiteBackend(ANSWER_CACHE_SQLITE_PATH, table="answers")
+        if ANSWER_CACHE_SQLITE_PATH
+        else None
+    ),
+)
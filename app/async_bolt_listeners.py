@@ -0,0 +1,532 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Optional
+
+import aiohttp
+from slack_bolt import BoltResponse
+from slack_bolt.async_app import AsyncAck, AsyncBoltContext, AsyncBoltRequest
+from slack_bolt.request.payload_utils import is_event
+from slack_sdk.web.async_client import AsyncSlackResponse, AsyncWebClient
+
+from app.async_dify_ops import (
+    ASYNC_CONNECTION_ERRORS,
+    AsyncChatClient,
+    get_async_dify_client,
+    get_last_conversation_id,
+    is_stream_read_timeout,
+    iter_answer_from_streaming_response,
+    upload_file_to_dify,
+)
+from app.async_slack_ops import (
+    download_slack_image_content,
+    fetch_thread_messages,
+    is_thread_for_this_app,
+    post_wip_message,
+    resolve_bot_user_ids,
+    update_wip_message,
+    update_wip_message_with_stream,
+)
+from app.dify_ops import (
+    format_dify_message_content,
+    get_dify_user,
+    remember_conversation_id,
+)
+from app.env import (
+    IDEMPOTENCY_ENABLED,
+    STREAMING_ENABLED,
+    TRANSLATE_MARKDOWN,
+)
+from app.generation_registry import (
+    Generation,
+    find_cancelled_source,
+    generation_registry,
+)
+from app.generation_scheduler import (
+    CancelledInQueueError,
+    QueueFullError,
+    async_generation_scheduler,
+)
+from app.idempotency import get_event_idempotency_key, idempotency_store
+from app.image_ops import preprocess_image
+from app.lazy_listeners import (
+    MESSAGE_SUBTYPES_TO_SKIP,
+    find_changed_reply,
+    find_edited_root,
+)
+from app.listener_logic import (
+    build_chat_kwargs,
+    build_history_query,
+    cache_answer,
+    dify_image_file,
+    error_reply_text,
+    find_cached_answer,
+    generation_outcome_text,
+    get_user_message,
+    history_bot_ids,
+    is_from_other_bot,
+    record_generation_error,
+    record_generation_outcome,
+    select_history_messages,
+    select_images,
+    should_answer_root_message,
+    uploaded_file_ids,
+)
+from app.message_coalescer import merge_messages, message_coalescer
+from app.resilience import dify_circuit_breaker
+from app.slack_ops import (
+    BUSY_TEXT,
+    CANCELLED_TEXT,
+    DEFAULT_LOADING_TEXT,
+    QUEUED_TEXT,
+    UNAVAILABLE_TEXT,
+    forget_thread_root,
+    remember_thread_owner,
+    update_thread_reply,
+)
+
+# asyncio counterparts of the listeners in app.bolt_listeners for AsyncApp.
+# The decisions (which messages to answer, what to send to Dify, what to show
+# when a generation gives no answer) live in app.listener_logic; only the I/O
+# is awaited here instead of blocking a worker thread.
+
+
+async def just_ack(ack: AsyncAck):
+    await ack()
+
+
+async def handle_response_error(
+    logger: logging.Logger,
+    client: AsyncWebClient,
+    channel_id: str,
+    thread_ts: str,
+    user_id: str,
+    error: Exception,
+):
+    await client.chat_postMessage(
+        channel=channel_id,
+        thread_ts=thread_ts,
+        text=error_reply_text(logger, user_id, error),
+    )
+
+
+async def reply_with_answer(
+    client: AsyncWebClient,
+    dify_client: AsyncChatClient,
+    channel_id: str,
+    thread_ts: str,
+    wip_reply: AsyncSlackResponse,
+    response: aiohttp.ClientResponse,
+    generation: Generation,
+) -> str:
+    wip_ts = wip_reply["message"]["ts"]
+    result = generation.result
+    async with response:
+        response.raise_for_status()
+        chunks = generation.until_cancelled_async(
+            iter_answer_from_streaming_response(response, result)
+        )
+        if STREAMING_ENABLED:
+            reply_message = await update_wip_message_with_stream(
+                client, channel_id, wip_ts, chunks
+            )
+        else:
+            reply_message = "".join([chunk async for chunk in chunks])
+            await update_wip_message(client, channel_id, wip_ts, reply_message)
+
+    remember_conversation_id(dify_client, thread_ts, result)
+    return reply_message
+
+
+async def stop_dify_task(dify_client: AsyncChatClient, task_id: str, user: str):
+    async with await dify_client.stop_message(task_id, user):
+        pass
+
+
+async def generate_reply(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    dify_client: AsyncChatClient,
+    thread_ts: str,
+    wip_reply: AsyncSlackResponse,
+    chat_kwargs: dict,
+) -> Optional[str]:
+    channel_id = context.channel_id
+    wip_ts = wip_reply["message"]["ts"]
+    queued = False
+    answer = None
+
+    async def show_position(position: int):
+        nonlocal queued
+        queued = True
+        await update_wip_message(
+            client, channel_id, wip_ts, QUEUED_TEXT.format(position=position)
+        )
+
+    def stop_task(task_id: str):
+        # Cancellation runs on the event loop; the stop call goes on in the background
+        return asyncio.create_task(
+            stop_dify_task(dify_client, task_id, chat_kwargs["user"])
+        )
+
+    try:
+        with generation_registry.track(
+            channel_id,
+            thread_ts,
+            payload["ts"],
+            stop_task,
+            on_cancel=async_generation_scheduler.wake,
+            user=context.actor_user_id or context.user_id,
+            merged_ts=payload.get("merged_ts", ()),
+        ) as generation:
+            async with async_generation_scheduler.slot(
+                channel_id,
+                context.actor_user_id or context.user_id,
+                priority=payload.get("channel_type") == "im",
+                on_queued=show_position,
+                cancelled=lambda: generation.cancelled,
+            ):
+                if not generation.cancelled:
+                    if not dify_circuit_breaker.allow():
+                        await update_wip_message(
+                            client, channel_id, wip_ts, UNAVAILABLE_TEXT
+                        )
+                        return None
+                    if queued:
+                        await update_wip_message(
+                            client, channel_id, wip_ts, DEFAULT_LOADING_TEXT
+                        )
+                    generation_registry.start_async_watchdog()
+                    started_at = time.perf_counter()
+                    try:
+                        response = await dify_client.create_chat_message(
+                            response_mode="streaming", **chat_kwargs
+                        )
+                        generation.attach(response, started_at)
+                        answer = await reply_with_answer(
+                            client,
+                            dify_client,
+                            channel_id,
+                            thread_ts,
+                            wip_reply,
+                            response,
+                            generation,
+                        )
+                    except Exception as e:
+                        if not record_generation_error(
+                            generation,
+                            e,
+                            is_stream_read_timeout(e),
+                            ASYNC_CONNECTION_ERRORS,
+                        ):
+                            raise
+                    record_generation_outcome(generation, started_at)
+                outcome_text = generation_outcome_text(generation)
+                if outcome_text is not None:
+                    await update_wip_message(client, channel_id, wip_ts, outcome_text)
+                    return None
+    except QueueFullError:
+        await update_wip_message(client, channel_id, wip_ts, BUSY_TEXT)
+    except CancelledInQueueError:
+        await update_wip_message(client, channel_id, wip_ts, CANCELLED_TEXT)
+    return answer
+
+
+async def reply_from_answer_cache(
+    context: AsyncBoltContext,
+    client: AsyncWebClient,
+    thread_ts: str,
+    query: str,
+    files: list,
+) -> bool:
+    answer = find_cached_answer(context, query, files)
+    if answer is None:
+        return False
+    await post_wip_message(
+        client=client,
+        channel=context.channel_id,
+        thread_ts=thread_ts,
+        loading_text=answer,
+    )
+    return True
+
+
+async def build_thread_history_query(
+    client: AsyncWebClient,
+    channel_id: str,
+    thread_ts: str,
+    before_ts: str,
+    user_message: str,
+) -> str:
+    messages_history = select_history_messages(
+        await fetch_thread_messages(client, channel_id, thread_ts), before_ts
+    )
+    bot_users = await resolve_bot_user_ids(client, history_bot_ids(messages_history))
+    return build_history_query(messages_history, bot_users, user_message)
+
+
+async def respond_to_app_mention(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+):
+    thread_ts = payload.get("thread_ts")
+    user_id = context.actor_user_id or context.user_id
+    dify_client = get_async_dify_client(context["DIFY_APP_API_KEY"])
+
+    # Threads started by a mention are answered by the message listener
+    if thread_ts and await is_thread_for_this_app(
+        context, client, context.channel_id, thread_ts
+    ):
+        return
+
+    try:
+        user_message = get_user_message(payload, context.bot_user_id)
+        user_message = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
+        files = payload.get("files", [])
+
+        if thread_ts:
+            wip_reply_task = asyncio.create_task(
+                post_wip_message(
+                    client=client, channel=context.channel_id, thread_ts=thread_ts
+                )
+            )
+            latest_conversation_id = await get_last_conversation_id(
+                dify_client, thread_ts
+            )
+
+            query = user_message
+            # The thread history is only needed to start a new Dify conversation
+            if not latest_conversation_id:
+                query = await build_thread_history_query(
+                    client, context.channel_id, thread_ts, payload["ts"], user_message
+                )
+
+            wip_reply = await wip_reply_task
+            chat_kwargs = build_chat_kwargs(
+                user_id, query, get_dify_user(thread_ts), latest_conversation_id
+            )
+        else:
+            remember_thread_owner(context.channel_id, payload.get("ts"), True)
+            if await reply_from_answer_cache(
+                context, client, payload.get("ts"), user_message, files
+            ):
+                return
+            wip_reply, files_content = await asyncio.gather(
+                post_wip_message(
+                    client=client,
+                    channel=context.channel_id,
+                    thread_ts=payload.get("ts"),
+                ),
+                prepare_files_content(files, context, logger),
+            )
+
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                user_message,
+                get_dify_user(payload.get("ts")),
+                files=files_content,
+            )
+
+        answer = await generate_reply(
+            context,
+            payload,
+            client,
+            dify_client,
+            thread_ts or payload.get("ts"),
+            wip_reply,
+            chat_kwargs,
+        )
+        if not thread_ts:
+            cache_answer(context, user_message, files, answer)
+
+    except Exception as e:
+        await handle_response_error(
+            logger, client, context.channel_id, payload.get("ts"), user_id, e
+        )
+
+
+async def respond_to_new_message(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+):
+    if is_from_other_bot(payload, context.bot_id):
+        return
+
+    try:
+        is_in_dm_with_bot = payload.get("channel_type") == "im"
+        thread_ts = payload.get("thread_ts")
+        dify_client = get_async_dify_client(context["DIFY_APP_API_KEY"])
+        user_id = context.actor_user_id or context.user_id
+
+        if not thread_ts:
+            if not should_answer_root_message(context, payload):
+                return
+        elif not await is_thread_for_this_app(
+            context, client, context.channel_id, thread_ts
+        ):
+            return
+
+        payloads = await message_coalescer.collect_async(
+            (context.channel_id, thread_ts, user_id), payload
+        )
+        if payloads is None:
+            return
+        payload = merge_messages(payloads)
+        files = payload["files"]
+        user_message = get_user_message(payload, context.bot_user_id)
+
+        if is_in_dm_with_bot and not thread_ts:
+            cache_query = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
+            if await reply_from_answer_cache(
+                context, client, payload.get("ts"), cache_query, files
+            ):
+                return
+            wip_reply, files_content = await asyncio.gather(
+                post_wip_message(
+                    client=client,
+                    channel=context.channel_id,
+                    thread_ts=payload.get("ts"),
+                ),
+                prepare_files_content(files, context, logger),
+            )
+
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                user_message,
+                get_dify_user(payload.get("ts")),
+                files=files_content,
+            )
+        else:
+            user_message = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
+            wip_reply, latest_conversation_id, files_content = await asyncio.gather(
+                post_wip_message(
+                    client=client, channel=context.channel_id, thread_ts=thread_ts
+                ),
+                get_last_conversation_id(dify_client, thread_ts),
+                prepare_files_content(files, context, logger),
+            )
+
+            query = user_message
+            # No conversation yet: the thread was answered from the answer
+            # cache, or the conversation expired
+            if not latest_conversation_id:
+                query = await build_thread_history_query(
+                    client, context.channel_id, thread_ts, payload["ts"], user_message
+                )
+
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                query,
+                get_dify_user(thread_ts),
+                latest_conversation_id,
+                files_content,
+            )
+
+        answer = await generate_reply(
+            context,
+            payload,
+            client,
+            dify_client,
+            thread_ts or payload.get("ts"),
+            wip_reply,
+            chat_kwargs,
+        )
+        if is_in_dm_with_bot and not thread_ts:
+            cache_answer(context, cache_query, files, answer)
+
+    except Exception as e:
+        await handle_response_error(
+            logger, client, context.channel_id, payload.get("ts"), user_id, e
+        )
+
+
+def register_listeners(app):
+    app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
+    app.event("message")(ack=just_ack, lazy=[respond_to_new_message])
+
+
+# Same as app.lazy_listeners.before_authorize
+async def before_authorize(
+    body: dict,
+    payload: dict,
+    request: AsyncBoltRequest,
+    logger: logging.Logger,
+    next_,
+):
+    if (
+        is_event(body)
+        and payload.get("type") == "message"
+        and payload.get("subtype") in MESSAGE_SUBTYPES_TO_SKIP
+    ):
+        logger.debug(
+            "Skipped the following middleware and listeners "
+            f"for this message event (subtype: {payload.get('subtype')})"
+        )
+        source = find_cancelled_source(payload)
+        if source is not None:
+            generation_registry.cancel(*source)
+        edited_root = find_edited_root(payload)
+        if edited_root is not None:
+            forget_thread_root(*edited_root)
+        changed_reply = find_changed_reply(payload)
+        if changed_reply is not None:
+            update_thread_reply(*changed_reply)
+        return BoltResponse(status=200, body="")
+
+    if IDEMPOTENCY_ENABLED and is_event(body) and not request.lazy_only:
+        key = get_event_idempotency_key(body)
+        # The shared backend is a blocking client, so keep it off the event loop
+        if key is not None and not await asyncio.to_thread(
+            idempotency_store.claim, key, logger
+        ):
+            logger.debug(f"Skipped a duplicated delivery of the event {key}")
+            return BoltResponse(status=200, body="")
+    await next_()
+
+
+async def upload_slack_image_to_dify(file: dict, context: AsyncBoltContext) -> dict:
+    api_key = context["DIFY_APP_API_KEY"]
+    file_id_key = (api_key, file["id"])
+    upload_file_id = uploaded_file_ids.get(file_id_key)
+
+    if upload_file_id is None:
+        image_content = await download_slack_image_content(
+            file["url_private"], context.bot_token
+        )
+        digest_key = (api_key, hashlib.sha256(image_content).hexdigest())
+        upload_file_id = uploaded_file_ids.get(digest_key)
+        if upload_file_id is None:
+            # Decoding and encoding images is CPU work; keep the loop responsive
+            image_content, file_name, mime_type = await asyncio.to_thread(
+                preprocess_image,
+                image_content,
+                file.get("name", "image.jpg"),
+                file["mimetype"],
+            )
+            response = await upload_file_to_dify(
+                file_name, image_content, api_key, context.user_id, mime_type
+            )
+            upload_file_id = response["id"]
+            uploaded_file_ids.set(digest_key, upload_file_id)
+        uploaded_file_ids.set(file_id_key, upload_file_id)
+
+    return dify_image_file(upload_file_id)
+
+
+async def prepare_files_content(
+    files: list, context: AsyncBoltContext, logger: logging.Logger
+) -> list:
+    return list(
+        await asyncio.gather(
+            *(
+                upload_slack_image_to_dify(file, context)
+                for file in select_images(files, logger)
+            )
+        )
+    )
@@ -0,0 +1,255 @@
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+from app.conversation_store import conversation_store
+from app.dify_ops import (
+    StreamingEventParser,
+    StreamingResult,
+    consume_answer_event,
+    get_dify_user,
+)
+from app.env import (
+    ASYNC_HTTP_MAX_CONNECTIONS,
+    DIFY_API_BASE_URL,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_READ_TIMEOUT_SECONDS,
+)
+from app.http_pool import STREAM_TIMEOUT
+from app.metrics import metrics
+from app.resilience import CONNECTION_ERRORS, dify_circuit_breaker, retry_call_async
+
+# Connection failures of aiohttp are not OSErrors
+ASYNC_CONNECTION_ERRORS = (*CONNECTION_ERRORS, aiohttp.ClientConnectionError)
+
+# ----------------------------
+# Client
+# ----------------------------
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    # Created on first use so that it is bound to the running event loop
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_MAX_CONNECTIONS),
+            # No total timeout: a stream stays open as long as Dify generates
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+                sock_read=HTTP_READ_TIMEOUT_SECONDS,
+            ),
+        )
+    return _session
+
+
+async def close_async_session() -> None:
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+class AsyncChatClient:
+    """asyncio counterpart of dify_client.ChatClient for the calls used by this app."""
+
+    def __init__(self, api_key: str, base_url: str = DIFY_API_BASE_URL):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+
+    async def _send_request(
+        self,
+        method: str,
+        endpoint: str,
+        json=None,
+        params=None,
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+    ) -> aiohttp.ClientResponse:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+        if params is not None:
+            # aiohttp rejects None values, which requests silently drops
+            params = {k: v for k, v in params.items() if v is not None}
+        return await get_async_session().request(
+            method,
+            f"{self.base_url}{endpoint}",
+            json=json,
+            params=params,
+            headers=headers,
+            # None would disable the session's timeouts
+            **({"timeout": timeout} if timeout is not None else {}),
+        )
+
+    async def create_chat_message(
+        self,
+        inputs,
+        query,
+        user,
+        response_mode="blocking",
+        conversation_id=None,
+        files=None,
+    ) -> aiohttp.ClientResponse:
+        data = {
+            "inputs": inputs,
+            "query": query,
+            "user": user,
+            "response_mode": response_mode,
+            "files": files,
+        }
+        if conversation_id:
+            data["conversation_id"] = conversation_id
+        timeout = (
+            aiohttp.ClientTimeout(
+                sock_connect=STREAM_TIMEOUT[0], sock_read=STREAM_TIMEOUT[1]
+            )
+            if response_mode == "streaming"
+            else None
+        )
+        return await self._send_request("POST", "/chat-messages", data, timeout=timeout)
+
+    async def get_conversations(
+        self, user, last_id=None, limit=None, pinned=None
+    ) -> aiohttp.ClientResponse:
+        params = {"user": user, "last_id": last_id, "limit": limit, "pinned": pinned}
+        return await self._send_request("GET", "/conversations", params=params)
+
+    async def stop_message(self, task_id, user) -> aiohttp.ClientResponse:
+        data = {"user": user}
+        return await self._send_request("POST", f"/chat-messages/{task_id}/stop", data)
+
+
+_async_dify_clients: dict[str, AsyncChatClient] = {}
+
+
+def get_async_dify_client(api_key: str) -> AsyncChatClient:
+    client = _async_dify_clients.get(api_key)
+    if client is None:
+        client = _async_dify_clients.setdefault(api_key, AsyncChatClient(api_key))
+    return client
+
+
+# ----------------------------
+# Internal functions
+# ----------------------------
+
+
+def is_stream_read_timeout(error: BaseException) -> bool:
+    """Whether a streaming request timed out waiting for the headers or the next chunk."""
+    return isinstance(error, aiohttp.SocketTimeoutError)
+
+
+@metrics.timed("dify.get_last_conversation_id")
+async def get_last_conversation_id(
+    client: AsyncChatClient, thread_ts: str
+) -> Optional[str]:
+    dify_user = get_dify_user(thread_ts)
+    conversation_id = conversation_store.get(client.api_key, dify_user)
+    if conversation_id is not None:
+        return conversation_id
+
+    async def get_conversations():
+        async with await client.get_conversations(dify_user) as res:
+            res.raise_for_status()
+            return await res.json()
+
+    conversation_history = await retry_call_async(
+        get_conversations,
+        name="dify.get_conversations",
+        breaker=dify_circuit_breaker,
+        connection_errors=ASYNC_CONNECTION_ERRORS,
+    )
+    if len(conversation_history["data"]) == 0:
+        return None
+    conversation_id = conversation_history["data"][-1]["id"]
+    conversation_store.set(client.api_key, dify_user, conversation_id)
+    return conversation_id
+
+
+async def iter_streaming_events(
+    response: aiohttp.ClientResponse,
+) -> AsyncIterator[tuple[str, bytes]]:
+    """
+    Incrementally parse the server-sent events of the streaming response.
+
+    :return: An async iterator over (event name, raw JSON data) pairs
+    """
+    parser = StreamingEventParser()
+    async for chunk in response.content.iter_any():
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
+
+
+async def iter_answer_from_streaming_response(
+    response: aiohttp.ClientResponse, result: Optional[StreamingResult] = None
+) -> AsyncIterator[str]:
+    """
+    Yield the answer chunks from the streaming response as they arrive.
+
+    See app.dify_ops.get_answer_from_streaming_response for the format of the events.
+    """
+    if result is None:
+        result = StreamingResult()
+
+    async for event, raw_data in iter_streaming_events(response):
+        answer = consume_answer_event(event, raw_data, result)
+        if answer is not None:
+            yield answer
+        elif event == "message_end":
+            break
+
+
+async def get_answer_from_streaming_response(
+    response: aiohttp.ClientResponse, result: Optional[StreamingResult] = None
+) -> str:
+    if result is None:
+        result = StreamingResult()
+    async for _ in iter_answer_from_streaming_response(response, result):
+        pass
+    return result.answer
+
+
+# 画像のアップロード
+@metrics.timed("dify.upload_file")
+async def upload_file_to_dify(
+    file_name: str,
+    file_content: bytes,
+    api_key: str,
+    user_id: str,
+    mime_type: str = "image/jpeg",
+) -> dict:
+    """
+    app.dify_ops.upload_file_to_dify の asyncio 版
+    """
+    url = f"{DIFY_API_BASE_URL.rstrip('/')}/files/upload"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+    }
+
+    async def post() -> dict:
+        # FormData can only be sent once, so it is built for every attempt
+        data = aiohttp.FormData()
+        data.add_field("user", user_id)
+        data.add_field("file", file_content, filename=file_name, content_type=mime_type)
+        async with get_async_session().post(
+            url, headers=headers, data=data
+        ) as response:
+            # Retried by retry_call_async
+            if response.status == 429 or response.status >= 500:
+                response.raise_for_status()
+            if response.status != 201:
+                raise Exception(
+                    f"Failed to upload file: {response.status}, {await response.text()}"
+                )
+            return await response.json()
+
+    return await retry_call_async(
+        post,
+        name="dify.upload_file",
+        breaker=dify_circuit_breaker,
+        connection_errors=ASYNC_CONNECTION_ERRORS,
+    )
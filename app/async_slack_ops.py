@@ -0,0 +1,235 @@
+import asyncio
+import time
+from typing import AsyncIterable, Iterable, Optional
+
+from slack_bolt.context.async_context import AsyncBoltContext
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncSlackResponse, AsyncWebClient
+
+from app.async_dify_ops import get_async_session
+from app.env import (
+    IMAGE_MAX_BYTES,
+    STREAMING_UPDATE_INTERVAL_SECONDS,
+    STREAMING_UPDATE_MIN_BYTES,
+)
+from app.markdown_conversion import MarkdownToSlackStream, markdown_to_slack
+from app.metrics import metrics
+from app.slack_ops import (
+    DEFAULT_LOADING_TEXT,
+    bot_user_ids,
+    remember_thread_root,
+    thread_ownership,
+)
+from app.thread_history import compact_message, last_seen_ts, thread_history_cache
+
+# ----------------------------
+# General operations in a channel
+# ----------------------------
+
+
+async def fetch_replies(
+    client: AsyncWebClient,
+    channel: str,
+    thread_ts: str,
+    oldest: Optional[str] = None,
+) -> list[dict]:
+    messages = []
+    cursor = None
+    while True:
+        with metrics.timer("slack.conversations.replies"):
+            response = await client.conversations_replies(
+                channel=channel,
+                ts=thread_ts,
+                include_all_metadata=True,
+                limit=1000,
+                oldest=oldest,
+                cursor=cursor,
+            )
+        messages.extend(compact_message(m) for m in response.get("messages", []))
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            return messages
+
+
+async def fetch_thread_messages(
+    client: AsyncWebClient, channel_id: str, thread_ts: str
+) -> list:
+    # Shares the thread history cache with the sync listeners
+    cached = thread_history_cache.peek(channel_id, thread_ts)
+    if cached is None:
+        messages = await fetch_replies(client, channel_id, thread_ts)
+        return thread_history_cache.put(channel_id, thread_ts, messages)
+
+    newer = await fetch_replies(
+        client, channel_id, thread_ts, last_seen_ts(cached, thread_ts)
+    )
+    return thread_history_cache.extend(channel_id, thread_ts, cached, newer)
+
+
+async def find_thread_root_message(
+    client: AsyncWebClient, channel_id: str, thread_ts: str
+) -> Optional[dict]:
+    root_message = thread_history_cache.peek_root(channel_id, thread_ts)
+    if root_message is not None:
+        return root_message
+
+    with metrics.timer("slack.conversations.replies"):
+        response = await client.conversations_replies(
+            channel=channel_id, ts=thread_ts, limit=1
+        )
+    messages = response.get("messages", [])
+    return compact_message(messages[0]) if messages else None
+
+
+async def is_thread_for_this_app(
+    context: AsyncBoltContext, client: AsyncWebClient, channel_id: str, thread_ts: str
+) -> bool:
+    is_owned = thread_ownership.get((channel_id, thread_ts))
+    if is_owned is not None:
+        return is_owned
+
+    root_message = await find_thread_root_message(client, channel_id, thread_ts)
+    if root_message is None:
+        return False
+    return remember_thread_root(context, channel_id, root_message)
+
+
+async def resolve_bot_user_ids(
+    client: AsyncWebClient, bot_ids: Iterable[Optional[str]]
+) -> dict[str, Optional[str]]:
+    # Same as app.slack_ops.resolve_bot_user_ids, sharing its cache
+    resolved = {}
+    for bot_id in dict.fromkeys(bot_id for bot_id in bot_ids if bot_id):
+        user_id = bot_user_ids.get(bot_id)
+        if user_id is None:
+            with metrics.timer("slack.bots.info"):
+                response = await client.bots_info(bot=bot_id)
+            user_id = response.get("bot", {}).get("user_id") or ""
+            bot_user_ids.set(bot_id, user_id)
+        resolved[bot_id] = user_id or None
+    return resolved
+
+
+# ----------------------------
+# WIP reply message stuff
+# ----------------------------
+
+
+@metrics.timed("slack.chat.postMessage")
+async def post_wip_message(
+    *,
+    client: AsyncWebClient,
+    channel: str,
+    thread_ts: str,
+    loading_text: str = DEFAULT_LOADING_TEXT,
+) -> AsyncSlackResponse:
+    return await client.chat_postMessage(
+        channel=channel,
+        thread_ts=thread_ts,
+        text=markdown_to_slack(loading_text),
+    )
+
+
+@metrics.timed("slack.chat.update")
+async def _chat_update(
+    client: AsyncWebClient, channel: str, ts: str, text: str
+) -> AsyncSlackResponse:
+    return await client.chat_update(channel=channel, ts=ts, text=text)
+
+
+async def update_wip_message(
+    client: AsyncWebClient,
+    channel: str,
+    ts: str,
+    text: str,
+) -> AsyncSlackResponse:
+    return await _chat_update(client, channel, ts, markdown_to_slack(text))
+
+
+async def update_wip_message_with_stream(
+    client: AsyncWebClient,
+    channel: str,
+    ts: str,
+    chunks: AsyncIterable[str],
+    *,
+    interval: float = STREAMING_UPDATE_INTERVAL_SECONDS,
+    min_bytes: int = STREAMING_UPDATE_MIN_BYTES,
+) -> str:
+    """
+    asyncio version of app.slack_ops.update_wip_message_with_stream.
+
+    The intermediate updates run in the background while the stream is read;
+    while one is in flight the next ones are skipped, so the text keeps
+    accumulating until the following update.
+
+    :return: The complete answer
+    """
+    parts = []
+    converter = MarkdownToSlackStream()
+    pending_bytes = 0
+    last_update = time.monotonic()
+    in_flight: Optional[asyncio.Task] = None
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        parts.append(chunk)
+        converter.feed(chunk)
+        pending_bytes += len(chunk.encode())
+        now = time.monotonic()
+        if now - last_update >= interval or pending_bytes >= min_bytes:
+            if in_flight is not None and not in_flight.done():
+                continue
+            if in_flight is not None:
+                in_flight.result()  # Surface the error of the previous update
+            in_flight = asyncio.create_task(
+                _chat_update(client, channel, ts, converter.text)
+            )
+            pending_bytes = 0
+            last_update = now
+
+    if in_flight is not None:
+        await in_flight
+    converter.finish()
+    await _chat_update(client, channel, ts, converter.text)
+    return "".join(parts)
+
+
+# ----------------------------
+# Files
+# ----------------------------
+
+
+@metrics.timed("slack.download_image")
+async def download_slack_image_content(
+    image_url: str, bot_token: str, max_bytes: int = IMAGE_MAX_BYTES
+) -> bytes:
+    # Same checks as app.slack_ops.download_slack_image_content
+    async with get_async_session().get(
+        image_url, headers={"Authorization": f"Bearer {bot_token}"}
+    ) as response:
+        if response.status != 200:
+            error = f"Request to {image_url} failed with status code {response.status}"
+            raise SlackApiError(error, response)
+
+        content_type = response.headers["content-type"]
+        if content_type.startswith("text/html"):
+            error = f"You don't have the permission to download this file: {image_url}"
+            raise SlackApiError(error, response)
+
+        if not content_type.startswith("image/"):
+            error = f"The responded content-type is not for image data: {content_type}"
+            raise SlackApiError(error, response)
+
+        if (response.content_length or 0) > max_bytes:
+            error = f"The image is larger than {max_bytes} bytes: {image_url}"
+            raise SlackApiError(error, response)
+
+        content = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            content += chunk
+            if len(content) > max_bytes:
+                error = f"The image is larger than {max_bytes} bytes: {image_url}"
+                raise SlackApiError(error, response)
+
+    return bytes(content)
@@ -1,34 +1,89 @@
+import hashlib
 import logging
-import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from dify_client import ChatClient
-from slack_bolt import Ack, BoltContext, BoltResponse
-from slack_bolt.request.payload_utils import is_event
+from requests import Response
+from slack_bolt import BoltContext
 from slack_sdk import WebClient
+from slack_sdk.web import SlackResponse
 
 from app.dify_ops import (
     format_dify_message_content,
-    get_answer_from_streaming_response,
+    get_dify_client,
+    get_dify_user,
     get_last_conversation_id,
+    is_stream_read_timeout,
+    iter_answer_from_streaming_response,
+    remember_conversation_id,
     upload_file_to_dify,
 )
-from app.env import TRANSLATE_MARKDOWN
-from app.markdown_conversion import slack_to_markdown
+from app.env import (
+    FILES_MAX_WORKERS,
+    PREFLIGHT_MAX_WORKERS,
+    STREAMING_ENABLED,
+    TRANSLATE_MARKDOWN,
+)
+from app.generation_registry import (
+    Generation,
+    find_cancelled_source,
+    generation_registry,
+)
+from app.generation_scheduler import (
+    CancelledInQueueError,
+    QueueFullError,
+    generation_scheduler,
+)
+from app.image_ops import preprocess_image
+from app.listener_logic import (
+    build_chat_kwargs,
+    build_history_query,
+    cache_answer,
+    dify_image_file,
+    error_reply_text,
+    find_cached_answer,
+    generation_outcome_text,
+    get_user_message,
+    history_bot_ids,
+    is_from_other_bot,
+    record_generation_error,
+    record_generation_outcome,
+    select_history_messages,
+    select_images,
+    should_answer_root_message,
+    uploaded_file_ids,
+)
+from app.message_coalescer import merge_messages, message_coalescer
+from app.resilience import dify_circuit_breaker
 from app.slack_ops import (
+    BUSY_TEXT,
+    CANCELLED_TEXT,
+    DEFAULT_LOADING_TEXT,
+    QUEUED_TEXT,
+    UNAVAILABLE_TEXT,
     download_slack_image_content,
-    find_parent_message,
-    is_this_app_mentioned,
+    fetch_thread_messages,
+    is_thread_for_this_app,
     post_wip_message,
+    remember_thread_owner,
+    resolve_bot_user_ids,
     update_wip_message,
+    update_wip_message_with_stream,
 )
+from app.slack_rate_limit import slack_api_scheduler
 
-
-def just_ack(ack: Ack):
-    ack()
+# Bounded pool for the independent Slack / Dify calls made before a generation
+preflight_executor = ThreadPoolExecutor(
+    max_workers=PREFLIGHT_MAX_WORKERS, thread_name_prefix="preflight"
+)
 
 
-def get_user_message(payload: dict, bot_user_id: str) -> str:
-    return re.sub(f"<@{bot_user_id}>\\s*", "", payload["text"])
+# Pool for downloading images from Slack and uploading them to Dify
+files_executor = ThreadPoolExecutor(
+    max_workers=FILES_MAX_WORKERS, thread_name_prefix="files"
+)
 
 
 def handle_response_error(
@@ -39,12 +94,178 @@ def handle_response_error(
     user_id: str,
     error: Exception,
 ):
-    logger.error(f"Failed to respond to app mention: {error}")
-    client.chat_postMessage(
+    slack_api_scheduler.call(
+        client,
+        "chat_postMessage",
         channel=channel_id,
         thread_ts=thread_ts,
-        text=f"<@{user_id}>\n申し訳ありませんが、エラーが発生しました。後ほどお試しください。",
+        text=error_reply_text(logger, user_id, error),
+    )
+
+
+def reply_with_answer(
+    client: WebClient,
+    dify_client: ChatClient,
+    channel_id: str,
+    thread_ts: str,
+    wip_reply: SlackResponse,
+    response: Response,
+    generation: Generation,
+) -> str:
+    wip_ts = wip_reply["message"]["ts"]
+    result = generation.result
+    chunks = generation.until_cancelled(
+        iter_answer_from_streaming_response(response, result)
+    )
+    if STREAMING_ENABLED:
+        reply_message = update_wip_message_with_stream(
+            client, channel_id, wip_ts, chunks
+        )
+    else:
+        reply_message = "".join(chunks)
+        update_wip_message(client, channel_id, wip_ts, reply_message)
+
+    remember_conversation_id(dify_client, thread_ts, result)
+    return reply_message
+
+
+def generate_reply(
+    context: BoltContext,
+    payload: dict,
+    client: WebClient,
+    dify_client: ChatClient,
+    thread_ts: str,
+    wip_reply: SlackResponse,
+    chat_kwargs: dict,
+) -> Optional[str]:
+    """
+    Run the Dify generation in a slot of the generation scheduler and write
+    the answer into the WIP reply. While waiting for a slot, the WIP reply
+    shows the position in the queue.
+
+    :return: The answer, unless the generation was cancelled or declined
+
+    The generation is registered while it runs, so that it is cancelled when
+    the source message is deleted or edited, or superseded by a newer message
+    of the same user in the thread.
+
+    While the Dify circuit breaker is open, the WIP reply says so right away;
+    a stream that stalls is cancelled by the registry's watchdog.
+    """
+    channel_id = context.channel_id
+    wip_ts = wip_reply["message"]["ts"]
+    queued = False
+    answer = None
+
+    def show_position(position: int):
+        nonlocal queued
+        queued = True
+        update_wip_message(
+            client, channel_id, wip_ts, QUEUED_TEXT.format(position=position)
+        )
+
+    def stop_task(task_id: str):
+        dify_client.stop_message(task_id, chat_kwargs["user"]).close()
+
+    try:
+        with (
+            generation_registry.track(
+                channel_id,
+                thread_ts,
+                payload["ts"],
+                stop_task,
+                # Stopping a superseded stream must not hold up this reply
+                run=preflight_executor.submit,
+                # A cancelled generation leaves the queue right away
+                on_cancel=generation_scheduler.wake,
+                user=context.actor_user_id or context.user_id,
+                merged_ts=payload.get("merged_ts", ()),
+            ) as generation,
+            generation_scheduler.slot(
+                channel_id,
+                context.actor_user_id or context.user_id,
+                priority=payload.get("channel_type") == "im",
+                on_queued=show_position,
+                cancelled=lambda: generation.cancelled,
+            ),
+        ):
+            if not generation.cancelled:
+                if not dify_circuit_breaker.allow():
+                    update_wip_message(client, channel_id, wip_ts, UNAVAILABLE_TEXT)
+                    return None
+                if queued:
+                    update_wip_message(client, channel_id, wip_ts, DEFAULT_LOADING_TEXT)
+                generation_registry.start_watchdog(preflight_executor.submit)
+                started_at = time.perf_counter()
+                try:
+                    response = dify_client.create_chat_message(
+                        response_mode="streaming", **chat_kwargs
+                    )
+                    generation.attach(response, started_at)
+                    with response:
+                        response.raise_for_status()
+                        answer = reply_with_answer(
+                            client,
+                            dify_client,
+                            channel_id,
+                            thread_ts,
+                            wip_reply,
+                            response,
+                            generation,
+                        )
+                except Exception as e:
+                    if not record_generation_error(
+                        generation, e, is_stream_read_timeout(e)
+                    ):
+                        raise
+                record_generation_outcome(generation, started_at)
+            outcome_text = generation_outcome_text(generation)
+            if outcome_text is not None:
+                update_wip_message(client, channel_id, wip_ts, outcome_text)
+                return None
+    except QueueFullError:
+        update_wip_message(client, channel_id, wip_ts, BUSY_TEXT)
+    except CancelledInQueueError:
+        update_wip_message(client, channel_id, wip_ts, CANCELLED_TEXT)
+    return answer
+
+
+def reply_from_answer_cache(
+    context: BoltContext, client: WebClient, thread_ts: str, query: str, files: list
+) -> bool:
+    """
+    Post the cached answer to the same question, if any, without a WIP reply.
+
+    :return: True if the question was answered from the cache
+    """
+    answer = find_cached_answer(context, query, files)
+    if answer is None:
+        return False
+    post_wip_message(
+        client=client,
+        channel=context.channel_id,
+        thread_ts=thread_ts,
+        loading_text=answer,
+    )
+    return True
+
+
+def build_thread_history_query(
+    client: WebClient,
+    channel_id: str,
+    thread_ts: str,
+    before_ts: str,
+    user_message: str,
+) -> str:
+    """
+    Prefix the message with the thread history before it, for the first
+    message of a thread sent to Dify.
+    """
+    messages_history = select_history_messages(
+        fetch_thread_messages(client, channel_id, thread_ts), before_ts
     )
+    bot_users = resolve_bot_user_ids(client, history_bot_ids(messages_history))
+    return build_history_query(messages_history, bot_users, user_message)
 
 
 def respond_to_app_mention(
@@ -54,72 +275,75 @@ def respond_to_app_mention(
     logger: logging.Logger,
 ):
     thread_ts = payload.get("thread_ts")
-    if thread_ts:
-        parent_message = find_parent_message(client, context.channel_id, thread_ts)
-        if parent_message and is_this_app_mentioned(context, parent_message):
-            return
+    user_id = context.actor_user_id or context.user_id
+    dify_client = get_dify_client(context["DIFY_APP_API_KEY"])
+
+    # Threads started by a mention are answered by the message listener
+    if thread_ts and is_thread_for_this_app(
+        context, client, context.channel_id, thread_ts
+    ):
+        return
 
     try:
-        user_id = context.actor_user_id or context.user_id
-        dify_client = ChatClient(context["DIFY_APP_API_KEY"])
         user_message = get_user_message(payload, context.bot_user_id)
         user_message = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
         files = payload.get("files", [])
 
         if thread_ts:
-            latest_conversation_id = get_last_conversation_id(dify_client, thread_ts)
-            messages_history = client.conversations_replies(
+            wip_reply_future = preflight_executor.submit(
+                post_wip_message,
+                client=client,
                 channel=context.channel_id,
-                ts=thread_ts,
-                include_all_metadata=True,
-                limit=1000,
-            ).get("messages", [])
-
-            wip_reply = post_wip_message(
-                client=client, channel=context.channel_id, thread_ts=thread_ts
+                thread_ts=thread_ts,
             )
+            # Looked up while the WIP message is being posted
+            latest_conversation_id = get_last_conversation_id(dify_client, thread_ts)
 
-            if latest_conversation_id:
-                response = dify_client.create_chat_message(
-                    inputs={"slack_user_id": user_id},
-                    query=user_message,
-                    conversation_id=latest_conversation_id,
-                    user=thread_ts.replace(".", "-"),
-                    response_mode="streaming",
-                )
-            else:
-                messages_fmt = "\n".join(
-                    f"<@{msg['user'] if 'user' in msg else msg['username']}>: {slack_to_markdown(msg['text'])}"
-                    for msg in messages_history
-                )
-                query = f"{messages_fmt}\n{user_message}"
-                response = dify_client.create_chat_message(
-                    inputs={"slack_user_id": user_id},
-                    query=query,
-                    user=thread_ts.replace(".", "-"),
-                    response_mode="streaming",
+            query = user_message
+            # The thread history is only needed to start a new Dify conversation
+            if not latest_conversation_id:
+                query = build_thread_history_query(
+                    client, context.channel_id, thread_ts, payload["ts"], user_message
                 )
+
+            wip_reply = wip_reply_future.result()
+            chat_kwargs = build_chat_kwargs(
+                user_id, query, get_dify_user(thread_ts), latest_conversation_id
+            )
         else:
-            wip_reply = post_wip_message(
-                client=client, channel=context.channel_id, thread_ts=payload.get("ts")
+            # This mention starts a thread the app will keep answering
+            remember_thread_owner(context.channel_id, payload.get("ts"), True)
+            if reply_from_answer_cache(
+                context, client, payload.get("ts"), user_message, files
+            ):
+                return
+            wip_reply_future = preflight_executor.submit(
+                post_wip_message,
+                client=client,
+                channel=context.channel_id,
+                thread_ts=payload.get("ts"),
             )
+            files_content = prepare_files_content(files, context, logger)
+            wip_reply = wip_reply_future.result()
 
-            files_paths = save_image_content(files, context)
-            files_content = create_files_content(files_paths, context)
-
-            response = dify_client.create_chat_message(
-                inputs={"slack_user_id": user_id},
-                query=user_message,
-                user=payload.get("ts").replace(".", "-"),
-                response_mode="streaming",
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                user_message,
+                get_dify_user(payload.get("ts")),
                 files=files_content,
             )
 
-        response.raise_for_status()
-        reply_message = get_answer_from_streaming_response(response)
-        update_wip_message(
-            client, context.channel_id, wip_reply["message"]["ts"], reply_message
+        answer = generate_reply(
+            context,
+            payload,
+            client,
+            dify_client,
+            thread_ts or payload.get("ts"),
+            wip_reply,
+            chat_kwargs,
         )
+        if not thread_ts:
+            cache_answer(context, user_message, files, answer)
 
     except Exception as e:
         handle_response_error(
@@ -133,84 +357,96 @@ def respond_to_new_message(
     client: WebClient,
     logger: logging.Logger,
 ):
-    if payload.get("bot_id") and payload.get("bot_id") != context.bot_id:
+    if is_from_other_bot(payload, context.bot_id):
         return
 
     try:
         is_in_dm_with_bot = payload.get("channel_type") == "im"
         thread_ts = payload.get("thread_ts")
-        dify_client = ChatClient(context["DIFY_APP_API_KEY"])
+        dify_client = get_dify_client(context["DIFY_APP_API_KEY"])
         user_id = context.actor_user_id or context.user_id
-        files = payload.get("files", [])
 
-        if not is_in_dm_with_bot and not thread_ts:
+        if not thread_ts:
+            if not should_answer_root_message(context, payload):
+                return
+        elif not is_thread_for_this_app(context, client, context.channel_id, thread_ts):
             return
 
+        # Quick successive messages of the user get a single answer
+        payloads = message_coalescer.collect(
+            (context.channel_id, thread_ts, user_id), payload
+        )
+        if payloads is None:
+            return
+        payload = merge_messages(payloads)
+        files = payload["files"]
         user_message = get_user_message(payload, context.bot_user_id)
 
         if is_in_dm_with_bot and not thread_ts:
-            wip_reply = post_wip_message(
-                client=client, channel=context.channel_id, thread_ts=payload.get("ts")
+            cache_query = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
+            if reply_from_answer_cache(
+                context, client, payload.get("ts"), cache_query, files
+            ):
+                return
+            wip_reply_future = preflight_executor.submit(
+                post_wip_message,
+                client=client,
+                channel=context.channel_id,
+                thread_ts=payload.get("ts"),
             )
+            files_content = prepare_files_content(files, context, logger)
+            wip_reply = wip_reply_future.result()
 
-            files_paths = save_image_content(files, context)
-            files_content = create_files_content(files_paths, context)
-
-            response = dify_client.create_chat_message(
-                inputs={"slack_user_id": user_id},
-                query=user_message,
-                user=payload.get("ts").replace(".", "-"),
-                response_mode="streaming",
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                user_message,
+                get_dify_user(payload.get("ts")),
                 files=files_content,
             )
         else:
-            messages_in_context = client.conversations_replies(
+            # Everything below only runs for threads owned by this app,
+            # and none of these calls depend on each other
+            wip_reply_future = preflight_executor.submit(
+                post_wip_message,
+                client=client,
                 channel=context.channel_id,
-                ts=thread_ts,
-                include_all_metadata=True,
-                limit=1000,
-            ).get("messages", [])
-
-            is_thread_for_this_app = any(
-                message.get("ts") == thread_ts
-                and is_this_app_mentioned(context, message)
-                for message in messages_in_context
+                thread_ts=thread_ts,
             )
-            if not is_thread_for_this_app:
-                return
-
-            wip_reply = post_wip_message(
-                client=client, channel=context.channel_id, thread_ts=thread_ts
+            conversation_id_future = preflight_executor.submit(
+                get_last_conversation_id, dify_client, thread_ts
             )
-            latest_conversation_id = get_last_conversation_id(dify_client, thread_ts)
             user_message = format_dify_message_content(user_message, TRANSLATE_MARKDOWN)
-
-            files_paths = save_image_content(files, context)
-            files_content = create_files_content(files_paths, context)
-
-            if latest_conversation_id:
-                response = dify_client.create_chat_message(
-                    inputs={"slack_user_id": user_id},
-                    query=user_message,
-                    conversation_id=latest_conversation_id,
-                    user=thread_ts.replace(".", "-"),
-                    response_mode="streaming",
-                    files=files_content,
-                )
-            else:
-                response = dify_client.create_chat_message(
-                    inputs={"slack_user_id": user_id},
-                    query=user_message,
-                    user=thread_ts.replace(".", "-"),
-                    response_mode="streaming",
-                    files=files_content,
+            files_content = prepare_files_content(files, context, logger)
+            latest_conversation_id = conversation_id_future.result()
+
+            query = user_message
+            # No conversation yet: the thread was answered from the answer
+            # cache, or the conversation expired
+            if not latest_conversation_id:
+                query = build_thread_history_query(
+                    client, context.channel_id, thread_ts, payload["ts"], user_message
                 )
+            wip_reply = wip_reply_future.result()
+
+            chat_kwargs = build_chat_kwargs(
+                user_id,
+                query,
+                get_dify_user(thread_ts),
+                latest_conversation_id,
+                files_content,
+            )
 
-        response.raise_for_status()
-        reply_message = get_answer_from_streaming_response(response)
-        update_wip_message(
-            client, context.channel_id, wip_reply["message"]["ts"], reply_message
+        answer = generate_reply(
+            context,
+            payload,
+            client,
+            dify_client,
+            thread_ts or payload.get("ts"),
+            wip_reply,
+            chat_kwargs,
         )
+        if is_in_dm_with_bot and not thread_ts:
+            cache_answer(context, cache_query, files, answer)
 
     except Exception as e:
         handle_response_error(
@@ -218,71 +454,45 @@ def respond_to_new_message(
         )
 
 
-def register_listeners(app):
-    app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
-    app.event("message")(ack=just_ack, lazy=[respond_to_new_message])
+def upload_slack_image_to_dify(file: dict, context: BoltContext) -> dict:
+    api_key = context["DIFY_APP_API_KEY"]
+    # Re-sent or shared images are resolved from the cache without any I/O
+    file_id_key = (api_key, file["id"])
+    upload_file_id = uploaded_file_ids.get(file_id_key)
 
-
-MESSAGE_SUBTYPES_TO_SKIP = ["message_changed", "message_deleted"]
-
-
-# To reduce unnecessary workload in this app,
-# this before_authorize function skips message changed/deleted events.
-# Especially, "message_changed" events can be triggered many times when the app rapidly updates its reply.
-def before_authorize(
-    body: dict,
-    payload: dict,
-    logger: logging.Logger,
-    next_,
-):
-    if (
-        is_event(body)
-        and payload.get("type") == "message"
-        and payload.get("subtype") in MESSAGE_SUBTYPES_TO_SKIP
-    ):
-        logger.debug(
-            "Skipped the following middleware and listeners "
-            f"for this message event (subtype: {payload.get('subtype')})"
+    if upload_file_id is None:
+        image_content = download_slack_image_content(
+            file["url_private"], context.bot_token
         )
-        return BoltResponse(status=200, body="")
-    next_()
-
-
-def save_image_content(files: list, context: BoltContext) -> dict:
-    file_paths = {}
-
-    if len(files) == 0:
-        return file_paths
-
-    for file in files:
-        mime_type = file.get("mimetype", "")
-        if mime_type.startswith("image/"):
-            image_url = file["url_private"]
-            file_name = file.get("name", "image.jpg")
-            local_image_path = download_slack_image_content(
-                image_url, file_name, context.bot_token
+        digest_key = (api_key, hashlib.sha256(image_content).hexdigest())
+        upload_file_id = uploaded_file_ids.get(digest_key)
+        if upload_file_id is None:
+            image_content, file_name, mime_type = preprocess_image(
+                image_content, file.get("name", "image.jpg"), file["mimetype"]
+            )
+            response = upload_file_to_dify(
+                file_name, image_content, api_key, context.user_id, mime_type
             )
-            file_paths[file_name] = local_image_path
+            upload_file_id = response["id"]
+            uploaded_file_ids.set(digest_key, upload_file_id)
+        uploaded_file_ids.set(file_id_key, upload_file_id)
 
-    return file_paths
+    return dify_image_file(upload_file_id)
 
 
-def create_files_content(files: dict, context: BoltContext) -> list:
-    files_content = []
-    if len(files) == 0:
-        return files_content
+def prepare_files_content(
+    files: list, context: BoltContext, logger: logging.Logger
+) -> list:
+    # Download from Slack and upload to Dify in parallel, keeping the file order
+    futures = [
+        files_executor.submit(upload_slack_image_to_dify, file, context)
+        for file in select_images(files, logger)
+    ]
+    return [future.result() for future in futures]
 
-    for _, file_path in files.items():
-        response = upload_file_to_dify(
-            file_path, context["DIFY_APP_API_KEY"], context.user_id
-        )
-
-        files_content.append(
-            {
-                "type": "image",
-                "transfer_method": "local_file",
-                "upload_file_id": response["id"],
-            }
-        )
 
-    return files_content
+def cancel_generation_for(payload: dict) -> None:
+    """Cancel the answer to the message deleted or edited by this event, if any."""
+    source = find_cancelled_source(payload)
+    if source is not None and source in generation_registry:
+        preflight_executor.submit(generation_registry.cancel, *source)
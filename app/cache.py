@@ -0,0 +1,187 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Protocol
+
+# ----------------------------
+# In-process cache
+# ----------------------------
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after `ttl` seconds.
+
+    The least recently used entry is evicted once `maxsize` entries are stored.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> bool:
+        """Store the value only if the key is absent (or expired)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# ----------------------------
+# Durable backends
+# ----------------------------
+
+
+class KeyValueBackend(Protocol):
+    """Interface for the shared / durable stores behind the in-process caches."""
+
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str, ttl: float) -> None: ...
+
+
+class AddIfAbsentBackend(Protocol):
+    """Shared store with an atomic add-if-absent, e.g. a DynamoDB conditional put."""
+
+    def add(self, key: str, value: str, ttl: float) -> bool: ...
+
+
+class SQLiteBackend:
+    """KeyValueBackend persisted in a local SQLite file."""
+
+    def __init__(self, path: str, table: str = "kv"):
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE expires_at <= ?", (time.time(),)
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE "
+                "SET value = excluded.value, expires_at = excluded.expires_at "
+                f"WHERE {self.table}.expires_at <= ?",
+                (key, value, now + ttl, now),
+            )
+        return cursor.rowcount == 1
+
+
+class DynamoDBBackend:
+    """
+    KeyValueBackend stored in a DynamoDB table whose partition key is `key`.
+
+    Enable the table's TTL on the `expires_at` attribute so that expired items
+    are eventually deleted. boto3 is provided by the AWS Lambda runtime.
+    """
+
+    def __init__(self, table_name: str, client=None):
+        if client is None:
+            import boto3
+
+            client = boto3.client("dynamodb")
+        self.table_name = table_name
+        self._client = client
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._client.get_item(
+            TableName=self.table_name, Key={"key": {"S": key}}, ConsistentRead=True
+        ).get("Item")
+        if item is None or float(item["expires_at"]["N"]) <= time.time():
+            return None
+        return item["value"]["S"]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self._client.put_item(
+            TableName=self.table_name, Item=self._item(key, value, ttl)
+        )
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        try:
+            self._client.put_item(
+                TableName=self.table_name,
+                Item=self._item(key, value, ttl),
+                ConditionExpression="attribute_not_exists(#key) OR expires_at <= :now",
+                ExpressionAttributeNames={"#key": "key"},
+                ExpressionAttributeValues={":now": {"N": str(int(time.time()))}},
+            )
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    @staticmethod
+    def _item(key: str, value: str, ttl: float) -> dict:
+        return {
+            "key": {"S": key},
+            "value": {"S": value},
+            "expires_at": {"N": str(int(time.time() + ttl))},
+        }
@@ -0,0 +1,58 @@
+import hashlib
+from typing import Optional
+
+from app.cache import KeyValueBackend, SQLiteBackend, TTLCache
+from app.env import (
+    CONVERSATION_CACHE_MAX_SIZE,
+    CONVERSATION_CACHE_TTL_SECONDS,
+    CONVERSATION_STORE_SQLITE_PATH,
+)
+
+
+class ConversationStore:
+    """
+    Mapping from the Dify user (derived from the Slack thread_ts) to the Dify
+    conversation_id, so threaded replies can skip the get_conversations call.
+
+    Lookups hit the in-process LRU first and fall back to the optional durable
+    backend, which survives restarts and can be shared between processes.
+    """
+
+    def __init__(
+        self,
+        cache: TTLCache,
+        backend: Optional[KeyValueBackend] = None,
+    ):
+        self.cache = cache
+        self.backend = backend
+
+    @staticmethod
+    def _key(api_key: str, dify_user: str) -> str:
+        # Never persist the API key itself; a digest is enough to separate apps
+        app_digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        return f"{app_digest}:{dify_user}"
+
+    def get(self, api_key: str, dify_user: str) -> Optional[str]:
+        key = self._key(api_key, dify_user)
+        conversation_id = self.cache.get(key)
+        if conversation_id is None and self.backend is not None:
+            conversation_id = self.backend.get(key)
+            if conversation_id is not None:
+                self.cache.set(key, conversation_id)
+        return conversation_id
+
+    def set(self, api_key: str, dify_user: str, conversation_id: str) -> None:
+        key = self._key(api_key, dify_user)
+        self.cache.set(key, conversation_id)
+        if self.backend is not None:
+            self.backend.set(key, conversation_id, self.cache.ttl)
+
+
+conversation_store = ConversationStore(
+    cache=TTLCache(CONVERSATION_CACHE_MAX_SIZE, CONVERSATION_CACHE_TTL_SECONDS),
+    backend=(
+        SQLiteBackend(CONVERSATION_STORE_SQLITE_PATH, table="conversations")
+        if CONVERSATION_STORE_SQLITE_PATH
+        else None
+    ),
+)
@@ -1,12 +1,77 @@
 import json
-from typing import Optional
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
 
-import requests
 from dify_client import ChatClient
 from requests import Response
-from sseclient import SSEClient
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import ReadTimeout
+from urllib3.exceptions import ReadTimeoutError
 
+from app.conversation_store import conversation_store
+from app.env import DIFY_API_BASE_URL
+from app.http_pool import DEFAULT_TIMEOUT, STREAM_TIMEOUT, get_session
 from app.markdown_conversion import slack_to_markdown
+from app.metrics import metrics
+from app.resilience import dify_circuit_breaker, retry_call
+
+# ----------------------------
+# Client
+# ----------------------------
+
+
+class PooledChatClient(ChatClient):
+    """ChatClient sending its requests through the shared keep-alive session."""
+
+    def __init__(self, api_key: str, base_url: str = DIFY_API_BASE_URL):
+        super().__init__(api_key)
+        self.base_url = base_url.rstrip("/")
+        self.session = get_session(self.base_url)
+
+    def _send_request(self, method, endpoint, json=None, params=None, stream=False):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+        return self.session.request(
+            method,
+            f"{self.base_url}{endpoint}",
+            json=json,
+            params=params,
+            headers=headers,
+            stream=stream,
+            timeout=STREAM_TIMEOUT if stream else DEFAULT_TIMEOUT,
+        )
+
+    def _send_request_with_files(self, method, endpoint, data, files):
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        return self.session.request(
+            method,
+            f"{self.base_url}{endpoint}",
+            data=data,
+            headers=headers,
+            files=files,
+            timeout=DEFAULT_TIMEOUT,
+        )
+
+    # Not provided by dify-client 0.1.10
+    def stop_message(self, task_id, user):
+        data = {"user": user}
+        return self._send_request("POST", f"/chat-messages/{task_id}/stop", data)
+
+
+_dify_clients: dict[str, PooledChatClient] = {}
+
+
+def get_dify_client(api_key: str) -> PooledChatClient:
+    # ChatClient only holds the API key, so one instance per key can be shared
+    client = _dify_clients.get(api_key)
+    if client is None:
+        client = _dify_clients.setdefault(api_key, PooledChatClient(api_key))
+    return client
+
 
 # ----------------------------
 # Internal functions
@@ -31,16 +96,77 @@ def format_dify_message_content(
     return content
 
 
+@dataclass
+class StreamingResult:
+    """Answer and metadata collected from a Dify stream while it is consumed."""
+
+    answer_chunks: list[str] = field(default_factory=list)
+    conversation_id: Optional[str] = None
+    message_id: Optional[str] = None
+    task_id: Optional[str] = None
+    usage: Optional[dict] = None
+    # Generation latency in seconds as reported by Dify in message_end
+    latency: Optional[float] = None
+    # time.perf_counter() of the first and latest events, the first answer
+    # chunk and message_end
+    first_event_at: Optional[float] = None
+    last_event_at: Optional[float] = None
+    first_answer_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def answer(self) -> str:
+        return "".join(self.answer_chunks)
+
+
+def is_stream_read_timeout(error: BaseException) -> bool:
+    """Whether a streaming request timed out waiting for the headers or the next chunk."""
+    if isinstance(error, ReadTimeout):
+        return True
+    # Raised by iter_content for a read timeout in the body
+    return isinstance(error, RequestsConnectionError) and any(
+        isinstance(arg, ReadTimeoutError) for arg in error.args
+    )
+
+
+def get_dify_user(ts: str) -> str:
+    return ts.replace(".", "-")
+
+
+@metrics.timed("dify.get_last_conversation_id")
 def get_last_conversation_id(client: ChatClient, thread_ts: str) -> Optional[str]:
-    res = client.get_conversations(thread_ts.replace(".", "-"))
-    res.raise_for_status()
-    conversation_history = res.json()
+    dify_user = get_dify_user(thread_ts)
+    conversation_id = conversation_store.get(client.api_key, dify_user)
+    if conversation_id is not None:
+        return conversation_id
+
+    def get_conversations():
+        res = client.get_conversations(dify_user)
+        res.raise_for_status()
+        return res.json()
+
+    conversation_history = retry_call(
+        get_conversations, name="dify.get_conversations", breaker=dify_circuit_breaker
+    )
     if len(conversation_history["data"]) == 0:
         return None
-    return conversation_history["data"][-1]["id"]
+    conversation_id = conversation_history["data"][-1]["id"]
+    conversation_store.set(client.api_key, dify_user, conversation_id)
+    return conversation_id
+
+
+def remember_conversation_id(
+    client: ChatClient, ts: str, result: StreamingResult
+) -> None:
+    if result.conversation_id is not None:
+        conversation_store.set(
+            client.api_key, get_dify_user(ts), result.conversation_id
+        )
 
 
-def get_answer_from_streaming_response(response: Response) -> str:
+def get_answer_from_streaming_response(
+    response: Response, result: Optional[StreamingResult] = None
+) -> str:
     """
     Get the answer from the streaming response.
 
@@ -60,32 +186,164 @@ def get_answer_from_streaming_response(response: Response) -> str:
     data: {"event": "tts_message_end", "conversation_id": "23dd85f3-1a41-4ea0-b7a9-062734ccfaf9", "message_id": "a8bdc41c-13b2-4c18-bfd9-054b9803038c", "created_at": 1721205487, "task_id": "3bf8a0bb-e73b-4690-9e66-4e429bad8ee7", "audio": ""}
 
     :param response: The response from the streaming request
+    :param result: If given, filled with the answer and metadata from the stream
     :return: The answer from the response
     """
 
-    client = SSEClient(response)
+    if result is None:
+        result = StreamingResult()
+    for _ in iter_answer_from_streaming_response(response, result):
+        pass
+    return result.answer
 
-    answer = ""
 
-    for event in client.events():
-        data = json.loads(event.data)
-        if data["event"] == "message":
-            answer += data.get("answer", "")
-        elif data["event"] == "message_end":
-            break
+# Dify puts "event" first in every payload, so the event name can be read
+# from the head of the data line without decoding the rest of it
+_EVENT_NAME_PATTERN = re.compile(rb'^\s*\{\s*"event"\s*:\s*"([^"]+)"')
+_json_decoder = json.JSONDecoder()
 
-    return answer
+
+def _decode_event_data(data: bytes) -> dict:
+    # Dify streams UTF-8, which spares json.loads detecting the encoding
+    return _json_decoder.decode(data.decode())
+
+
+class StreamingEventParser:
+    """
+    Incremental parser of the server-sent events in a Dify stream, shared by
+    the sync and the asyncio clients.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._data_lines = []
+
+    def feed(self, chunk: bytes) -> Iterator[tuple[str, bytes]]:
+        """
+        :return: An iterator over the (event name, raw JSON data) pairs completed by the chunk
+        """
+        self._pending.append(chunk)
+        # Large payloads arrive in many chunks; only join once a line is complete
+        if b"\n" not in chunk:
+            return
+        lines = b"".join(self._pending).split(b"\n")
+        self._pending = [lines.pop()]
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line.startswith(b"data:"):
+                self._data_lines.append(line[5:].lstrip())
+            elif not line and self._data_lines:
+                data = b"\n".join(self._data_lines)
+                self._data_lines = []
+                match = _EVENT_NAME_PATTERN.match(data)
+                if match is not None:
+                    yield match.group(1).decode(), data
+                else:
+                    yield _decode_event_data(data).get("event", ""), data
+
+    def close(self) -> Iterator[tuple[str, bytes]]:
+        """
+        :return: The event left unterminated at the end of the stream, if any
+        """
+        # A last data line without its trailing newline
+        line = b"".join(self._pending).rstrip(b"\r")
+        self._pending = []
+        if line.startswith(b"data:"):
+            self._data_lines.append(line[5:].lstrip())
+        if self._data_lines:
+            data = b"\n".join(self._data_lines)
+            self._data_lines = []
+            yield _decode_event_data(data).get("event", ""), data
+
+
+def iter_streaming_events(response: Response) -> Iterator[tuple[str, bytes]]:
+    """
+    Incrementally parse the server-sent events of the streaming response.
+
+    :param response: The response from the streaming request
+    :return: An iterator over (event name, raw JSON data) pairs
+    """
+    parser = StreamingEventParser()
+    for chunk in response.iter_content(chunk_size=None):
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def consume_answer_event(
+    event: str, raw_data: bytes, result: StreamingResult
+) -> Optional[str]:
+    """
+    Collect a streamed event into the result.
+
+    Only message and message_end events are decoded; workflow, retriever and
+    TTS payloads are skipped by their event name.
+
+    :return: The answer chunk of a message event, otherwise None
+    """
+    result.last_event_at = time.perf_counter()
+    if result.first_event_at is None:
+        result.first_event_at = result.last_event_at
+    if event == "message":
+        data = _decode_event_data(raw_data)
+        if result.first_answer_at is None:
+            result.first_answer_at = time.perf_counter()
+        if result.conversation_id is None:
+            result.conversation_id = data.get("conversation_id")
+            result.message_id = data.get("message_id")
+            result.task_id = data.get("task_id")
+        answer = data.get("answer", "")
+        result.answer_chunks.append(answer)
+        return answer
+    if event == "message_end":
+        result.finished_at = time.perf_counter()
+        data = _decode_event_data(raw_data)
+        result.conversation_id = data.get("conversation_id", result.conversation_id)
+        result.message_id = data.get("id", result.message_id)
+        result.task_id = data.get("task_id", result.task_id)
+        result.usage = data.get("metadata", {}).get("usage")
+        if result.usage is not None:
+            result.latency = result.usage.get("latency")
+    return None
+
+
+def iter_answer_from_streaming_response(
+    response: Response, result: Optional[StreamingResult] = None
+) -> Iterator[str]:
+    """
+    Yield the answer chunks from the streaming response as they arrive.
+
+    See get_answer_from_streaming_response for the format of the events.
+
+    :param response: The response from the streaming request
+    :param result: If given, filled with the answer and metadata from the stream
+    :return: An iterator over the answer chunks
+    """
+    if result is None:
+        result = StreamingResult()
+
+    for event, raw_data in iter_streaming_events(response):
+        answer = consume_answer_event(event, raw_data, result)
+        if answer is not None:
+            yield answer
+        elif event == "message_end":
+            break
 
 
 # 画像のアップロード
+@metrics.timed("dify.upload_file")
 def upload_file_to_dify(
-    file_path: str, api_key: str, user_id: str, mime_type: str = "image/jpeg"
+    file_name: str,
+    file_content: bytes,
+    api_key: str,
+    user_id: str,
+    mime_type: str = "image/jpeg",
 ) -> dict:
     """
     Difyの/files/uploadエンドポイントを使ってファイルをアップロードする関数
 
     Args:
-        file_path (str): アップロードするローカルファイルのパス
+        file_name (str): アップロードするファイルの名前
+        file_content (bytes): アップロードするファイルの内容
         api_key (str): DifyのAPIキー
         user_id (str): ユーザーID
         mime_type (str): ファイルのMIMEタイプ（デフォルト: image/jpeg）
@@ -93,17 +351,25 @@ def upload_file_to_dify(
     Returns:
         dict: アップロードのレスポンスデータ
     """
-    url = "https://api.dify.ai/v1/files/upload"
+    url = f"{DIFY_API_BASE_URL.rstrip('/')}/files/upload"
     headers = {
         "Authorization": f"Bearer {api_key}",
     }
-    with open(file_path, "rb") as file_data:
-        files = {
-            "file": (file_path, file_data, mime_type)  # MIMEタイプを指定
-        }
-        data = {"user": user_id}
-        response = requests.post(url, headers=headers, files=files, data=data)
+    files = {
+        "file": (file_name, file_content, mime_type)  # MIMEタイプを指定
+    }
+    data = {"user": user_id}
+
+    def post() -> Response:
+        response = get_session(url).post(
+            url, headers=headers, files=files, data=data, timeout=DEFAULT_TIMEOUT
+        )
+        # Retried by retry_call
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
 
+    response = retry_call(post, name="dify.upload_file", breaker=dify_circuit_breaker)
     if response.status_code != 201:
         raise Exception(
             f"Failed to upload file: {response.status_code}, {response.text}"
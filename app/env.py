@@ -1,2 +1,170 @@
+import os
+
 IMAGE_FILE_ACCESS_ENABLED = True
 TRANSLATE_MARKDOWN = True
+
+# Progressive streaming of Dify answers into the WIP message
+STREAMING_ENABLED = os.environ.get("STREAMING_ENABLED", "true").lower() == "true"
+STREAMING_UPDATE_INTERVAL_SECONDS = float(
+    os.environ.get("STREAMING_UPDATE_INTERVAL_SECONDS", "1.0")
+)
+STREAMING_UPDATE_MIN_BYTES = int(os.environ.get("STREAMING_UPDATE_MIN_BYTES", "1024"))
+
+# thread_ts -> Dify conversation_id mapping
+CONVERSATION_CACHE_MAX_SIZE = int(
+    os.environ.get("CONVERSATION_CACHE_MAX_SIZE", "10000")
+)
+CONVERSATION_CACHE_TTL_SECONDS = float(
+    os.environ.get("CONVERSATION_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60))
+)
+CONVERSATION_STORE_SQLITE_PATH = os.environ.get("CONVERSATION_STORE_SQLITE_PATH")
+
+# Concurrent pre-flight calls before a Dify generation
+PREFLIGHT_MAX_WORKERS = int(os.environ.get("PREFLIGHT_MAX_WORKERS", "16"))
+
+# Dify API / shared HTTP connection pools
+DIFY_API_BASE_URL = os.environ.get("DIFY_API_BASE_URL", "https://api.dify.ai/v1")
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get("HTTP_CONNECT_TIMEOUT_SECONDS", "5")
+)
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get("HTTP_READ_TIMEOUT_SECONDS", "60"))
+
+# Slack -> Dify image pipeline
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+FILES_MAX_WORKERS = int(os.environ.get("FILES_MAX_WORKERS", "8"))
+
+# Slack file id / content digest -> Dify upload_file_id; keep the TTL within
+# the retention of uploaded files on the Dify side
+UPLOAD_CACHE_MAX_SIZE = int(os.environ.get("UPLOAD_CACHE_MAX_SIZE", "1000"))
+UPLOAD_CACHE_TTL_SECONDS = float(
+    os.environ.get("UPLOAD_CACHE_TTL_SECONDS", str(24 * 60 * 60))
+)
+
+# Downscaling / recompression of images before the Dify upload (needs Pillow)
+IMAGE_PREPROCESSING_ENABLED = (
+    os.environ.get("IMAGE_PREPROCESSING_ENABLED", "false").lower() == "true"
+)
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_OUTPUT_FORMAT = os.environ.get("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_OUTPUT_QUALITY = int(os.environ.get("IMAGE_OUTPUT_QUALITY", "85"))
+
+# Thread history cache for conversations.replies
+THREAD_HISTORY_CACHE_MAX_BYTES = int(
+    os.environ.get("THREAD_HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024))
+)
+
+# Index of thread roots mentioning this app; negative entries expire sooner
+# because a root message can be edited to mention the app later
+THREAD_OWNERSHIP_CACHE_MAX_SIZE = int(
+    os.environ.get("THREAD_OWNERSHIP_CACHE_MAX_SIZE", "100000")
+)
+THREAD_OWNERSHIP_CACHE_TTL_SECONDS = float(
+    os.environ.get("THREAD_OWNERSHIP_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60))
+)
+THREAD_OWNERSHIP_NEGATIVE_TTL_SECONDS = float(
+    os.environ.get("THREAD_OWNERSHIP_NEGATIVE_TTL_SECONDS", str(60 * 60))
+)
+
+# Slack bot_id -> bot user id resolved with bots.info
+BOT_USER_CACHE_MAX_SIZE = int(os.environ.get("BOT_USER_CACHE_MAX_SIZE", "1000"))
+BOT_USER_CACHE_TTL_SECONDS = float(
+    os.environ.get("BOT_USER_CACHE_TTL_SECONDS", str(24 * 60 * 60))
+)
+
+# Approximate token budget of the thread history sent to start a new Dify
+# conversation; 0 sends the whole thread
+THREAD_HISTORY_MAX_TOKENS = int(os.environ.get("THREAD_HISTORY_MAX_TOKENS", "8000"))
+
+# Dedup of Slack retries / duplicated events; the optional shared store is
+# needed when deliveries can reach different processes (e.g. Lambda)
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_CACHE_MAX_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_MAX_SIZE", "10000"))
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_SQLITE_PATH = os.environ.get("IDEMPOTENCY_SQLITE_PATH")
+IDEMPOTENCY_DYNAMODB_TABLE = os.environ.get("IDEMPOTENCY_DYNAMODB_TABLE")
+
+# Slack Web API
+SLACK_API_BASE_URL = os.environ.get("SLACK_API_BASE_URL", "https://slack.com/api/")
+SLACK_RATE_LIMIT_ENABLED = (
+    os.environ.get("SLACK_RATE_LIMIT_ENABLED", "true").lower() == "true"
+)
+SLACK_RATE_LIMIT_MAX_RETRIES = int(os.environ.get("SLACK_RATE_LIMIT_MAX_RETRIES", "3"))
+
+# Connections of the aiohttp session used by index_async.py; every streaming
+# generation holds one for its whole duration
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get("ASYNC_HTTP_MAX_CONNECTIONS", "512"))
+
+# Admission of the Dify generations: global / per-channel / per-user caps and
+# the number of generations allowed to wait for a slot
+GENERATION_MAX_WORKERS = int(os.environ.get("GENERATION_MAX_WORKERS", "16"))
+GENERATION_MAX_PER_CHANNEL = int(os.environ.get("GENERATION_MAX_PER_CHANNEL", "4"))
+GENERATION_MAX_PER_USER = int(os.environ.get("GENERATION_MAX_PER_USER", "2"))
+GENERATION_QUEUE_MAX_SIZE = int(os.environ.get("GENERATION_QUEUE_MAX_SIZE", "100"))
+# A changed queue position is shown at most this often, so that a long queue
+# doesn't turn every admission into a chat.update of each waiting reply
+GENERATION_QUEUE_POSITION_INTERVAL_SECONDS = float(
+    os.environ.get("GENERATION_QUEUE_POSITION_INTERVAL_SECONDS", "5")
+)
+
+# Threads running the lazy listeners of the sync app (Socket Mode). Bolt's
+# default of 5 would cap the generations before the scheduler above does, so
+# every running and queued generation gets a thread by default
+LISTENER_MAX_WORKERS = int(
+    os.environ.get(
+        "LISTENER_MAX_WORKERS", str(GENERATION_MAX_WORKERS + GENERATION_QUEUE_MAX_SIZE)
+    )
+)
+
+# Messages posted by a user in the same thread within this window are answered
+# together with a single generation; 0 answers every message separately
+MESSAGE_COALESCE_WINDOW_MS = int(os.environ.get("MESSAGE_COALESCE_WINDOW_MS", "0"))
+MESSAGE_COALESCE_MAX_WAIT_MS = int(
+    os.environ.get("MESSAGE_COALESCE_MAX_WAIT_MS", "5000")
+)
+
+# Durations of the Slack / Dify operations and Dify token usage, written to
+# stdout in CloudWatch Embedded Metric Format; the optional port serves them
+# to Prometheus in Socket Mode (requires the `metrics` extra)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "DifySlackBot")
+METRICS_PROMETHEUS_PORT = (
+    int(os.environ["METRICS_PROMETHEUS_PORT"])
+    if os.environ.get("METRICS_PROMETHEUS_PORT")
+    else None
+)
+
+# Opt-in cache of the answers to top-level questions without files; change
+# the version to invalidate the cached answers (e.g. after a knowledge base
+# update). The optional SQLite file shares them between local processes
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_MAX_SIZE = int(os.environ.get("ANSWER_CACHE_MAX_SIZE", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(
+    os.environ.get("ANSWER_CACHE_TTL_SECONDS", str(24 * 60 * 60))
+)
+ANSWER_CACHE_VERSION = os.environ.get("ANSWER_CACHE_VERSION", "1")
+ANSWER_CACHE_SQLITE_PATH = os.environ.get("ANSWER_CACHE_SQLITE_PATH")
+
+# Resilience of the Dify calls: the stream is cancelled when its first event
+# or the next one doesn't arrive in time, idempotent calls (conversation
+# lookups, file uploads) are retried with jittered backoff, and after
+# consecutive failures the circuit opens and replies fail fast (0 disables it)
+DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS = float(
+    os.environ.get("DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS", "30")
+)
+DIFY_STREAM_IDLE_TIMEOUT_SECONDS = float(
+    os.environ.get("DIFY_STREAM_IDLE_TIMEOUT_SECONDS", "30")
+)
+DIFY_RETRY_MAX_ATTEMPTS = int(os.environ.get("DIFY_RETRY_MAX_ATTEMPTS", "3"))
+DIFY_RETRY_BASE_DELAY_SECONDS = float(
+    os.environ.get("DIFY_RETRY_BASE_DELAY_SECONDS", "0.5")
+)
+DIFY_RETRY_MAX_DELAY_SECONDS = float(
+    os.environ.get("DIFY_RETRY_MAX_DELAY_SECONDS", "4")
+)
+DIFY_CIRCUIT_FAILURE_THRESHOLD = int(
+    os.environ.get("DIFY_CIRCUIT_FAILURE_THRESHOLD", "5")
+)
+DIFY_CIRCUIT_RECOVERY_SECONDS = float(
+    os.environ.get("DIFY_CIRCUIT_RECOVERY_SECONDS", "30")
+)
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional
+
+from app.dify_ops import StreamingResult
+from app.env import (
+    DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS,
+    DIFY_STREAM_IDLE_TIMEOUT_SECONDS,
+)
+from app.http_pool import abort_response
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func: Callable[[], object]) -> object:
+    return func()
+
+
+@dataclass
+class Generation:
+    """
+    A Dify generation in flight, answering the Slack message `source_ts` of
+    `user`.
+
+    `stop_task` calls Dify's stop API with the task_id read from the stream;
+    `response` is the open streaming response, aborted on cancellation so that
+    a read blocked on it returns right away.
+
+    `started_at` is the time.perf_counter() when the request was sent; the
+    registry's watchdog times the generation out when the stream stalls.
+
+    `on_cancel` is called right after the generation is marked cancelled, e.g.
+    to wake it up while it waits for a slot of the generation scheduler.
+    """
+
+    channel: str
+    thread_ts: str
+    source_ts: str
+    stop_task: Callable[[str], object]
+    user: Optional[str] = None
+    result: StreamingResult = field(default_factory=StreamingResult)
+    response: Optional[object] = None
+    started_at: Optional[float] = None
+    on_cancel: Optional[Callable[[], object]] = None
+    _cancelled: threading.Event = field(default_factory=threading.Event)
+    _timed_out: bool = False
+    _task_stopped: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def timed_out(self) -> bool:
+        return self._timed_out
+
+    def attach(self, response, started_at: Optional[float] = None) -> None:
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.response = response
+        if self.cancelled:
+            self.cancel()
+
+    def stalled(
+        self, now: float, first_byte_timeout: float, idle_timeout: float
+    ) -> Optional[str]:
+        """
+        :return: "first_byte" or "idle" when the stream waited too long for
+            its first / next event, otherwise None
+        """
+        if (
+            self.response is None
+            or self.started_at is None
+            or self.cancelled
+            # Only the final chat.update is left
+            or self.result.finished_at is not None
+        ):
+            return None
+        last_event_at = self.result.last_event_at
+        if last_event_at is None:
+            if now - self.started_at > first_byte_timeout:
+                return "first_byte"
+        elif now - last_event_at > idle_timeout:
+            return "idle"
+        return None
+
+    def time_out(self, run: Callable[[Callable[[], None]], object] = _call) -> None:
+        self._timed_out = True
+        self.cancel(run)
+
+    def cancel(self, run: Callable[[Callable[[], None]], object] = _call) -> None:
+        """
+        Mark the generation as cancelled, then stop the Dify task and abort
+        the stream through `run`, e.g. an executor's submit, since the stop
+        call blocks.
+        """
+        self._cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel()
+        run(self._stop)
+
+    def _stop(self) -> None:
+        with self._lock:
+            task_id = self.result.task_id
+            should_stop = task_id is not None and not self._task_stopped
+            self._task_stopped = self._task_stopped or should_stop
+        if should_stop:
+            try:
+                self.stop_task(task_id)
+            except Exception as e:
+                logger.warning(f"Failed to stop the Dify task {task_id}: {e}")
+        if self.response is not None:
+            abort_response(self.response)
+
+    def until_cancelled(self, chunks: Iterator[str]) -> Iterator[str]:
+        """Pass the answer chunks through until the generation is cancelled."""
+        try:
+            for chunk in chunks:
+                if self.cancelled:
+                    # The task_id may only be known now
+                    self.cancel()
+                    return
+                yield chunk
+        except Exception:
+            # Reading from the response closed by cancel() fails
+            if not self.cancelled:
+                raise
+
+    async def until_cancelled_async(
+        self, chunks: AsyncIterator[str]
+    ) -> AsyncIterator[str]:
+        try:
+            async for chunk in chunks:
+                if self.cancelled:
+                    self.cancel()
+                    return
+                yield chunk
+        except Exception:
+            if not self.cancelled:
+                raise
+
+
+class GenerationRegistry:
+    """
+    In-flight generations keyed by (channel, source message ts), so that
+    deleting or editing the source message, or a newer message of the same
+    user in the same thread, cancels the answer being generated.
+    """
+
+    def __init__(
+        self,
+        first_byte_timeout: float = DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS,
+        idle_timeout: float = DIFY_STREAM_IDLE_TIMEOUT_SECONDS,
+    ):
+        self._generations: dict[tuple[str, str], Generation] = {}
+        self._lock = threading.Lock()
+        self.first_byte_timeout = first_byte_timeout
+        self.idle_timeout = idle_timeout
+        self.timeouts_total: Counter = Counter()
+        self._watchdog: Optional[threading.Thread] = None
+        self._async_watchdog: Optional[asyncio.Task] = None
+
+    @contextmanager
+    def track(
+        self,
+        channel: str,
+        thread_ts: str,
+        source_ts: str,
+        stop_task: Callable[[str], object],
+        run: Callable[[Callable[[], None]], object] = _call,
+        on_cancel: Optional[Callable[[], object]] = None,
+        user: Optional[str] = None,
+        merged_ts: Iterable[str] = (),
+    ):
+        """
+        Register the generation answering `source_ts`, superseding the ones
+        still answering earlier messages of `user` in the thread. The answers
+        to the other users of a shared thread go on.
+
+        :param run: Runs the cancellation of the superseded generations, e.g.
+            an executor's submit so that the caller doesn't wait for it
+        :param on_cancel: See Generation
+        :param merged_ts: The ts of the other messages answered together with
+            `source_ts`; the generation is registered under each of them
+        """
+        generation = Generation(
+            channel, thread_ts, source_ts, stop_task, user=user, on_cancel=on_cancel
+        )
+        keys = [(channel, ts) for ts in dict.fromkeys([source_ts, *merged_ts])]
+        with self._lock:
+            superseded = [
+                g
+                for g in self._unique_generations()
+                if g.channel == channel and g.thread_ts == thread_ts and g.user == user
+            ]
+            for key in keys:
+                self._generations[key] = generation
+        for g in superseded:
+            g.cancel(run)
+
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                for key in keys:
+                    if self._generations.get(key) is generation:
+                        del self._generations[key]
+
+    def _unique_generations(self) -> list[Generation]:
+        # A generation answering merged messages is registered under each ts
+        return list({id(g): g for g in self._generations.values()}.values())
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._generations
+
+    def cancel(self, channel: str, source_ts: str) -> bool:
+        with self._lock:
+            generation = self._generations.get((channel, source_ts))
+        if generation is None:
+            return False
+        generation.cancel()
+        return True
+
+    # ----------------------------
+    # Stream timeouts
+    # ----------------------------
+
+    def time_out(
+        self,
+        generation: Generation,
+        kind: Optional[str] = None,
+        run: Callable[[Callable[[], None]], object] = _call,
+    ) -> None:
+        """
+        Time out the generation, e.g. when a read of its stream timed out.
+
+        :param kind: "first_byte" or "idle"; by default, from the events read
+        """
+        if kind is None:
+            kind = "first_byte" if generation.result.first_event_at is None else "idle"
+        logger.warning(
+            f"The Dify stream for {generation.channel}/{generation.source_ts} "
+            f"timed out ({kind})"
+        )
+        self.timeouts_total[kind] += 1
+        metrics.count(f"dify.stream_timeout.{kind}")
+        generation.time_out(run)
+
+    def expire_stalled(
+        self, run: Callable[[Callable[[], None]], object] = _call
+    ) -> list[Generation]:
+        """Time out the generations whose stream stalled."""
+        with self._lock:
+            generations = self._unique_generations()
+        now = time.perf_counter()
+        expired = []
+        for generation in generations:
+            kind = generation.stalled(now, self.first_byte_timeout, self.idle_timeout)
+            if kind is not None:
+                self.time_out(generation, kind, run)
+                expired.append(generation)
+        return expired
+
+    def _watch(self, interval: float, run: Callable) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.expire_stalled(run)
+            except Exception as e:
+                logger.exception(f"Failed to check the Dify streams: {e}")
+
+    def start_watchdog(
+        self,
+        run: Callable[[Callable[[], None]], object] = _call,
+        interval: float = 1.0,
+    ) -> None:
+        """
+        Check the streams from a daemon thread (sync listeners).
+
+        :param run: Runs the Dify stop calls of the timed out generations,
+            e.g. an executor's submit, so that they don't hold up the checks
+        """
+        with self._lock:
+            if self._watchdog is not None:
+                return
+            self._watchdog = threading.Thread(
+                target=self._watch, args=(interval, run), daemon=True
+            )
+        self._watchdog.start()
+
+    async def _watch_async(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.expire_stalled()
+            except Exception as e:
+                logger.exception(f"Failed to check the Dify streams: {e}")
+
+    def start_async_watchdog(self, interval: float = 1.0) -> None:
+        """
+        Check the streams from a task of the running event loop (asyncio
+        listeners), since aiohttp responses must be closed on their loop.
+        """
+        if self._async_watchdog is None or self._async_watchdog.done():
+            self._async_watchdog = asyncio.get_running_loop().create_task(
+                self._watch_async(interval)
+            )
+
+    def metrics(self) -> dict:
+        with self._lock:
+            in_flight = len(self._unique_generations())
+        return {
+            "in_flight": in_flight,
+            "first_byte_timeouts_total": self.timeouts_total["first_byte"],
+            "idle_timeouts_total": self.timeouts_total["idle"],
+        }
+
+
+def find_cancelled_source(payload: dict) -> Optional[tuple[str, str]]:
+    """
+    :return: The (channel, ts) of the message deleted or edited by the
+        message_deleted / message_changed event, if any
+    """
+    subtype = payload.get("subtype")
+    if subtype == "message_deleted":
+        return payload.get("channel"), payload.get("deleted_ts")
+    if subtype == "message_changed":
+        message = payload.get("message", {})
+        previous_message = payload.get("previous_message", {})
+        # Unfurls and the app's own updates also trigger message_changed
+        if "edited" in message and message.get("text") != previous_message.get("text"):
+            return payload.get("channel"), message.get("ts")
+    return None
+
+
+generation_registry = GenerationRegistry()
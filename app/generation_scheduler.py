@@ -0,0 +1,344 @@
+import asyncio
+import bisect
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from app.env import (
+    GENERATION_MAX_PER_CHANNEL,
+    GENERATION_MAX_PER_USER,
+    GENERATION_MAX_WORKERS,
+    GENERATION_QUEUE_MAX_SIZE,
+    GENERATION_QUEUE_POSITION_INTERVAL_SECONDS,
+)
+from app.metrics import metrics
+
+
+class QueueFullError(Exception):
+    """Raised when a generation can't even be queued."""
+
+
+class CancelledInQueueError(Exception):
+    """Raised when a generation is cancelled while it waits for a slot."""
+
+
+@dataclass
+class _Waiter:
+    channel: str
+    user: str
+    priority: bool
+    seq: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def order(self) -> tuple[int, int]:
+        # Priority (DM) requests first, then first come, first served
+        return (0 if self.priority else 1, self.seq)
+
+
+class _SchedulerState:
+    """
+    Admission bookkeeping shared by the thread and the asyncio schedulers.
+
+    A queued generation starts once a global slot is free and its channel and
+    user are below their caps. Waiters blocked only by their own channel or
+    user cap don't hold back the ones behind them.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_per_channel: int,
+        max_per_user: int,
+        max_queue: int,
+        position_interval: float = 0.0,
+    ):
+        self.max_workers = max_workers
+        self.max_per_channel = max_per_channel
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.position_interval = position_interval
+        self.running = 0
+        self._running_per_channel: dict[str, int] = {}
+        self._running_per_user: dict[str, int] = {}
+        self._queue: list[_Waiter] = []
+        self._seq = itertools.count()
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _can_run(self, channel: str, user: str) -> bool:
+        return (
+            self.running < self.max_workers
+            and self._running_per_channel.get(channel, 0) < self.max_per_channel
+            and self._running_per_user.get(user, 0) < self.max_per_user
+        )
+
+    def _enqueue(self, channel: str, user: str, priority: bool) -> _Waiter:
+        if len(self._queue) >= self.max_queue:
+            self.rejected_total += 1
+            raise QueueFullError(f"{len(self._queue)} generations are already queued")
+        waiter = _Waiter(channel, user, priority, next(self._seq))
+        bisect.insort(self._queue, waiter, key=lambda w: w.order)
+        return waiter
+
+    def _is_next(self, waiter: _Waiter) -> bool:
+        for queued in self._queue:
+            if self._can_run(queued.channel, queued.user):
+                return queued is waiter
+        return False
+
+    def _position(self, waiter: _Waiter) -> int:
+        return self._queue.index(waiter) + 1
+
+    def _leave_if_cancelled(
+        self, waiter: _Waiter, cancelled: Optional[Callable[[], bool]]
+    ) -> bool:
+        if cancelled is not None and cancelled():
+            self._queue.remove(waiter)
+            return True
+        return False
+
+    def _report_delay(
+        self, position: int, last_position: Optional[int], last_report: float
+    ) -> Optional[float]:
+        """
+        :return: 0 if the position should be reported now, the seconds until
+            it may be reported, or None if it didn't change
+        """
+        if position == last_position:
+            return None
+        if last_position is None:
+            return 0
+        return max(0.0, last_report + self.position_interval - time.monotonic())
+
+    def _admit(self, channel: str, user: str, waiter: Optional[_Waiter]) -> None:
+        if waiter is not None:
+            self._queue.remove(waiter)
+            waited = time.monotonic() - waiter.enqueued_at
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            metrics.observe("generation.queue_wait", waited)
+        self.admitted_total += 1
+        self.running += 1
+        self._running_per_channel[channel] = (
+            self._running_per_channel.get(channel, 0) + 1
+        )
+        self._running_per_user[user] = self._running_per_user.get(user, 0) + 1
+
+    def _release(self, channel: str, user: str) -> None:
+        self.running -= 1
+        for counts, key in (
+            (self._running_per_channel, channel),
+            (self._running_per_user, user),
+        ):
+            counts[key] -= 1
+            if counts[key] == 0:
+                del counts[key]
+
+    def _try_admit_now(self, channel: str, user: str) -> bool:
+        if not self._queue and self._can_run(channel, user):
+            self._admit(channel, user, None)
+            return True
+        return False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def metrics(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "wait_seconds_total": self.wait_seconds_total,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+class GenerationScheduler(_SchedulerState):
+    """Bounds the concurrent Dify generations of the thread-based listeners."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(
+        self,
+        channel: str,
+        user: str,
+        *,
+        priority: bool = False,
+        on_queued: Optional[Callable[[int], None]] = None,
+        cancelled: Optional[Callable[[], bool]] = None,
+    ):
+        """
+        Hold a generation slot, waiting in the queue when none is available.
+
+        :param on_queued: Called with the 1-based queue position when queued,
+            then when it changes, at most every `position_interval` seconds
+        :param cancelled: Checked while waiting; call wake() when it turns True
+        :raises QueueFullError: When the queue is already full
+        :raises CancelledInQueueError: When cancelled while waiting
+        """
+        self._acquire(channel, user, priority, on_queued, cancelled)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._release(channel, user)
+                self._cond.notify_all()
+
+    def wake(self) -> None:
+        """Make the waiters check whether they were cancelled."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _acquire(self, channel, user, priority, on_queued, cancelled) -> None:
+        with self._cond:
+            if self._try_admit_now(channel, user):
+                return
+            waiter = self._enqueue(channel, user, priority)
+
+        last_position = None
+        last_report = 0.0
+        while True:
+            with self._cond:
+                while True:
+                    if self._leave_if_cancelled(waiter, cancelled):
+                        # The waiters behind it may be next now
+                        self._cond.notify_all()
+                        raise CancelledInQueueError()
+                    if self._is_next(waiter):
+                        self._admit(channel, user, waiter)
+                        # Another slot may be free for the next waiter
+                        self._cond.notify_all()
+                        return
+                    position = self._position(waiter)
+                    delay = self._report_delay(position, last_position, last_report)
+                    if delay == 0:
+                        break
+                    self._cond.wait(delay)
+            # Report outside of the lock; it usually calls the Slack API
+            last_position = position
+            last_report = time.monotonic()
+            if on_queued is not None:
+                try:
+                    on_queued(position)
+                except Exception:
+                    with self._cond:
+                        self._queue.remove(waiter)
+                        self._cond.notify_all()
+                    raise
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return super().metrics()
+
+
+class AsyncGenerationScheduler(_SchedulerState):
+    """asyncio version of GenerationScheduler for app.async_bolt_listeners."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Created lazily so that it is bound to the running event loop
+        self._cond: Optional[asyncio.Condition] = None
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        channel: str,
+        user: str,
+        *,
+        priority: bool = False,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+        cancelled: Optional[Callable[[], bool]] = None,
+    ):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        await self._acquire(channel, user, priority, on_queued, cancelled)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._release(channel, user)
+                self._cond.notify_all()
+
+    def wake(self) -> None:
+        """Make the waiters check whether they were cancelled (on the loop)."""
+        if self._cond is not None:
+            asyncio.get_running_loop().create_task(self._notify_all())
+
+    async def _notify_all(self) -> None:
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def _acquire(self, channel, user, priority, on_queued, cancelled) -> None:
+        if self._try_admit_now(channel, user):
+            return
+        waiter = self._enqueue(channel, user, priority)
+
+        last_position = None
+        last_report = 0.0
+        try:
+            while True:
+                async with self._cond:
+                    while True:
+                        if self._leave_if_cancelled(waiter, cancelled):
+                            self._cond.notify_all()
+                            raise CancelledInQueueError()
+                        if self._is_next(waiter):
+                            self._admit(channel, user, waiter)
+                            self._cond.notify_all()
+                            return
+                        position = self._position(waiter)
+                        delay = self._report_delay(position, last_position, last_report)
+                        if delay == 0:
+                            break
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), delay)
+                        except TimeoutError:
+                            pass
+                last_position = position
+                last_report = time.monotonic()
+                if on_queued is not None:
+                    await on_queued(position)
+        except BaseException:
+            # Failed callback or cancelled task: leave the queue
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+                async with self._cond:
+                    self._cond.notify_all()
+            raise
+
+
+def _scheduler_args() -> dict:
+    return dict(
+        max_workers=GENERATION_MAX_WORKERS,
+        max_per_channel=GENERATION_MAX_PER_CHANNEL,
+        max_per_user=GENERATION_MAX_PER_USER,
+        max_queue=GENERATION_QUEUE_MAX_SIZE,
+        position_interval=GENERATION_QUEUE_POSITION_INTERVAL_SECONDS,
+    )
+
+
+generation_scheduler = GenerationScheduler(**_scheduler_args())
+async_generation_scheduler = AsyncGenerationScheduler(**_scheduler_args())
+
+# Only one of the schedulers is used in a process
+metrics.register_gauge(
+    "dify_slack_generations_running",
+    "Dify generations holding a slot",
+    lambda: generation_scheduler.running + async_generation_scheduler.running,
+)
+metrics.register_gauge(
+    "dify_slack_generation_queue_depth",
+    "Dify generations waiting for a slot",
+    lambda: generation_scheduler.queue_depth + async_generation_scheduler.queue_depth,
+)
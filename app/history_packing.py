@@ -0,0 +1,61 @@
+from typing import Callable, Sequence
+
+# Replaces the messages dropped from the middle of a long thread
+OMITTED_MESSAGES_TEXT = "(... {count} messages omitted ...)"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of the text, without loading any model tokenizer.
+
+    English-like text averages about 4 characters per token, while Japanese
+    and other non-ASCII scripts get close to one token per character. The
+    non-ASCII characters are counted from the UTF-8 size (mostly 3 bytes each).
+    """
+    extra_bytes = len(text.encode()) - len(text)
+    non_ascii = extra_bytes // 2
+    ascii_chars = len(text) - non_ascii
+    return (ascii_chars + 3) // 4 + non_ascii
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # The estimate is roughly linear in the length, so cut proportionally
+    return text[: len(text) * max_tokens // tokens] + "…"
+
+
+def pack_thread_history(
+    messages: Sequence[dict],
+    format_message: Callable[[dict], str],
+    max_tokens: int,
+) -> list[str]:
+    """
+    Format the thread messages into lines fitting in `max_tokens`.
+
+    The root message is always kept (truncated to half of the budget at most)
+    and the remaining budget is filled with the most recent messages. The
+    messages in between are collapsed into a single line. Only the kept
+    messages are formatted. A budget of 0 or less keeps the whole thread.
+    """
+    if max_tokens <= 0 or len(messages) <= 1:
+        return [format_message(message) for message in messages]
+
+    root = truncate_to_tokens(format_message(messages[0]), max_tokens // 2)
+    budget = max_tokens - estimate_tokens(root)
+
+    recent = []
+    for message in reversed(messages[1:]):
+        line = format_message(message)
+        tokens = estimate_tokens(line)
+        if tokens > budget:
+            break
+        recent.append(line)
+        budget -= tokens
+    recent.reverse()
+
+    omitted = len(messages) - 1 - len(recent)
+    if omitted > 0:
+        return [root, OMITTED_MESSAGES_TEXT.format(count=omitted), *recent]
+    return [root, *recent]
@@ -0,0 +1,64 @@
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.env import (
+    DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS,
+    DIFY_STREAM_IDLE_TIMEOUT_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_READ_TIMEOUT_SECONDS,
+)
+
+DEFAULT_TIMEOUT = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS)
+# The read timeout applies to every recv, so for a stream it is the longest
+# wait for the response headers or for the next chunk
+STREAM_TIMEOUT = (
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    max(DIFY_STREAM_FIRST_BYTE_TIMEOUT_SECONDS, DIFY_STREAM_IDLE_TIMEOUT_SECONDS),
+)
+
+# Keep-alive sessions are shared per host so that warm Lambda containers and
+# Socket Mode workers reuse TCP / TLS connections across events
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def abort_response(response) -> None:
+    """
+    Make a read blocked on the streaming response fail right away.
+
+    Closing a requests response from another thread waits for the blocked
+    read, so its socket is shut down instead; the reader closes the response.
+    Other responses (aiohttp) are closed.
+    """
+    connection = getattr(getattr(response, "raw", None), "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        response.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # Already closed
+        pass
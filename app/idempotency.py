@@ -0,0 +1,71 @@
+import logging
+from typing import Optional
+
+from app.cache import AddIfAbsentBackend, DynamoDBBackend, SQLiteBackend, TTLCache
+from app.env import (
+    IDEMPOTENCY_CACHE_MAX_SIZE,
+    IDEMPOTENCY_DYNAMODB_TABLE,
+    IDEMPOTENCY_SQLITE_PATH,
+    IDEMPOTENCY_TTL_SECONDS,
+)
+
+
+class IdempotencyStore:
+    """
+    Records the Slack events already accepted, so that retried deliveries
+    (X-Slack-Retry-Num) and duplicated events are dropped.
+
+    The in-process set answers retries reaching the same process; the optional
+    shared backend catches the ones delivered to another process or Lambda
+    container.
+    """
+
+    def __init__(
+        self,
+        cache: TTLCache,
+        backend: Optional[AddIfAbsentBackend] = None,
+    ):
+        self.cache = cache
+        self.backend = backend
+
+    def claim(self, key: str, logger: Optional[logging.Logger] = None) -> bool:
+        """
+        :return: True if the key is seen for the first time
+        """
+        if not self.cache.add(key, True):
+            return False
+        if self.backend is None:
+            return True
+        try:
+            return self.backend.add(key, "1", self.cache.ttl)
+        except Exception as e:
+            # Answering twice is better than not answering at all
+            if logger is not None:
+                logger.warning(f"Failed to record the event {key}: {e}")
+            return True
+
+
+def get_event_idempotency_key(body: dict) -> Optional[str]:
+    event_id = body.get("event_id")
+    if event_id:
+        return event_id
+    # app_mention and message share the client_msg_id, so keep them apart
+    event = body.get("event", {})
+    client_msg_id = event.get("client_msg_id")
+    if client_msg_id:
+        return f"{event.get('type')}:{client_msg_id}"
+    return None
+
+
+def _build_backend() -> Optional[AddIfAbsentBackend]:
+    if IDEMPOTENCY_DYNAMODB_TABLE:
+        return DynamoDBBackend(IDEMPOTENCY_DYNAMODB_TABLE)
+    if IDEMPOTENCY_SQLITE_PATH:
+        return SQLiteBackend(IDEMPOTENCY_SQLITE_PATH, table="slack_events")
+    return None
+
+
+idempotency_store = IdempotencyStore(
+    cache=TTLCache(IDEMPOTENCY_CACHE_MAX_SIZE, IDEMPOTENCY_TTL_SECONDS),
+    backend=_build_backend(),
+)
@@ -0,0 +1,78 @@
+from io import BytesIO
+
+from app.env import (
+    IMAGE_MAX_DIMENSION,
+    IMAGE_OUTPUT_FORMAT,
+    IMAGE_OUTPUT_QUALITY,
+    IMAGE_PREPROCESSING_ENABLED,
+)
+
+# Pillow is an optional dependency (`image` extra); without it images are
+# forwarded to Dify as they are
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+    ImageOps = None
+
+
+def can_preprocess_images() -> bool:
+    return IMAGE_PREPROCESSING_ENABLED and Image is not None
+
+
+def preprocess_image(
+    content: bytes,
+    file_name: str,
+    mime_type: str,
+    *,
+    max_dimension: int = IMAGE_MAX_DIMENSION,
+    output_format: str = IMAGE_OUTPUT_FORMAT,
+    quality: int = IMAGE_OUTPUT_QUALITY,
+) -> tuple[bytes, str, str]:
+    """
+    Downscale the image to fit in `max_dimension` pixels, recompress it and drop
+    its metadata (EXIF, ICC profile, comments) before it is uploaded to Dify.
+
+    The original is kept when it can't be decoded, is animated, or when the
+    recompressed image wouldn't be any smaller.
+
+    :return: The (content, file_name, mime_type) to upload
+    """
+    if not can_preprocess_images():
+        return content, file_name, mime_type
+
+    try:
+        with Image.open(BytesIO(content)) as image:
+            if getattr(image, "is_animated", False):
+                return content, file_name, mime_type
+
+            # Apply the EXIF orientation before the metadata is discarded
+            image = ImageOps.exif_transpose(image)
+            resized = max(image.size) > max_dimension
+            if resized:
+                image.thumbnail(
+                    (max_dimension, max_dimension), Image.Resampling.LANCZOS
+                )
+
+            if output_format == "JPEG" and image.mode != "RGB":
+                # JPEG has no alpha channel; flatten transparency onto white
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, "white")
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif output_format == "WEBP" and image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+            output = BytesIO()
+            image.save(output, format=output_format, quality=quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Not an image Pillow can handle (or too large to decode safely); let
+        # Dify decide what to do with it
+        return content, file_name, mime_type
+
+    processed = output.getvalue()
+    if not resized and len(processed) >= len(content):
+        return content, file_name, mime_type
+
+    extension = "jpg" if output_format == "JPEG" else output_format.lower()
+    base_name = file_name.rsplit(".", 1)[0] if "." in file_name else file_name
+    return processed, f"{base_name}.{extension}", f"image/{output_format.lower()}"
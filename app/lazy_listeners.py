@@ -0,0 +1,135 @@
+import logging
+import sys
+from typing import Optional
+
+from slack_bolt import Ack, BoltContext, BoltRequest, BoltResponse
+from slack_bolt.request.payload_utils import is_event
+from slack_sdk import WebClient
+
+from app.env import IDEMPOTENCY_ENABLED
+from app.idempotency import get_event_idempotency_key, idempotency_store
+
+# Listeners registered by index.py. Everything on the ack path of a request
+# is defined here and only needs slack_bolt and the idempotency store; the
+# generation path in app.bolt_listeners (dify_client, requests, Pillow, ...)
+# is imported by the first lazy listener run in the process, which on Lambda
+# is a separate invocation made after Slack got its response.
+
+
+def just_ack(ack: Ack):
+    ack()
+
+
+def respond_to_app_mention(
+    context: BoltContext,
+    payload: dict,
+    client: WebClient,
+    logger: logging.Logger,
+):
+    # Bolt finds the lazy listener to run by its name, hence the same one
+    from app import bolt_listeners
+
+    bolt_listeners.respond_to_app_mention(context, payload, client, logger)
+
+
+def respond_to_new_message(
+    context: BoltContext,
+    payload: dict,
+    client: WebClient,
+    logger: logging.Logger,
+):
+    from app import bolt_listeners
+
+    bolt_listeners.respond_to_new_message(context, payload, client, logger)
+
+
+def register_listeners(app):
+    app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
+    app.event("message")(ack=just_ack, lazy=[respond_to_new_message])
+
+
+MESSAGE_SUBTYPES_TO_SKIP = ["message_changed", "message_deleted"]
+
+
+def find_edited_root(payload: dict) -> Optional[tuple[str, str]]:
+    """
+    :return: The (channel, ts) of the thread root edited by this
+        message_changed event, if any; an edit may add or remove a mention
+    """
+    if payload.get("subtype") != "message_changed":
+        return None
+    message = payload.get("message", {})
+    if message.get("thread_ts") not in (None, message.get("ts")):
+        return None
+    return payload.get("channel"), message.get("ts")
+
+
+def find_changed_reply(
+    payload: dict,
+) -> Optional[tuple[str, str, str, Optional[dict]]]:
+    """
+    :return: The (channel, thread_ts, ts, new message) of the thread reply
+        edited or deleted (new message None) by this event, if any
+    """
+    subtype = payload.get("subtype")
+    if subtype == "message_changed":
+        message = payload.get("message", {})
+        new_message = message
+    elif subtype == "message_deleted":
+        message = payload.get("previous_message", {})
+        new_message = None
+    else:
+        return None
+    thread_ts = message.get("thread_ts")
+    if thread_ts in (None, message.get("ts")):
+        return None
+    return payload.get("channel"), thread_ts, message.get("ts"), new_message
+
+
+# To reduce unnecessary workload in this app,
+# this before_authorize function skips message changed/deleted events,
+# after cancelling the generation answering the changed/deleted message.
+# Especially, "message_changed" events can be triggered many times when the app rapidly updates its reply.
+# It also drops Slack's retried deliveries and duplicated events before any Slack / Dify API call.
+def before_authorize(
+    body: dict,
+    payload: dict,
+    request: BoltRequest,
+    logger: logging.Logger,
+    next_,
+):
+    if (
+        is_event(body)
+        and payload.get("type") == "message"
+        and payload.get("subtype") in MESSAGE_SUBTYPES_TO_SKIP
+    ):
+        logger.debug(
+            "Skipped the following middleware and listeners "
+            f"for this message event (subtype: {payload.get('subtype')})"
+        )
+        # Nothing can be in flight or cached in a process that never ran a
+        # generation
+        bolt_listeners = sys.modules.get("app.bolt_listeners")
+        if bolt_listeners is not None:
+            bolt_listeners.cancel_generation_for(payload)
+        slack_ops = sys.modules.get("app.slack_ops")
+        edited_root = find_edited_root(payload)
+        if slack_ops is not None and edited_root is not None:
+            slack_ops.forget_thread_root(*edited_root)
+        # Also the app's own replies: the cached copy may still be a WIP text
+        changed_reply = find_changed_reply(payload)
+        if slack_ops is not None and changed_reply is not None:
+            slack_ops.update_thread_reply(*changed_reply)
+        return BoltResponse(status=200, body="")
+
+    # On Lambda, the lazy listeners are run by re-invoking the function with
+    # the same (already claimed) event
+    if IDEMPOTENCY_ENABLED and is_event(body) and not request.lazy_only:
+        key = get_event_idempotency_key(body)
+        if key is not None and not idempotency_store.claim(key, logger):
+            logger.debug(
+                f"Skipped a duplicated delivery of the event {key} "
+                f"(retry: {request.headers.get('x-slack-retry-num')})"
+            )
+            return BoltResponse(status=200, body="")
+    next_()
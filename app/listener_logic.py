@@ -0,0 +1,206 @@
+import logging
+import re
+from typing import Iterable, Iterator, Optional
+
+from slack_bolt import BoltContext
+
+from app.answer_cache import answer_cache
+from app.cache import TTLCache
+from app.env import (
+    IMAGE_MAX_BYTES,
+    THREAD_HISTORY_MAX_TOKENS,
+    UPLOAD_CACHE_MAX_SIZE,
+    UPLOAD_CACHE_TTL_SECONDS,
+)
+from app.generation_registry import Generation, generation_registry
+from app.history_packing import pack_thread_history
+from app.markdown_conversion import slack_to_markdown
+from app.metrics import metrics
+from app.resilience import (
+    CONNECTION_ERRORS,
+    DifyUnavailableError,
+    dify_circuit_breaker,
+)
+from app.slack_ops import (
+    CANCELLED_TEXT,
+    ERROR_TEXT,
+    TIMEOUT_TEXT,
+    UNAVAILABLE_TEXT,
+    is_status_text,
+    remember_thread_root,
+)
+
+# The decisions of the listeners, shared by app.bolt_listeners and
+# app.async_bolt_listeners. Nothing here does any network I/O; the listeners
+# only add the Slack / Dify calls, blocking or awaited.
+
+
+# (API key, Slack file id or content digest) -> Dify upload_file_id
+uploaded_file_ids = TTLCache(UPLOAD_CACHE_MAX_SIZE, UPLOAD_CACHE_TTL_SECONDS)
+
+
+def get_user_message(payload: dict, bot_user_id: str) -> str:
+    return re.sub(f"<@{bot_user_id}>\\s*", "", payload["text"])
+
+
+def format_thread_message(msg: dict, bot_users: dict) -> str:
+    author = msg.get("user") or bot_users.get(msg.get("bot_id")) or msg["username"]
+    return f"<@{author}>: {slack_to_markdown(msg['text'])}"
+
+
+def error_reply_text(logger: logging.Logger, user_id: str, error: Exception) -> str:
+    if isinstance(error, DifyUnavailableError):
+        logger.warning(f"Failed to respond to app mention: {error}")
+        return f"<@{user_id}>\n{UNAVAILABLE_TEXT}"
+    logger.error(f"Failed to respond to app mention: {error}")
+    return f"<@{user_id}>\n{ERROR_TEXT}"
+
+
+# ----------------------------
+# Which messages to answer
+# ----------------------------
+
+
+def is_from_other_bot(payload: dict, bot_id: str) -> bool:
+    return bool(payload.get("bot_id")) and payload.get("bot_id") != bot_id
+
+
+def should_answer_root_message(context: BoltContext, payload: dict) -> bool:
+    """
+    Every new root message is indexed so that replies in threads not owned by
+    this app are skipped without any Slack API call.
+
+    :return: True if the root message itself is answered (DMs with the app)
+    """
+    remember_thread_root(context, context.channel_id, payload)
+    return payload.get("channel_type") == "im"
+
+
+def find_cached_answer(context: BoltContext, query: str, files: list) -> Optional[str]:
+    # Only thread roots without files are answered from the cache
+    if files:
+        return None
+    return answer_cache.get(context["DIFY_APP_API_KEY"], query)
+
+
+def cache_answer(
+    context: BoltContext, query: str, files: list, answer: Optional[str]
+) -> None:
+    if not files and answer:
+        answer_cache.set(context["DIFY_APP_API_KEY"], query, answer)
+
+
+# ----------------------------
+# What to send to Dify
+# ----------------------------
+
+
+def select_history_messages(messages: list, before_ts: str) -> list:
+    return [
+        msg
+        for msg in messages
+        # Leftover WIP placeholders and status replies carry no information
+        if not is_status_text(msg.get("text", ""))
+        and float(msg.get("ts", 0)) < float(before_ts)
+    ]
+
+
+def history_bot_ids(messages: list) -> Iterator[str]:
+    return (msg.get("bot_id") for msg in messages if "user" not in msg)
+
+
+def build_history_query(messages: list, bot_users: dict, user_message: str) -> str:
+    """
+    Prefix the message with the thread history, packed into
+    THREAD_HISTORY_MAX_TOKENS, for the first message of a thread sent to Dify.
+    """
+    messages_fmt = "\n".join(
+        pack_thread_history(
+            messages,
+            lambda msg: format_thread_message(msg, bot_users),
+            THREAD_HISTORY_MAX_TOKENS,
+        )
+    )
+    return f"{messages_fmt}\n{user_message}" if messages_fmt else user_message
+
+
+def build_chat_kwargs(
+    user_id: str,
+    query: str,
+    dify_user: str,
+    conversation_id: Optional[str] = None,
+    files: Optional[list] = None,
+) -> dict:
+    return dict(
+        inputs={"slack_user_id": user_id},
+        query=query,
+        conversation_id=conversation_id,
+        user=dify_user,
+        files=files,
+    )
+
+
+def select_images(files: Iterable[dict], logger: logging.Logger) -> list:
+    images = []
+    for file in files:
+        if not file.get("mimetype", "").startswith("image/"):
+            continue
+        if file.get("size", 0) > IMAGE_MAX_BYTES:
+            logger.warning(
+                f"Skipped the image {file.get('id')} larger than {IMAGE_MAX_BYTES} bytes"
+            )
+            continue
+        images.append(file)
+    return images
+
+
+def dify_image_file(upload_file_id: str) -> dict:
+    return {
+        "type": "image",
+        "transfer_method": "local_file",
+        "upload_file_id": upload_file_id,
+    }
+
+
+# ----------------------------
+# Generation outcomes
+# ----------------------------
+
+
+def record_generation_error(
+    generation: Generation,
+    error: Exception,
+    is_read_timeout: bool,
+    connection_errors: tuple[type[BaseException], ...] = CONNECTION_ERRORS,
+) -> bool:
+    """
+    A read timeout of the stream times the generation out; any other error is
+    recorded by the circuit breaker.
+
+    :return: True if the error was handled, False if it should be raised
+    """
+    if not is_read_timeout:
+        dify_circuit_breaker.record(error, connection_errors)
+        return False
+    generation_registry.time_out(generation)
+    return True
+
+
+def record_generation_outcome(generation: Generation, started_at: float) -> None:
+    if generation.timed_out:
+        dify_circuit_breaker.record_failure()
+        return
+    dify_circuit_breaker.record_success()
+    metrics.record_generation(generation.result, started_at)
+
+
+def generation_outcome_text(generation: Generation) -> Optional[str]:
+    """
+    :return: The text replacing the WIP reply when the generation gave no
+        answer, otherwise None
+    """
+    if generation.timed_out:
+        return TIMEOUT_TEXT
+    if generation.cancelled:
+        return CANCELLED_TEXT
+    return None
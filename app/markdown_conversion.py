@@ -1,59 +1,197 @@
+import itertools
 import re
+from typing import Optional
+
+# Code blocks and inline code are kept as they are by both conversions
+CODE_PATTERN = re.compile(r"(?s)(```.+?```|`[^`\n]+?`)")
+
+# Slack mrkdwn -> markdown, with the marker character each rule needs
+SLACK_TO_MARKDOWN_RULES = [
+    ("*", re.compile(r"\*(?!\s)([^\*\n]+?)(?<!\s)\*"), r"**\1**"),  # *bold* to **bold**
+    ("_", re.compile(r"_(?!\s)([^_\n]+?)(?<!\s)_"), r"*\1*"),  # _italic_ to *italic*
+    (
+        "~",
+        re.compile(r"~(?!\s)([^~\n]+?)(?<!\s)~"),
+        r"~~\1~~",
+    ),  # ~strike~ to ~~strike~~
+]
+
+# markdown -> Slack mrkdwn
+CODE_BLOCK_LANGUAGE_PATTERN = re.compile(r"```[a-zA-Z0-9]+\n")
+HEADING_PATTERN = re.compile(r"^(#{1,6}) (.+)", flags=re.MULTILINE)
+MARKDOWN_TO_SLACK_RULES = [
+    (
+        re.compile(r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*"),
+        r"_*\1*_",
+    ),  # ***bold italic*** to *_bold italic_*
+    (
+        re.compile(r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])"),
+        r"_\1_",
+    ),  # *italic* to _italic_
+    (re.compile(r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*"), r"*\1*"),  # **bold** to *bold*
+    (re.compile(r"__(?!\s)([^_\n]+?)(?<!\s)__"), r"*\1*"),  # __bold__ to *bold*
+    (re.compile(r"~~(?!\s)([^~\n]+?)(?<!\s)~~"), r"~\1~"),  # ~~strike~~ to ~strike~
+]
+
+
+# Joins the text parts so that every rule runs once over the whole message.
+# All rules work within a line, so they never match across this separator.
+PART_SEPARATOR = "\n\x00\n"
+
+
+def _convert_text(content: str, convert_part) -> str:
+    # re.split puts the captured code parts at the odd indexes; like those,
+    # text parts starting with a stray backtick are kept as they are
+    parts = CODE_PATTERN.split(content)
+    if len(parts) == 1:
+        return content if content.startswith("`") else convert_part(content)
+
+    indexes = [i for i in range(0, len(parts), 2) if not parts[i].startswith("`")]
+
+    if "\x00" in content:
+        for i in indexes:
+            parts[i] = convert_part(parts[i])
+    else:
+        converted = convert_part(PART_SEPARATOR.join(parts[i] for i in indexes))
+        for i, part in zip(indexes, converted.split(PART_SEPARATOR)):
+            parts[i] = part
+    return "".join(parts)
+
+
+def _slack_part_to_markdown(part: str) -> str:
+    for marker, pattern, replacement in SLACK_TO_MARKDOWN_RULES:
+        if marker in part:
+            part = pattern.sub(replacement, part)
+    return part
+
+
+def _markdown_part_to_slack(part: str) -> str:
+    # Convert any heading level to bold
+    if "#" in part:
+        part = HEADING_PATTERN.sub(r"**\2**", part)
+    if "*" in part or "_" in part or "~" in part:
+        for pattern, replacement in MARKDOWN_TO_SLACK_RULES:
+            part = pattern.sub(replacement, part)
+    return part
 
 
 # Conversion from Slack mrkdwn to OpenAI markdown
 # See also: https://api.slack.com/reference/surfaces/formatting#basics
 def slack_to_markdown(content: str) -> str:
-    # Split the input string into parts based on code blocks and inline code
-    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
-
     # Apply the bold, italic, and strikethrough formatting to text not within code
-    result = ""
-    for part in parts:
-        if part.startswith("```") or part.startswith("`"):
-            result += part
-        else:
-            for o, n in [
-                (r"\*(?!\s)([^\*\n]+?)(?<!\s)\*", r"**\1**"),  # *bold* to **bold**
-                (r"_(?!\s)([^_\n]+?)(?<!\s)_", r"*\1*"),  # _italic_ to *italic*
-                (r"~(?!\s)([^~\n]+?)(?<!\s)~", r"~~\1~~"),  # ~strike~ to ~~strike~~
-            ]:
-                part = re.sub(o, n, part)
-            result += part
-    return result
+    return _convert_text(content, _slack_part_to_markdown)
 
 
 # Conversion from OpenAI markdown to Slack mrkdwn
 # See also: https://api.slack.com/reference/surfaces/formatting#basics
 def markdown_to_slack(content: str) -> str:
     # Replace ```language with ``` and keep the code block intact
-    content = re.sub(r"```[a-zA-Z0-9]+\n", "```\n", content)
-
-    # Split the input string into parts based on code blocks and inline code
-    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    if "```" in content:
+        content = CODE_BLOCK_LANGUAGE_PATTERN.sub("```\n", content)
 
     # Apply the bold, italic, strikethrough, and heading formatting to text not within code
-    result = ""
-    for part in parts:
-        if part.startswith("```") or part.startswith("`"):
-            result += part
-        else:
-            # Convert any heading level to bold
-            part = re.sub(r"^(#{1,6}) (.+)", r"**\2**", part, flags=re.MULTILINE)
-
-            for o, n in [
-                (
-                    r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*",
-                    r"_*\1*_",
-                ),  # ***bold italic*** to *_bold italic_*
-                (
-                    r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])",
-                    r"_\1_",
-                ),  # *italic* to _italic_
-                (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),  # **bold** to *bold*
-                (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),  # __bold__ to *bold*
-                (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),  # ~~strike~~ to ~strike~
-            ]:
-                part = re.sub(o, n, part)
-            result += part
-    return result
+    return _convert_text(content, _markdown_part_to_slack)
+
+
+class MarkdownToSlackStream:
+    """
+    Incremental markdown_to_slack for an answer that arrives in chunks.
+
+    Every conversion rule works within a line, so the answer can be converted
+    line by line as it grows. Only the unterminated tail is held back: the
+    current line, or everything from an unclosed code fence onwards. The
+    concatenated output is the same as markdown_to_slack on the whole answer.
+    """
+
+    def __init__(self):
+        self._stable_parts: list[str] = []
+        self._pending = ""
+        # Whether the text part still open at the end of the stable prefix is
+        # kept as it is, which markdown_to_slack decides at the start of a part
+        self._open_part_raw: Optional[bool] = None
+
+    def feed(self, delta: str) -> str:
+        """
+        Add an answer delta.
+
+        :return: The Slack mrkdwn newly appended to the stable prefix
+        """
+        self._pending += delta
+        cut = _stable_prefix_length(self._pending)
+        if cut == 0:
+            return ""
+
+        stable, self._open_part_raw = _markdown_piece_to_slack(
+            self._pending[:cut], self._open_part_raw
+        )
+        self._pending = self._pending[cut:]
+        self._stable_parts.append(stable)
+        return stable
+
+    def finish(self) -> str:
+        """
+        Flush the held back tail at the end of the answer.
+
+        :return: The Slack mrkdwn of the tail
+        """
+        tail, self._open_part_raw = _markdown_piece_to_slack(
+            self._pending, self._open_part_raw
+        )
+        self._pending = ""
+        self._stable_parts.append(tail)
+        return tail
+
+    @property
+    def text(self) -> str:
+        """The stable prefix followed by a best-effort conversion of the tail."""
+        tail, _ = _markdown_piece_to_slack(self._pending, self._open_part_raw)
+        return "".join(self._stable_parts) + tail
+
+
+def _stable_prefix_length(content: str) -> int:
+    # Cut after a newline outside of code, before any unclosed code fence
+    end = content.rfind("\n") + 1
+    if end == 0 or "```" not in content[:end]:
+        return end
+
+    prefix = CODE_BLOCK_LANGUAGE_PATTERN.sub("```\n", content[:end])
+    cut = 0
+    position = 0
+    for match in itertools.chain(CODE_PATTERN.finditer(prefix), [None]):
+        gap_end = len(prefix) if match is None else match.start()
+        # A fence may end right where an inline code match starts
+        fence = prefix.find("```", position, gap_end + 2)
+        unclosed = 0 <= fence < gap_end
+        newline = prefix.rfind("\n", position, fence if unclosed else gap_end)
+        if newline >= 0:
+            cut = newline + 1
+        if unclosed or match is None:
+            break
+        position = match.end()
+
+    if cut == len(prefix):
+        return end
+
+    # The language replacement keeps the newlines, so map back by line count
+    raw_cut = 0
+    for _ in range(prefix.count("\n", 0, cut)):
+        raw_cut = content.index("\n", raw_cut) + 1
+    return raw_cut
+
+
+def _markdown_piece_to_slack(
+    content: str, open_part_raw: Optional[bool]
+) -> tuple[str, bool]:
+    # Same as markdown_to_slack, except that the first text part may continue
+    # a part opened by the previous piece and then inherits its treatment
+    if "```" in content:
+        content = CODE_BLOCK_LANGUAGE_PATTERN.sub("```\n", content)
+
+    parts = CODE_PATTERN.split(content)
+    part_raw = open_part_raw
+    for i in range(0, len(parts), 2):
+        if i > 0 or part_raw is None:
+            part_raw = parts[i].startswith("`")
+        if not part_raw:
+            parts[i] = _markdown_part_to_slack(parts[i])
+    return "".join(parts), part_raw
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Hashable, Optional
+
+from app.env import MESSAGE_COALESCE_MAX_WAIT_MS, MESSAGE_COALESCE_WINDOW_MS
+
+
+@dataclass
+class _Batch:
+    payloads: list[dict]
+    started_at: float = field(default_factory=time.monotonic)
+    last_at: float = field(default_factory=time.monotonic)
+
+
+class MessageCoalescer:
+    """
+    Groups the messages a user posts in quick succession in the same thread.
+
+    The first message of a batch leads it: collect() waits until no message
+    has joined for `window` seconds (and at most `max_wait` seconds in total),
+    then returns all the payloads in the batch. The messages arriving in the
+    meantime join the batch and get None, so that only the leader replies.
+
+    Batches live in this process, so only the messages handled by the same
+    process are coalesced.
+    """
+
+    def __init__(self, window: float, max_wait: float):
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self._batches: dict[Hashable, _Batch] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _join(self, key: Hashable, payload: dict) -> Optional[_Batch]:
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None:
+                batch.payloads.append(payload)
+                batch.last_at = time.monotonic()
+                return None
+            batch = _Batch([payload])
+            self._batches[key] = batch
+            return batch
+
+    def _remaining(self, key: Hashable, batch: _Batch) -> float:
+        with self._lock:
+            now = time.monotonic()
+            remaining = min(
+                batch.last_at + self.window - now,
+                batch.started_at + self.max_wait - now,
+            )
+            if remaining <= 0:
+                # Closed: the next message starts a new batch
+                del self._batches[key]
+            return remaining
+
+    def collect(self, key: Hashable, payload: dict) -> Optional[list[dict]]:
+        """
+        :return: The payloads to answer together, oldest first, or None when
+            the payload joined the batch of another message
+        """
+        if not self.enabled:
+            return [payload]
+        batch = self._join(key, payload)
+        if batch is None:
+            return None
+        while (remaining := self._remaining(key, batch)) > 0:
+            time.sleep(remaining)
+        return batch.payloads
+
+    async def collect_async(self, key: Hashable, payload: dict) -> Optional[list[dict]]:
+        if not self.enabled:
+            return [payload]
+        batch = self._join(key, payload)
+        if batch is None:
+            return None
+        while (remaining := self._remaining(key, batch)) > 0:
+            await asyncio.sleep(remaining)
+        return batch.payloads
+
+
+def merge_messages(payloads: list[dict]) -> dict:
+    """
+    Merge the message payloads into the first one: the texts are joined with
+    new lines and the files are concatenated. `merged_ts` lists the ts of all
+    the messages, so that editing or deleting any of them cancels the answer.
+    """
+    merged = dict(payloads[0])
+    merged["merged_ts"] = [p["ts"] for p in payloads]
+    merged["text"] = "\n".join(p.get("text", "") for p in payloads if p.get("text"))
+    merged["files"] = [f for p in payloads for f in p.get("files", [])]
+    return merged
+
+
+message_coalescer = MessageCoalescer(
+    window=MESSAGE_COALESCE_WINDOW_MS / 1000,
+    max_wait=MESSAGE_COALESCE_MAX_WAIT_MS / 1000,
+)
@@ -0,0 +1,194 @@
+import functools
+import inspect
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Optional
+
+from app.env import METRICS_ENABLED, METRICS_NAMESPACE, METRICS_PROMETHEUS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Token counts reported by Dify in the usage of message_end
+USAGE_TOKEN_FIELDS = {
+    "prompt_tokens": "PromptTokens",
+    "completion_tokens": "CompletionTokens",
+    "total_tokens": "TotalTokens",
+}
+
+
+class Metrics:
+    """
+    Durations of the Slack / Dify operations and the token usage of the
+    generations.
+
+    Every measurement is written to stdout as a CloudWatch Embedded Metric
+    Format document (one JSON line, with the stage as dimension), and also
+    kept in Prometheus metrics once start_prometheus_server() is called.
+    When disabled, timer() and timed() cost nothing but a flag check.
+    """
+
+    def __init__(self, enabled: bool, namespace: str):
+        self.enabled = enabled
+        self.namespace = namespace
+        self._prometheus = None
+        self._gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+        self._write_lock = threading.Lock()
+
+    def _emit(self, dimensions: dict, values: dict[str, tuple[float, str]]):
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (_, unit) in values.items()
+                        ],
+                    }
+                ],
+            },
+            **dimensions,
+            **{name: value for name, (value, _) in values.items()},
+        }
+        # EMF documents must be written as they are; the Lambda runtime's
+        # logging format would prefix them
+        line = json.dumps(document, separators=(",", ":")) + "\n"
+        with self._write_lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        self._emit({"Stage": stage}, {"Duration": (seconds * 1000, "Milliseconds")})
+        if self._prometheus is not None:
+            self._prometheus["duration"].labels(stage).observe(seconds)
+
+    def count(self, stage: str, value: int = 1) -> None:
+        """Count an event, e.g. a retry or a timeout."""
+        if not self.enabled:
+            return
+        self._emit({"Stage": stage}, {"Count": (value, "Count")})
+        if self._prometheus is not None:
+            self._prometheus["events"].labels(stage).inc(value)
+
+    def register_gauge(
+        self, name: str, description: str, func: Callable[[], float]
+    ) -> None:
+        """Expose the value returned by func as a Prometheus gauge (read at scrape time)."""
+        self._gauges[name] = (description, func)
+
+    @contextmanager
+    def _timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timer(self, stage: str):
+        """Context manager measuring the duration of the stage."""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(stage)
+
+    def timed(self, stage: str) -> Callable:
+        """Decorator measuring each call of a function or coroutine function."""
+
+        def decorator(func):
+            if not self.enabled:
+                return func
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self._timer(stage):
+                        return await func(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self._timer(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record_generation(self, result, started_at: float) -> None:
+        """
+        Record the timings of a Dify stream and the usage from its
+        message_end event.
+
+        :param result: The app.dify_ops.StreamingResult of the stream
+        :param started_at: time.perf_counter() when create_chat_message was called
+        """
+        if not self.enabled:
+            return
+        for stage, at in (
+            ("dify.time_to_first_event", result.first_event_at),
+            ("dify.time_to_first_token", result.first_answer_at),
+            ("dify.stream_total", result.finished_at),
+        ):
+            if at is not None:
+                self.observe(stage, at - started_at)
+
+        usage = result.usage or {}
+        values = {
+            name: (usage[field], "Count")
+            for field, name in USAGE_TOKEN_FIELDS.items()
+            if isinstance(usage.get(field), (int, float))
+        }
+        if result.latency is not None:
+            values["DifyLatency"] = (result.latency * 1000, "Milliseconds")
+        if not values:
+            return
+        self._emit({"Stage": "dify.usage"}, values)
+        if self._prometheus is not None:
+            for field in USAGE_TOKEN_FIELDS:
+                if isinstance(usage.get(field), (int, float)):
+                    self._prometheus["tokens"].labels(field).inc(usage[field])
+            if result.latency is not None:
+                self._prometheus["dify_latency"].observe(result.latency)
+
+    def start_prometheus_server(self, port: Optional[int] = METRICS_PROMETHEUS_PORT):
+        """Serve /metrics on the port (Socket Mode only; requires the `metrics` extra)."""
+        if not self.enabled or port is None:
+            return
+        from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+        self._prometheus = {
+            "duration": Histogram(
+                "dify_slack_stage_duration_seconds",
+                "Duration of the Slack / Dify operations",
+                ["stage"],
+            ),
+            "tokens": Counter(
+                "dify_slack_tokens",
+                "Tokens used by the Dify generations",
+                ["kind"],
+            ),
+            "dify_latency": Histogram(
+                "dify_slack_dify_latency_seconds",
+                "Generation latency reported by Dify in message_end",
+            ),
+            "events": Counter(
+                "dify_slack_events",
+                "Retries, timeouts and circuit breaker events",
+                ["stage"],
+            ),
+        }
+        for name, (description, func) in self._gauges.items():
+            Gauge(name, description).set_function(func)
+        start_http_server(port)
+        logger.info(f"Serving Prometheus metrics on port {port}")
+
+
+metrics = Metrics(enabled=METRICS_ENABLED, namespace=METRICS_NAMESPACE)
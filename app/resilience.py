@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from app.env import (
+    DIFY_CIRCUIT_FAILURE_THRESHOLD,
+    DIFY_CIRCUIT_RECOVERY_SECONDS,
+    DIFY_RETRY_BASE_DELAY_SECONDS,
+    DIFY_RETRY_MAX_ATTEMPTS,
+    DIFY_RETRY_MAX_DELAY_SECONDS,
+)
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Errors of requests (OSError subclasses) and of the socket timeouts
+CONNECTION_ERRORS: tuple[type[BaseException], ...] = (OSError, TimeoutError)
+
+
+class DifyUnavailableError(Exception):
+    """Raised without calling Dify while the circuit breaker is open."""
+
+
+def is_transient_error(
+    error: BaseException,
+    connection_errors: tuple[type[BaseException], ...] = CONNECTION_ERRORS,
+) -> bool:
+    """
+    :return: True for errors worth retrying: connection failures, timeouts,
+        HTTP 429 and 5xx
+    """
+    response = getattr(error, "response", None)
+    # requests' HTTPError has response.status_code, aiohttp's errors .status
+    status = getattr(response, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return isinstance(error, connection_errors)
+
+
+# ----------------------------
+# Circuit breaker
+# ----------------------------
+
+
+class CircuitBreaker:
+    """
+    Fails fast while Dify keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    allow() returns False. Once `recovery_seconds` have passed, a single
+    trial call is allowed (half-open); its success closes the circuit, its
+    failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started_at: Optional[float] = None
+        self.opened_total = 0
+        self.rejected_total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if (
+                self._state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.recovery_seconds
+            ):
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        if not self.enabled:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.CLOSED:
+                return True
+            if (
+                self._state == self.OPEN
+                and now - self._opened_at >= self.recovery_seconds
+            ):
+                self._state = self.HALF_OPEN
+            # A trial that never reported back doesn't keep the circuit stuck
+            if self._state == self.HALF_OPEN and (
+                self._trial_started_at is None
+                or now - self._trial_started_at >= self.recovery_seconds
+            ):
+                self._trial_started_at = now
+                return True
+            self.rejected_total += 1
+        metrics.count(f"{self.name}.circuit_rejected")
+        return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"The {self.name} circuit is closed again")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_started_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            should_open = self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            )
+            if not should_open or not self.enabled:
+                return
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_started_at = None
+            self.opened_total += 1
+        logger.warning(
+            f"The {self.name} circuit is open for {self.recovery_seconds}s "
+            f"after {self._failures} consecutive failures"
+        )
+        metrics.count(f"{self.name}.circuit_opened")
+
+    def record(
+        self,
+        error: Optional[BaseException],
+        connection_errors: tuple[type[BaseException], ...] = CONNECTION_ERRORS,
+    ) -> None:
+        """Record the outcome of a call; only transient errors count as failures."""
+        if error is not None and is_transient_error(error, connection_errors):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def metrics(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "opened_total": self.opened_total,
+                "rejected_total": self.rejected_total,
+            }
+
+
+# ----------------------------
+# Retries
+# ----------------------------
+
+
+def _backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    # "Full jitter": spreads the retries of concurrent callers
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def retry_call(
+    func: Callable[[], T],
+    *,
+    name: str,
+    breaker: Optional[CircuitBreaker] = None,
+    attempts: int = DIFY_RETRY_MAX_ATTEMPTS,
+    base_delay: float = DIFY_RETRY_BASE_DELAY_SECONDS,
+    max_delay: float = DIFY_RETRY_MAX_DELAY_SECONDS,
+) -> T:
+    """
+    Call an idempotent function, retrying transient errors with jittered
+    exponential backoff.
+
+    :raises DifyUnavailableError: When the breaker is open
+    """
+    for attempt in range(attempts):
+        if breaker is not None and not breaker.allow():
+            raise DifyUnavailableError(f"{name} skipped while the circuit is open")
+        try:
+            result = func()
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(e)
+            if not is_transient_error(e) or attempt == attempts - 1:
+                raise
+            delay = _backoff(attempt, base_delay, max_delay)
+            logger.warning(f"{name} failed ({e}); retrying in {delay:.2f}s")
+            metrics.count(f"{name}.retry")
+            time.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+
+async def retry_call_async(
+    func: Callable[[], Awaitable[T]],
+    *,
+    name: str,
+    breaker: Optional[CircuitBreaker] = None,
+    connection_errors: tuple[type[BaseException], ...] = CONNECTION_ERRORS,
+    attempts: int = DIFY_RETRY_MAX_ATTEMPTS,
+    base_delay: float = DIFY_RETRY_BASE_DELAY_SECONDS,
+    max_delay: float = DIFY_RETRY_MAX_DELAY_SECONDS,
+) -> T:
+    """asyncio version of retry_call."""
+    for attempt in range(attempts):
+        if breaker is not None and not breaker.allow():
+            raise DifyUnavailableError(f"{name} skipped while the circuit is open")
+        try:
+            result = await func()
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(e, connection_errors)
+            if not is_transient_error(e, connection_errors) or attempt == attempts - 1:
+                raise
+            delay = _backoff(attempt, base_delay, max_delay)
+            logger.warning(f"{name} failed ({e}); retrying in {delay:.2f}s")
+            metrics.count(f"{name}.retry")
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+
+dify_circuit_breaker = CircuitBreaker(
+    "dify",
+    failure_threshold=DIFY_CIRCUIT_FAILURE_THRESHOLD,
+    recovery_seconds=DIFY_CIRCUIT_RECOVERY_SECONDS,
+)
+
+_CIRCUIT_STATE_VALUES = {
+    CircuitBreaker.CLOSED: 0,
+    CircuitBreaker.HALF_OPEN: 1,
+    CircuitBreaker.OPEN: 2,
+}
+metrics.register_gauge(
+    "dify_slack_dify_circuit_state",
+    "State of the Dify circuit breaker (0: closed, 1: half-open, 2: open)",
+    lambda: _CIRCUIT_STATE_VALUES[dify_circuit_breaker.state],
+)
@@ -1,19 +1,70 @@
-import uuid
-from typing import Optional
+import re
+import time
+from typing import Iterable, Optional
 
-import requests
 from slack_bolt import BoltContext
 from slack_sdk.errors import SlackApiError
 from slack_sdk.web import SlackResponse, WebClient
 
-from app.env import IMAGE_FILE_ACCESS_ENABLED
-from app.markdown_conversion import markdown_to_slack, slack_to_markdown
+from app.cache import TTLCache
+from app.env import (
+    BOT_USER_CACHE_MAX_SIZE,
+    BOT_USER_CACHE_TTL_SECONDS,
+    IMAGE_FILE_ACCESS_ENABLED,
+    IMAGE_MAX_BYTES,
+    STREAMING_UPDATE_INTERVAL_SECONDS,
+    STREAMING_UPDATE_MIN_BYTES,
+    THREAD_OWNERSHIP_CACHE_MAX_SIZE,
+    THREAD_OWNERSHIP_CACHE_TTL_SECONDS,
+    THREAD_OWNERSHIP_NEGATIVE_TTL_SECONDS,
+)
+from app.http_pool import DEFAULT_TIMEOUT, get_session
+from app.markdown_conversion import (
+    MarkdownToSlackStream,
+    markdown_to_slack,
+    slack_to_markdown,
+)
+from app.metrics import metrics
+from app.slack_rate_limit import slack_api_scheduler
+from app.thread_history import thread_history_cache
 
 # ----------------------------
 # Messages
 # ----------------------------
 
 DEFAULT_LOADING_TEXT = ":hourglass_flowing_sand: しばらくお待ちください..."
+QUEUED_TEXT = ":hourglass_flowing_sand: 順番待ちです（{position} 番目）。しばらくお待ちください..."
+BUSY_TEXT = ":warning: 現在混み合っています。しばらくしてからもう一度お試しください。"
+CANCELLED_TEXT = ":no_entry_sign: 回答を中止しました。"
+TIMEOUT_TEXT = ":warning: AI からの応答が途絶えたため、回答を中断しました。もう一度お試しください。"
+UNAVAILABLE_TEXT = (
+    ":warning: 現在 AI が応答できない状態です。しばらくしてからもう一度お試しください。"
+)
+ERROR_TEXT = "申し訳ありませんが、エラーが発生しました。後ほどお試しください。"
+
+# Placeholders and status replies of the app, which carry no information for
+# Dify; the error replies are prefixed with a mention of the user
+STATUS_TEXTS = {
+    DEFAULT_LOADING_TEXT,
+    QUEUED_TEXT,
+    BUSY_TEXT,
+    CANCELLED_TEXT,
+    TIMEOUT_TEXT,
+    UNAVAILABLE_TEXT,
+    ERROR_TEXT,
+}
+_STATUS_TEXT_PATTERN = re.compile(
+    r"(?:<@\w+>\n)?(?:"
+    + "|".join(
+        re.escape(text).replace(re.escape("{position}"), r"\d+")
+        for text in STATUS_TEXTS
+    )
+    + ")"
+)
+
+
+def is_status_text(text: str) -> bool:
+    return _STATUS_TEXT_PATTERN.fullmatch(text) is not None
 
 
 # ----------------------------
@@ -27,7 +78,9 @@ def find_parent_message(
     if channel_id is None or thread_ts is None:
         return None
 
-    messages = client.conversations_history(
+    messages = slack_api_scheduler.call(
+        client,
+        "conversations_history",
         channel=channel_id,
         latest=thread_ts,
         limit=1,
@@ -37,11 +90,101 @@ def find_parent_message(
     return messages[0] if len(messages) > 0 else None
 
 
+def fetch_thread_messages(client: WebClient, channel_id: str, thread_ts: str) -> list:
+    return thread_history_cache.get_messages(client, channel_id, thread_ts)
+
+
+def find_thread_root_message(
+    client: WebClient, channel_id: str, thread_ts: str
+) -> Optional[dict]:
+    return thread_history_cache.get_root_message(client, channel_id, thread_ts)
+
+
 def is_this_app_mentioned(context: BoltContext, parent_message: dict) -> bool:
     parent_message_text = parent_message.get("text", "")
     return f"<@{context.bot_user_id}>" in parent_message_text
 
 
+# (channel_id, thread_ts) -> whether the thread root mentions this app
+thread_ownership = TTLCache(
+    THREAD_OWNERSHIP_CACHE_MAX_SIZE, THREAD_OWNERSHIP_CACHE_TTL_SECONDS
+)
+
+
+def remember_thread_owner(channel_id: str, thread_ts: str, is_owned: bool) -> None:
+    thread_ownership.set(
+        (channel_id, thread_ts),
+        is_owned,
+        None if is_owned else THREAD_OWNERSHIP_NEGATIVE_TTL_SECONDS,
+    )
+
+
+def remember_thread_root(
+    context: BoltContext, channel_id: str, root_message: dict
+) -> bool:
+    is_owned = is_this_app_mentioned(context, root_message)
+    remember_thread_owner(channel_id, root_message["ts"], is_owned)
+    return is_owned
+
+
+def forget_thread_root(channel_id: str, thread_ts: str) -> None:
+    """Drop what is known about a root message that was edited."""
+    thread_ownership.pop((channel_id, thread_ts))
+    thread_history_cache.forget(channel_id, thread_ts)
+
+
+def update_thread_reply(
+    channel_id: str, thread_ts: str, ts: str, message: Optional[dict]
+) -> None:
+    """Apply the edit of a reply (or its deletion, if None) to the cached thread."""
+    thread_history_cache.replace(channel_id, thread_ts, ts, message)
+
+
+def is_thread_for_this_app(
+    context: BoltContext, client: WebClient, channel_id: str, thread_ts: str
+) -> bool:
+    """
+    Whether the thread was started by a message mentioning this app.
+
+    Roots already seen by this process are answered from memory; only unknown
+    threads cost a Slack API call, and the answer is remembered either way.
+    """
+    is_owned = thread_ownership.get((channel_id, thread_ts))
+    if is_owned is not None:
+        return is_owned
+
+    root_message = find_thread_root_message(client, channel_id, thread_ts)
+    if root_message is None:
+        return False
+    return remember_thread_root(context, channel_id, root_message)
+
+
+# bot_id -> user id of the bot, or "" for bots without a user
+bot_user_ids = TTLCache(BOT_USER_CACHE_MAX_SIZE, BOT_USER_CACHE_TTL_SECONDS)
+
+
+def resolve_bot_user_ids(
+    client: WebClient, bot_ids: Iterable[Optional[str]]
+) -> dict[str, Optional[str]]:
+    """
+    Resolve the user ids of the given bots, calling bots.info at most once
+    per distinct bot that isn't cached yet.
+
+    :return: Mapping from bot_id to the bot user id (None if it has none)
+    """
+    resolved = {}
+    for bot_id in dict.fromkeys(bot_id for bot_id in bot_ids if bot_id):
+        user_id = bot_user_ids.get(bot_id)
+        if user_id is None:
+            bot = slack_api_scheduler.call(client, "bots_info", bot=bot_id).get(
+                "bot", {}
+            )
+            user_id = bot.get("user_id") or ""
+            bot_user_ids.set(bot_id, user_id)
+        resolved[bot_id] = user_id or None
+    return resolved
+
+
 def build_thread_replies_as_combined_text(
     *,
     context: BoltContext,
@@ -50,22 +193,20 @@ def build_thread_replies_as_combined_text(
     thread_ts: str,
 ) -> str:
     thread_content = ""
-    for page in client.conversations_replies(
-        channel=channel,
-        ts=thread_ts,
-        limit=1000,
-    ):
-        for reply in page.get("messages", []):
-            user = reply.get("user")
-            if user == context.bot_user_id:  # Skip replies by this app
+    replies = fetch_thread_messages(client, channel, thread_ts)
+    bot_users = resolve_bot_user_ids(
+        client, (reply.get("bot_id") for reply in replies if "user" not in reply)
+    )
+    for reply in replies:
+        user = reply.get("user")
+        if user == context.bot_user_id:  # Skip replies by this app
+            continue
+        if user is None:
+            user = bot_users.get(reply.get("bot_id"))
+            if user is None or user == context.bot_user_id:
                 continue
-            if user is None:
-                bot_response = client.bots_info(bot=reply.get("bot_id"))
-                user = bot_response.get("bot", {}).get("user_id")
-                if user is None or user == context.bot_user_id:
-                    continue
-            text = slack_to_markdown("".join(reply["text"].splitlines()))
-            thread_content += f"<@{user}>: {text}\n"
+        text = slack_to_markdown("".join(reply["text"].splitlines()))
+        thread_content += f"<@{user}>: {text}\n"
     return thread_content
 
 
@@ -81,7 +222,9 @@ def post_wip_message(
     thread_ts: str,
     loading_text: str = DEFAULT_LOADING_TEXT,
 ) -> SlackResponse:
-    return client.chat_postMessage(
+    return slack_api_scheduler.call(
+        client,
+        "chat_postMessage",
         channel=channel,
         thread_ts=thread_ts,
         text=markdown_to_slack(loading_text),
@@ -93,12 +236,54 @@ def update_wip_message(
     channel: str,
     ts: str,
     text: str,
-) -> SlackResponse:
-    return client.chat_update(
-        channel=channel,
-        ts=ts,
-        text=markdown_to_slack(text),
-    )
+) -> Optional[SlackResponse]:
+    return slack_api_scheduler.update(client, channel, ts, markdown_to_slack(text))
+
+
+def update_wip_message_with_stream(
+    client: WebClient,
+    channel: str,
+    ts: str,
+    chunks: Iterable[str],
+    *,
+    interval: float = STREAMING_UPDATE_INTERVAL_SECONDS,
+    min_bytes: int = STREAMING_UPDATE_MIN_BYTES,
+) -> str:
+    """
+    Progressively write the streamed answer chunks into the WIP message.
+
+    Chunks are coalesced and flushed with chat_update once `interval` seconds
+    have passed since the previous update or once `min_bytes` of new text
+    have been buffered, whichever comes first. An intermediate update is
+    skipped while chat.update is rate limited, so the text keeps accumulating
+    until the next one. The complete answer is always written with a final
+    update.
+
+    :return: The complete answer
+    """
+    parts = []
+    converter = MarkdownToSlackStream()
+    pending_bytes = 0
+    last_update = time.monotonic()
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        parts.append(chunk)
+        # Converts only the newly completed lines instead of the whole answer
+        converter.feed(chunk)
+        pending_bytes += len(chunk.encode())
+        now = time.monotonic()
+        if now - last_update >= interval or pending_bytes >= min_bytes:
+            if slack_api_scheduler.update(
+                client, channel, ts, converter.text, block=False
+            ):
+                pending_bytes = 0
+                last_update = now
+
+    converter.finish()
+    slack_api_scheduler.update(client, channel, ts, converter.text)
+    return "".join(parts)
 
 
 # ----------------------------
@@ -130,28 +315,45 @@ def can_send_image_url_to_openai(context: BoltContext) -> bool:
     return can_send_image_url
 
 
+@metrics.timed("slack.download_image")
 def download_slack_image_content(
-    image_url: str, image_name: str, bot_token: str
-) -> str:
-    response = requests.get(
+    image_url: str, bot_token: str, max_bytes: int = IMAGE_MAX_BYTES
+) -> bytes:
+    """
+    Download the image into memory, streaming the body so that files larger
+    than `max_bytes` are rejected without being read entirely.
+    """
+    with get_session(image_url).get(
         image_url,
         headers={"Authorization": f"Bearer {bot_token}"},
-    )
-    if response.status_code != 200:
-        error = f"Request to {image_url} failed with status code {response.status_code}"
-        raise SlackApiError(error, response)
-
-    content_type = response.headers["content-type"]
-    if content_type.startswith("text/html"):
-        error = f"You don't have the permission to download this file: {image_url}"
-        raise SlackApiError(error, response)
-
-    if not content_type.startswith("image/"):
-        error = f"The responded content-type is not for image data: {content_type}"
-        raise SlackApiError(error, response)
-
-    temp_path = f"/tmp/{uuid.uuid4()}-{image_name}"
-    with open(temp_path, "wb") as f:
-        f.write(response.content)
-
-    return temp_path
+        timeout=DEFAULT_TIMEOUT,
+        stream=True,
+    ) as response:
+        if response.status_code != 200:
+            error = (
+                f"Request to {image_url} failed with status code {response.status_code}"
+            )
+            raise SlackApiError(error, response)
+
+        content_type = response.headers["content-type"]
+        if content_type.startswith("text/html"):
+            error = f"You don't have the permission to download this file: {image_url}"
+            raise SlackApiError(error, response)
+
+        if not content_type.startswith("image/"):
+            error = f"The responded content-type is not for image data: {content_type}"
+            raise SlackApiError(error, response)
+
+        content_length = int(response.headers.get("content-length", 0))
+        if content_length > max_bytes:
+            error = f"The image is larger than {max_bytes} bytes: {image_url}"
+            raise SlackApiError(error, response)
+
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content += chunk
+            if len(content) > max_bytes:
+                error = f"The image is larger than {max_bytes} bytes: {image_url}"
+                raise SlackApiError(error, response)
+
+    return bytes(content)
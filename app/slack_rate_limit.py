@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse, WebClient
+
+from app.cache import TTLCache
+from app.env import SLACK_RATE_LIMIT_ENABLED, SLACK_RATE_LIMIT_MAX_RETRIES
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute of the Web API methods used by this app
+# See also: https://api.slack.com/apis/rate-limits
+METHOD_RATES_PER_MINUTE = {
+    "chat.postMessage": 60,  # Special tier: about 1 per second per channel
+    "chat.update": 50,  # Tier 3
+    "conversations.history": 50,  # Tier 3
+    "conversations.replies": 50,  # Tier 3
+    "bots.info": 20,  # Tier 2
+}
+DEFAULT_RATE_PER_MINUTE = 20
+# Methods limited per channel rather than per workspace
+PER_CHANNEL_METHODS = {"chat.postMessage"}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second.
+
+    Required calls take a token without waiting for it, which leaves none
+    for the optional ones (try_acquire) while the method is busy; all of them
+    wait while the bucket is blocked by a Retry-After.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def take(self) -> float:
+        """Take a token if any and return how many seconds the bucket is blocked."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = max(0.0, self._tokens - 1)
+            return self._blocked_until - now
+
+    def block_for(self, seconds: float) -> None:
+        """Stop handing out tokens, e.g. for the Retry-After of a 429 response."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class SlackApiScheduler:
+    """
+    Runs the Slack Web API calls of this app within the per-method rate limits
+    (per channel for chat.postMessage).
+
+    Required calls are sent right away, since Slack tolerates bursts above
+    the documented rates; the optional intermediate updates of a stream are
+    only sent while the method is below its rate. Calls answered with 429
+    block the method (of the channel, for chat.postMessage) until Retry-After,
+    and are retried then. chat.update calls for the same message that are
+    waiting are collapsed into a single call with the latest text.
+    """
+
+    def __init__(self, enabled: bool = True, max_retries: int = 3):
+        self.enabled = enabled
+        self.max_retries = max_retries
+        # Idle buckets are full again, so only the recently used ones are kept
+        self._buckets = TTLCache(maxsize=10000, ttl=300)
+        self._waiting: dict[str, int] = {}
+        # (channel, ts) -> latest text of the chat.update waiting for its turn
+        self._pending_updates: dict[tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, method: str, channel: Optional[str] = None) -> TokenBucket:
+        key = (method, channel if method in PER_CHANNEL_METHODS else None)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate = METHOD_RATES_PER_MINUTE.get(method, DEFAULT_RATE_PER_MINUTE)
+                # Allow short bursts of a few seconds' worth of calls
+                bucket = TokenBucket(rate / 60, capacity=max(1.0, rate / 20))
+            # Refreshes the expiry of the buckets in use
+            self._buckets.set(key, bucket)
+            return bucket
+
+    def _wait_for_turn(self, method: str, channel: Optional[str] = None) -> None:
+        wait = self._bucket(method, channel).take()
+        if wait <= 0:
+            return
+        with self._lock:
+            self._waiting[method] = self._waiting.get(method, 0) + 1
+        try:
+            time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting[method] -= 1
+
+    def queue_depth(self, method: Optional[str] = None) -> int:
+        """Number of calls currently waiting for a Retry-After (of the method, or in total)."""
+        with self._lock:
+            if method is not None:
+                return self._waiting.get(method, 0)
+            return sum(self._waiting.values())
+
+    def call(self, client: WebClient, method_name: str, **kwargs) -> SlackResponse:
+        """
+        Call a WebClient method such as `chat_postMessage` within its rate limit.
+        """
+        api_method = method_name.replace("_", ".", 1)
+        if not self.enabled:
+            with metrics.timer(f"slack.{api_method}"):
+                return getattr(client, method_name)(**kwargs)
+
+        channel = kwargs.get("channel")
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_turn(api_method, channel)
+            try:
+                with metrics.timer(f"slack.{api_method}"):
+                    return getattr(client, method_name)(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = _retry_after(e)
+                logger.warning(
+                    f"{api_method} is rate limited; retrying in {retry_after}s "
+                    f"({self.queue_depth(api_method)} calls waiting)"
+                )
+                self._bucket(api_method, channel).block_for(retry_after)
+
+    def update(
+        self,
+        client: WebClient,
+        channel: str,
+        ts: str,
+        text: str,
+        *,
+        block: bool = True,
+    ) -> Optional[SlackResponse]:
+        """
+        chat.update the message, collapsing the calls waiting for the same ts.
+
+        :param block: When False, the update is skipped unless a token is
+            available right away, and not retried when answered with 429
+            (for intermediate updates of a stream)
+        :return: The response, or None if the text was handed over to a call
+            already waiting for this message or the update was skipped
+        """
+        if not self.enabled:
+            with metrics.timer("slack.chat.update"):
+                return client.chat_update(channel=channel, ts=ts, text=text)
+
+        key = (channel, ts)
+        bucket = self._bucket("chat.update")
+        with self._lock:
+            if key in self._pending_updates:
+                self._pending_updates[key] = text
+                return None
+            if block:
+                self._pending_updates[key] = text
+
+        if not block:
+            if not bucket.try_acquire():
+                return None
+        else:
+            try:
+                self._wait_for_turn("chat.update")
+            finally:
+                with self._lock:
+                    text = self._pending_updates.pop(key)
+
+        try:
+            with metrics.timer("slack.chat.update"):
+                return client.chat_update(channel=channel, ts=ts, text=text)
+        except SlackApiError as e:
+            if e.response.status_code != 429:
+                raise
+            bucket.block_for(_retry_after(e))
+            if not block:
+                # An intermediate update is skipped rather than retried; the
+                # next one (or the final update) carries the text
+                return None
+            # The retries go through the queue like any other call
+            return self.call(client, "chat_update", channel=channel, ts=ts, text=text)
+
+
+def _retry_after(error: SlackApiError) -> float:
+    return float(error.response.headers.get("Retry-After", 1))
+
+
+slack_api_scheduler = SlackApiScheduler(
+    enabled=SLACK_RATE_LIMIT_ENABLED, max_retries=SLACK_RATE_LIMIT_MAX_RETRIES
+)
+metrics.register_gauge(
+    "dify_slack_slack_api_queue_depth",
+    "Slack Web API calls waiting for their rate limit",
+    slack_api_scheduler.queue_depth,
+)
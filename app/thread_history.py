@@ -0,0 +1,174 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from slack_sdk.web import WebClient
+
+from app.env import THREAD_HISTORY_CACHE_MAX_BYTES
+from app.slack_rate_limit import slack_api_scheduler
+
+# Only these fields of a reply are used by the listeners
+MESSAGE_FIELDS = ("ts", "user", "bot_id", "username", "text")
+# Rough per-message overhead of the dict holding a record
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def compact_message(message: dict) -> dict:
+    return {key: message[key] for key in MESSAGE_FIELDS if key in message}
+
+
+def _message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD_BYTES + len(message.get("text", "").encode())
+
+
+def fetch_replies(
+    client: WebClient, channel: str, thread_ts: str, oldest: Optional[str] = None
+) -> list[dict]:
+    """Fetch all the (newer than `oldest`) replies, following the cursor pagination."""
+    messages = []
+    cursor = None
+    while True:
+        response = slack_api_scheduler.call(
+            client,
+            "conversations_replies",
+            channel=channel,
+            ts=thread_ts,
+            include_all_metadata=True,
+            limit=1000,
+            oldest=oldest,
+            cursor=cursor,
+        )
+        messages.extend(compact_message(m) for m in response.get("messages", []))
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            return messages
+
+
+def last_seen_ts(messages: list[dict], thread_ts: str) -> str:
+    return messages[-1]["ts"] if messages else thread_ts
+
+
+class ThreadHistoryCache:
+    """
+    Compact per-thread copies of conversations.replies, keyed by
+    (channel, thread_ts).
+
+    A thread is downloaded completely the first time, then only the replies
+    newer than the last seen ts are fetched; edits and deletions of the cached
+    replies, including the app's own WIP replies being updated, are applied
+    from the message_changed / message_deleted events with replace(). Threads
+    are evicted in LRU order once the records exceed `max_bytes` in total.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._threads: OrderedDict[tuple[str, str], tuple[list[dict], int]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get_messages(self, client: WebClient, channel: str, thread_ts: str) -> list:
+        cached = self.peek(channel, thread_ts)
+        if cached is None:
+            return self.put(
+                channel, thread_ts, fetch_replies(client, channel, thread_ts)
+            )
+
+        newer = fetch_replies(
+            client, channel, thread_ts, last_seen_ts(cached, thread_ts)
+        )
+        return self.extend(channel, thread_ts, cached, newer)
+
+    def get_root_message(
+        self, client: WebClient, channel: str, thread_ts: str
+    ) -> Optional[dict]:
+        root_message = self.peek_root(channel, thread_ts)
+        if root_message is not None:
+            return root_message
+
+        messages = slack_api_scheduler.call(
+            client, "conversations_replies", channel=channel, ts=thread_ts, limit=1
+        ).get("messages", [])
+        return compact_message(messages[0]) if messages else None
+
+    # The methods below hold no Slack client, so that the asyncio listeners
+    # can share the cache with their own conversations.replies calls
+
+    def peek(self, channel: str, thread_ts: str) -> Optional[list]:
+        key = (channel, thread_ts)
+        with self._lock:
+            cached = self._threads.get(key)
+        return None if cached is None else list(cached[0])
+
+    def peek_root(self, channel: str, thread_ts: str) -> Optional[dict]:
+        key = (channel, thread_ts)
+        with self._lock:
+            cached = self._threads.get(key)
+        if cached is not None and cached[0] and cached[0][0]["ts"] == thread_ts:
+            self._touch(key)
+            return cached[0][0]
+        return None
+
+    def put(self, channel: str, thread_ts: str, messages: list[dict]) -> list:
+        self._store((channel, thread_ts), messages)
+        return list(messages)
+
+    def extend(
+        self, channel: str, thread_ts: str, cached: list[dict], fetched: list[dict]
+    ) -> list:
+        """Append the replies fetched with oldest=last_seen_ts(cached) to the thread."""
+        last_ts = last_seen_ts(cached, thread_ts)
+        # The parent message is returned along with the newer replies
+        newer = [
+            message for message in fetched if float(message["ts"]) > float(last_ts)
+        ]
+        if not newer:
+            self._touch((channel, thread_ts))
+            return cached
+        return self.put(channel, thread_ts, cached + newer)
+
+    def replace(
+        self, channel: str, thread_ts: str, ts: str, message: Optional[dict]
+    ) -> None:
+        """Replace the cached reply `ts` with `message`, or drop it if None."""
+        key = (channel, thread_ts)
+        with self._lock:
+            cached = self._threads.get(key)
+        if cached is None or not any(m["ts"] == ts for m in cached[0]):
+            return
+        messages = []
+        for cached_message in cached[0]:
+            if cached_message["ts"] != ts:
+                messages.append(cached_message)
+            elif message is not None:
+                messages.append(compact_message({**message, "ts": ts}))
+        self._store(key, messages)
+
+    def forget(self, channel: str, thread_ts: str) -> None:
+        with self._lock:
+            previous = self._threads.pop((channel, thread_ts), None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+
+    def _touch(self, key: tuple[str, str]) -> None:
+        with self._lock:
+            if key in self._threads:
+                self._threads.move_to_end(key)
+
+    def _store(self, key: tuple[str, str], messages: list[dict]) -> None:
+        size = sum(_message_size(message) for message in messages)
+        with self._lock:
+            previous = self._threads.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            if size > self.max_bytes:
+                return
+            self._threads[key] = (messages, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._threads.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+
+thread_history_cache = ThreadHistoryCache(THREAD_HISTORY_CACHE_MAX_BYTES)
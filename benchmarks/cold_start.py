@@ -0,0 +1,180 @@
+"""
+Cold start and ack path of the Lambda entry point.
+
+    uv run python benchmarks/cold_start.py [invocations]
+
+Imports index.py in fresh interpreters with -X importtime, then calls
+lambda_handler repeatedly with signed events that are answered on the ack
+path (no Slack / Dify API call) and checks that:
+
+- the generation path (dify_client, Pillow, app.bolt_listeners, ...) is not
+  imported by the cold start nor by the ack path
+- the number of registered listeners stays the same across invocations
+- the ack latency stays well under Slack's 3 seconds
+
+boto3 must be installed as on the Lambda runtime.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+SIGNING_SECRET = "benchmark-signing-secret"
+ENV = {
+    "SLACK_APP_TOKEN": "xapp-benchmark",
+    "SLACK_BOT_TOKEN": "xoxb-benchmark",
+    "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+    "DIFY_APP_API_KEY": "app-benchmark",
+}
+GENERATION_PATH_MODULES = [
+    "app.bolt_listeners",
+    "app.listener_logic",
+    "app.dify_ops",
+    "app.image_ops",
+    "dify_client",
+    "sseclient",
+    "requests",
+    "PIL",
+]
+ACK_DEADLINE_SECONDS = 3.0
+
+
+def import_times(module: str, runs: int = 5) -> tuple[float, list[tuple[int, str]]]:
+    """
+    :return: The median cumulative import time of `module` in milliseconds,
+        and the (self time in us, name) of the slowest modules of the last run
+    """
+    totals = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT,
+            env={**os.environ, **ENV},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        modules = []
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            self_us, cumulative_us, name = line[len("import time:") :].split("|")
+            if not self_us.strip().isdigit():
+                continue  # Header
+            modules.append((int(self_us), int(cumulative_us), name.strip()))
+        totals.append(next(c for _, c, n in modules if n == module) / 1000)
+    slowest = sorted(((s, n) for s, _, n in modules), reverse=True)[:10]
+    return sorted(totals)[len(totals) // 2], slowest
+
+
+def loaded_generation_modules(module: str) -> list[str]:
+    code = (
+        f"import sys, {module}; "
+        f"print(' '.join(m for m in {GENERATION_PATH_MODULES!r} if m in sys.modules))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        env={**os.environ, **ENV},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return completed.stdout.split()
+
+
+def signed_lambda_event(body: dict) -> dict:
+    raw = json.dumps(body)
+    timestamp = str(int(time.time()))
+    signature = hmac.new(
+        SIGNING_SECRET.encode(), f"v0:{timestamp}:{raw}".encode(), hashlib.sha256
+    ).hexdigest()
+    return {
+        "body": raw,
+        "isBase64Encoded": False,
+        "headers": {
+            "content-type": "application/json",
+            "x-slack-request-timestamp": timestamp,
+            "x-slack-signature": f"v0={signature}",
+        },
+        "requestContext": {"http": {"method": "POST"}},
+    }
+
+
+def ack_path_events(i: int) -> list[dict]:
+    message_changed = {
+        "type": "event_callback",
+        "team_id": "T1",
+        "api_app_id": "A1",
+        "event_id": f"Ev{i}",
+        "event": {
+            "type": "message",
+            "subtype": "message_changed",
+            "channel": "C1",
+            "message": {"ts": f"{i}.0", "text": "edited", "edited": {}},
+            "previous_message": {"ts": f"{i}.0", "text": "original"},
+        },
+    }
+    url_verification = {"type": "url_verification", "challenge": f"challenge-{i}"}
+    return [signed_lambda_event(message_changed), signed_lambda_event(url_verification)]
+
+
+def main():
+    invocations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    for module in ["index", "app.bolt_listeners"]:
+        median, slowest = import_times(module)
+        print(f"import {module}: {median:.1f} ms (median of 5 cold imports)")
+        for self_us, name in slowest[:5]:
+            print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    loaded = loaded_generation_modules("index")
+    print(f"generation path modules loaded by index: {loaded or 'none'}")
+    assert not loaded, loaded
+
+    os.environ.update(ENV)
+    started = time.perf_counter()
+    import index
+
+    print(f"in-process import index: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    lambda_context = SimpleNamespace(
+        function_name="benchmark", invoked_function_arn="arn:benchmark"
+    )
+    listener_count = len(index.app._listeners)
+    latencies = []
+    for i in range(invocations):
+        for event in ack_path_events(i):
+            started = time.perf_counter()
+            response = index.lambda_handler(event, lambda_context)
+            latencies.append(time.perf_counter() - started)
+            assert response["statusCode"] == 200, response
+        assert len(index.app._listeners) == listener_count, (
+            f"{len(index.app._listeners)} listeners after {i + 1} invocations, "
+            f"{listener_count} expected"
+        )
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"ack path over {len(latencies)} invocations: "
+        f"p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+    )
+    print(f"listeners: {listener_count} (constant)")
+    loaded = [m for m in GENERATION_PATH_MODULES if m in sys.modules]
+    print(f"generation path modules loaded by the ack path: {loaded or 'none'}")
+    assert not loaded, loaded
+    assert latencies[-1] < ACK_DEADLINE_SECONDS
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+Local fake Slack Web API and Dify API servers for offline load tests.
+
+FakeSlack answers the Web API methods used by this app and keeps the posted
+messages per thread; FakeDify streams answers in Dify's server-sent events
+format, replaying a recorded stream or a synthetic one at a given token rate,
+with jitter and injected errors. Both count the calls per method / endpoint.
+
+With `rate_limit_factor`, FakeSlack answers the calls beyond Slack's
+published rate limits (SLACK_RATE_LIMITS, scaled by the factor) with 429 and
+Retry-After, like the real API.
+
+Every answer ends with ANSWER_END_MARKER so that a harness can tell the final
+chat.update of a reply from the intermediate ones.
+"""
+
+import itertools
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qsl, urlparse
+
+ANSWER_END_MARKER = "ENDOFANSWER"
+BOT_USER_ID = "UBOT"
+BOT_ID = "BBOT"
+TEAM_ID = "T0001"
+
+# Calls per minute of the Web API methods; chat.postMessage is limited per
+# channel, the others per workspace
+# See also: https://api.slack.com/apis/rate-limits
+SLACK_RATE_LIMITS = {
+    "chat.postMessage": 60,
+    "chat.update": 50,
+    "conversations.history": 50,
+    "conversations.replies": 50,
+    "bots.info": 20,
+}
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections under load
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Keep-alive connections closed by the app's pools are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self) -> dict:
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("content-type", "")
+        if content_type.startswith("application/json") and body:
+            params.update(json.loads(body))
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode()))
+        return params
+
+    def send_json(
+        self, data: dict, status: int = 200, headers: Optional[dict] = None
+    ) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _FakeService:
+    def __init__(self, handler_class: type):
+        handler = type(handler_class.__name__, (handler_class,), {"service": self})
+        self._server = _Server(("127.0.0.1", 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ----------------------------
+# Slack
+# ----------------------------
+
+
+class _SlackHandler(_JSONHandler):
+    service: "FakeSlack"
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        params = self.read_params()
+        self.service.count(method)
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        retry_after = self.service.check_rate_limit(method, params.get("channel"))
+        if retry_after is not None:
+            self.service.count("ratelimited")
+            self.send_json(
+                {"ok": False, "error": "ratelimited"},
+                429,
+                {"Retry-After": str(retry_after)},
+            )
+            return
+        self.send_json(self.service.handle(method, params))
+
+
+class FakeSlack(_FakeService):
+    """
+    Slack Web API at http://127.0.0.1:<port>/api/.
+
+    :param on_message: Called with (method, message) for every message posted
+        or updated by the app
+    :param latency: Seconds added to every call
+    :param rate_limit_factor: If given, the calls beyond SLACK_RATE_LIMITS
+        scaled by this factor are answered with 429 and Retry-After
+    """
+
+    def __init__(
+        self,
+        on_message: Optional[Callable[[str, dict], None]] = None,
+        latency: float = 0.0,
+        rate_limit_factor: Optional[float] = None,
+    ):
+        super().__init__(_SlackHandler)
+        self.on_message = on_message
+        self.latency = latency
+        self.rate_limit_factor = rate_limit_factor
+        # (method, channel) -> start times of the calls in the last minute
+        self._recent_calls: dict[tuple[str, Optional[str]], list[float]] = {}
+        # (channel, thread_ts) -> messages in ts order; the root first
+        self.threads: dict[tuple[str, str], list[dict]] = {}
+        self.messages: dict[tuple[str, str], dict] = {}
+        self._ts = itertools.count(1)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/"
+
+    def next_ts(self) -> str:
+        return f"{int(time.time())}.{next(self._ts):06d}"
+
+    def add_message(self, channel: str, message: dict) -> dict:
+        """Store a message as if it had been posted by a user."""
+        message = {"type": "message", "channel": channel, **message}
+        thread_ts = message.get("thread_ts") or message["ts"]
+        with self._lock:
+            self.threads.setdefault((channel, thread_ts), []).append(message)
+            self.messages[(channel, message["ts"])] = message
+        return message
+
+    def check_rate_limit(self, method: str, channel: Optional[str]) -> Optional[int]:
+        """
+        :return: The Retry-After seconds when the call exceeds the rate limit
+        """
+        if self.rate_limit_factor is None or method not in SLACK_RATE_LIMITS:
+            return None
+        limit = max(1, int(SLACK_RATE_LIMITS[method] * self.rate_limit_factor))
+        key = (method, channel if method == "chat.postMessage" else None)
+        # Sliding window; chat.postMessage allows 1 per second with short bursts
+        window = 60.0 if method != "chat.postMessage" else 60.0 / limit * 3
+        allowed = limit if method != "chat.postMessage" else 3
+        now = time.monotonic()
+        with self._lock:
+            calls = [t for t in self._recent_calls.get(key, []) if now - t < window]
+            if len(calls) >= allowed:
+                self._recent_calls[key] = calls
+                return max(1, math.ceil(window - (now - calls[0])))
+            calls.append(now)
+            self._recent_calls[key] = calls
+        return None
+
+    def handle(self, method: str, params: dict) -> dict:
+        channel = params.get("channel")
+        if method == "auth.test":
+            return {
+                "ok": True,
+                "url": "https://fake.slack.com/",
+                "team": "fake",
+                "team_id": TEAM_ID,
+                "user": "bot",
+                "user_id": BOT_USER_ID,
+                "bot_id": BOT_ID,
+            }
+        if method == "chat.postMessage":
+            message = self.add_message(
+                channel,
+                {
+                    "ts": self.next_ts(),
+                    "thread_ts": params.get("thread_ts"),
+                    "text": params.get("text", ""),
+                    "user": BOT_USER_ID,
+                    "bot_id": BOT_ID,
+                },
+            )
+            if self.on_message is not None:
+                self.on_message(method, message)
+            return {
+                "ok": True,
+                "channel": channel,
+                "ts": message["ts"],
+                "message": message,
+            }
+        if method == "chat.update":
+            with self._lock:
+                message = self.messages.get((channel, params.get("ts")))
+                if message is None:
+                    return {"ok": False, "error": "message_not_found"}
+                message["text"] = params.get("text", "")
+            if self.on_message is not None:
+                self.on_message(method, message)
+            return {
+                "ok": True,
+                "channel": channel,
+                "ts": message["ts"],
+                "text": message["text"],
+            }
+        if method == "conversations.replies":
+            with self._lock:
+                messages = list(self.threads.get((channel, params.get("ts")), []))
+            oldest = params.get("oldest")
+            if oldest:
+                messages = [m for m in messages if float(m["ts"]) > float(oldest)]
+            limit = int(params.get("limit") or 1000)
+            return {"ok": True, "messages": messages[:limit], "has_more": False}
+        if method == "conversations.history":
+            latest = params.get("latest")
+            with self._lock:
+                message = self.messages.get((channel, latest))
+            return {
+                "ok": True,
+                "messages": [message] if message else [],
+                "has_more": False,
+            }
+        if method == "bots.info":
+            return {
+                "ok": True,
+                "bot": {"id": params.get("bot"), "user_id": BOT_USER_ID},
+            }
+        return {"ok": True}
+
+
+# ----------------------------
+# Dify
+# ----------------------------
+
+
+def parse_recorded_stream(data: bytes) -> list[dict]:
+    """Parse a recorded Dify stream ("data: {...}" blocks) into its events."""
+    events = []
+    for block in data.replace(b"\r\n", b"\n").split(b"\n\n"):
+        for line in block.split(b"\n"):
+            if line.startswith(b"data:"):
+                events.append(json.loads(line[5:]))
+    return events
+
+
+def synthetic_stream(answer_tokens: int) -> list[dict]:
+    events = [{"event": "workflow_started", "data": {"id": "w"}}]
+    events += [
+        {"event": "message", "answer": f" token{i}"} for i in range(answer_tokens)
+    ]
+    events.append(
+        {
+            "event": "message_end",
+            "metadata": {
+                "usage": {
+                    "prompt_tokens": 100,
+                    "completion_tokens": answer_tokens,
+                    "total_tokens": 100 + answer_tokens,
+                    "latency": 1.0,
+                }
+            },
+        }
+    )
+    return events
+
+
+class _DifyHandler(_JSONHandler):
+    service: "FakeDify"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.read_params()
+        if path.endswith("/conversations"):
+            self.service.count("conversations")
+            self.send_json({"data": [], "has_more": False, "limit": 20})
+        else:
+            self.send_json({"message": "not found"}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        params = self.read_params()
+        if path.endswith("/files/upload"):
+            self.service.count("files/upload")
+            self.send_json({"id": str(uuid.uuid4())}, 201)
+        elif path.endswith("/stop"):
+            self.service.count("chat-messages/stop")
+            self.send_json({"result": "success"})
+        elif path.endswith("/chat-messages"):
+            self.service.count("chat-messages")
+            self.stream_answer(params)
+        else:
+            self.send_json({"message": "not found"}, 404)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def stream_answer(self, params: dict) -> None:
+        service = self.service
+        if service.first_byte_delay:
+            time.sleep(service.first_byte_delay)
+        if random.random() < service.error_rate:
+            service.count("errors")
+            self.send_json(
+                {"code": "internal_server_error", "message": "injected"}, 500
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+
+        ids = {
+            "task_id": str(uuid.uuid4()),
+            "conversation_id": params.get("conversation_id") or str(uuid.uuid4()),
+            "message_id": str(uuid.uuid4()),
+        }
+        try:
+            for event in service.events_for_answer():
+                if event.get("event") == "message" and service.token_interval:
+                    jitter = random.uniform(-service.jitter, service.jitter)
+                    time.sleep(max(0.0, service.token_interval * (1 + jitter)))
+                payload = {**event, **ids} if "event" in event else event
+                self.write_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # Closed by the app, e.g. a cancelled generation
+            self.close_connection = True
+
+
+class FakeDify(_FakeService):
+    """
+    Dify API at http://127.0.0.1:<port>/v1.
+
+    :param events: The events of every answer, e.g. parse_recorded_stream()
+        of a recorded stream; a synthetic answer by default
+    :param token_rate: message events per second; 0 sends them at once
+    :param jitter: Relative random variation of the interval between tokens
+    :param first_byte_delay: Seconds before the response starts
+    :param error_rate: Probability of answering a chat message with HTTP 500
+    """
+
+    def __init__(
+        self,
+        events: Optional[list[dict]] = None,
+        token_rate: float = 50.0,
+        jitter: float = 0.2,
+        first_byte_delay: float = 0.2,
+        error_rate: float = 0.0,
+    ):
+        super().__init__(_DifyHandler)
+        self.events = events if events is not None else synthetic_stream(100)
+        self.token_interval = 1 / token_rate if token_rate > 0 else 0.0
+        self.jitter = jitter
+        self.first_byte_delay = first_byte_delay
+        self.error_rate = error_rate
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def events_for_answer(self) -> list[dict]:
+        events = [e for e in self.events if e.get("event") != "message_end"]
+        message_end = next(
+            (e for e in self.events if e.get("event") == "message_end"),
+            {"event": "message_end", "metadata": {}},
+        )
+        marker = {"event": "message", "answer": f"\n{ANSWER_END_MARKER}"}
+        return [*events, marker, message_end]
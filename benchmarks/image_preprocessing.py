@@ -0,0 +1,77 @@
+"""
+Benchmark of the image preprocessing stage before the Dify upload.
+
+    IMAGE_PREPROCESSING_ENABLED=true uv run --extra image python benchmarks/image_preprocessing.py [image ...]
+
+Without arguments, synthetic phone-screenshot-sized images are generated.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PIL import Image  # noqa: E402
+
+from app.image_ops import can_preprocess_images, preprocess_image  # noqa: E402
+
+
+def synthetic_images() -> list[tuple[str, bytes, str]]:
+    images = []
+    for name, size in [("screenshot.png", (1290, 2796)), ("photo.png", (4032, 3024))]:
+        image = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 100).convert(
+            "RGB"
+        )
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        images.append((name, buffer.getvalue(), "image/png"))
+    return images
+
+
+def load_images(paths: list[str]) -> list[tuple[str, bytes, str]]:
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            content = f.read()
+        with Image.open(BytesIO(content)) as image:
+            mime_type = Image.MIME.get(image.format, "application/octet-stream")
+        images.append((os.path.basename(path), content, mime_type))
+    return images
+
+
+def main():
+    if not can_preprocess_images():
+        sys.exit("Set IMAGE_PREPROCESSING_ENABLED=true and install Pillow")
+
+    images = load_images(sys.argv[1:]) if len(sys.argv) > 1 else synthetic_images()
+
+    for name, content, mime_type in images:
+        start = time.perf_counter()
+        processed, _, processed_mime_type = preprocess_image(content, name, mime_type)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {len(content):>10,} B ({mime_type}) -> "
+            f"{len(processed):>10,} B ({processed_mime_type}) in {elapsed * 1000:.1f} ms"
+        )
+
+    batch = images * 4
+    for workers in (1, 4):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(
+                executor.map(
+                    lambda image: preprocess_image(image[1], image[0], image[2]),
+                    batch,
+                )
+            )
+        elapsed = time.perf_counter() - start
+        print(
+            f"batch of {len(batch)} with {workers} worker(s): {elapsed * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
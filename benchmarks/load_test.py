@@ -0,0 +1,456 @@
+"""
+Offline load test of the Bolt listeners against fake Slack and Dify servers.
+
+    uv run python benchmarks/load_test.py [--rate 10] [--duration 20] ...
+
+Synthetic app_mention / message events are dispatched to an App configured
+like index.py in Socket Mode, at a target rate (open loop). The fake Dify
+streams every answer (see benchmarks/fake_services.py), and an event is done
+when the final chat.update of its reply reaches the fake Slack, or when it is
+answered with an error / busy / unavailable message.
+
+Reported: throughput, p50/p95/p99 end-to-end latency (also per event kind),
+the events whose reply showed a queue position, and the Slack / Dify API
+calls per event. With --max-p95-ms / --max-dm-p95-ms /
+--max-slack-calls-per-event the script exits with status 1 when a limit is
+exceeded, for CI.
+
+Event mix (--mix):
+- mention: top-level app_mention in a channel, delivered with its message event
+- dm: top-level message in a DM
+- thread: reply in a thread started by a mention of the app
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fake_services import (  # noqa: E402
+    ANSWER_END_MARKER,
+    BOT_USER_ID,
+    TEAM_ID,
+    FakeDify,
+    FakeSlack,
+    parse_recorded_stream,
+    synthetic_stream,
+)
+
+
+@dataclass
+class Event:
+    kind: str
+    channel: str
+    ts: str
+    # The WIP reply of the app is posted in this thread
+    reply_thread_ts: str
+    sent_at: float = 0.0
+    done_at: Optional[float] = None
+    outcome: Optional[str] = None
+    # The reply showed a position in the generation queue
+    queued: bool = False
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.events: list[Event] = []
+        # (channel, ts of the message or of the thread of the reply) -> event
+        self.events_by_ts: dict[tuple[str, str], Event] = {}
+        self.lock = threading.Lock()
+        self.all_done = threading.Event()
+        self.sent_all = False
+        self.done = 0
+
+        if args.stream:
+            with open(args.stream, "rb") as f:
+                events = parse_recorded_stream(f.read())
+        else:
+            events = synthetic_stream(args.tokens)
+        self.slack = FakeSlack(
+            on_message=self.on_message,
+            latency=args.slack_latency_ms / 1000,
+            rate_limit_factor=args.slack_rate_limit_factor,
+        ).start()
+        self.dify = FakeDify(
+            events,
+            token_rate=args.token_rate,
+            jitter=args.jitter,
+            first_byte_delay=args.dify_first_byte_ms / 1000,
+            error_rate=args.error_rate,
+        ).start()
+
+        # app.env is read at import time
+        os.environ.update(
+            SLACK_API_BASE_URL=self.slack.base_url,
+            DIFY_API_BASE_URL=self.dify.base_url,
+            DIFY_APP_API_KEY="app-load-test",
+        )
+        if args.no_slack_pacing:
+            os.environ["SLACK_RATE_LIMIT_ENABLED"] = "false"
+        from slack_bolt import App, BoltContext
+        from slack_sdk import WebClient
+
+        from app.env import LISTENER_MAX_WORKERS
+        from app.lazy_listeners import before_authorize, register_listeners
+        from app.slack_ops import (
+            BUSY_TEXT,
+            CANCELLED_TEXT,
+            ERROR_TEXT,
+            QUEUED_TEXT,
+            TIMEOUT_TEXT,
+            UNAVAILABLE_TEXT,
+        )
+
+        self.queued_prefix = QUEUED_TEXT.split("{")[0]
+
+        self.failure_texts = {
+            "busy": BUSY_TEXT,
+            "cancelled": CANCELLED_TEXT,
+            "timed_out": TIMEOUT_TEXT,
+            "unavailable": UNAVAILABLE_TEXT,
+            "error": ERROR_TEXT,
+        }
+
+        # Same as index.py, in Socket Mode
+        self.app = App(
+            client=WebClient(token="xoxb-load-test", base_url=self.slack.base_url),
+            before_authorize=before_authorize,
+            token_verification_enabled=False,
+            listener_executor=ThreadPoolExecutor(max_workers=LISTENER_MAX_WORKERS),
+        )
+
+        @self.app.middleware
+        def set_dify_api_key(context: BoltContext, next_):
+            context["DIFY_APP_API_KEY"] = os.environ["DIFY_APP_API_KEY"]
+            next_()
+
+        register_listeners(self.app)
+
+    # ----------------------------
+    # Completion
+    # ----------------------------
+
+    def on_message(self, method: str, message: dict) -> None:
+        text = message.get("text", "")
+        if text.startswith(self.queued_prefix):
+            with self.lock:
+                event = self.events_by_ts.get(
+                    (message["channel"], message.get("thread_ts"))
+                )
+                if event is not None:
+                    event.queued = True
+            return
+        if ANSWER_END_MARKER in text:
+            outcome = "answered"
+        else:
+            outcome = next(
+                (o for o, t in self.failure_texts.items() if t in text), None
+            )
+            if outcome is None:
+                return
+        with self.lock:
+            event = self.events_by_ts.get(
+                (message["channel"], message.get("thread_ts"))
+            )
+            if event is None or event.done_at is not None:
+                return
+            event.done_at = time.perf_counter()
+            event.outcome = outcome
+            self.done += 1
+            if self.sent_all and self.done == len(self.events):
+                self.all_done.set()
+
+    # ----------------------------
+    # Events
+    # ----------------------------
+
+    def new_event(self, i: int) -> tuple[Event, list[dict]]:
+        kinds, weights = zip(*self.args.mix.items())
+        kind = random.choices(kinds, weights)[0]
+        user = f"U{i % self.args.users:05d}"
+        ts = self.slack.next_ts()
+        question = i % self.args.questions if self.args.questions else i
+        text = f"Question {question} " + "lorem ipsum " * self.args.words
+
+        if kind == "dm":
+            channel = f"D{i % self.args.users:05d}"
+            message = {"ts": ts, "user": user, "text": text, "channel_type": "im"}
+            self.slack.add_message(channel, message)
+            payloads = [{"type": "message", "channel": channel, **message}]
+            return Event(kind, channel, ts, ts), payloads
+
+        channel = f"C{i % self.args.channels:05d}"
+        if kind == "mention":
+            message = {
+                "ts": ts,
+                "user": user,
+                "text": f"<@{BOT_USER_ID}> {text}",
+                "channel_type": "channel",
+            }
+            self.slack.add_message(channel, message)
+            payloads = [
+                {"type": "app_mention", "channel": channel, **message},
+                {"type": "message", "channel": channel, **message},
+            ]
+            return Event(kind, channel, ts, ts), payloads
+
+        # A thread started by a mention of the app (already answered)
+        root_ts = ts
+        self.slack.add_message(
+            channel, {"ts": root_ts, "user": user, "text": f"<@{BOT_USER_ID}> hi"}
+        )
+        self.slack.add_message(
+            channel,
+            {
+                "ts": self.slack.next_ts(),
+                "thread_ts": root_ts,
+                "user": BOT_USER_ID,
+                "bot_id": "BBOT",
+                "text": "hello",
+            },
+        )
+        message = {
+            "ts": self.slack.next_ts(),
+            "thread_ts": root_ts,
+            "user": user,
+            "text": text,
+            "channel_type": "channel",
+        }
+        self.slack.add_message(channel, message)
+        payloads = [{"type": "message", "channel": channel, **message}]
+        return Event(kind, channel, message["ts"], root_ts), payloads
+
+    def dispatch(self, payload: dict) -> None:
+        from slack_bolt import BoltRequest
+
+        body = {
+            "token": "verification-token",
+            "team_id": TEAM_ID,
+            "api_app_id": "A0001",
+            "type": "event_callback",
+            "event_id": f"Ev{random.getrandbits(64):016X}",
+            "event_time": int(time.time()),
+            "event": payload,
+            "authorizations": [
+                {"team_id": TEAM_ID, "user_id": BOT_USER_ID, "is_bot": True}
+            ],
+        }
+        request = BoltRequest(body=json.dumps(body), mode="socket_mode")
+        response = self.app.dispatch(request)
+        if response.status != 200:
+            raise RuntimeError(f"Unexpected ack: {response.status} {response.body}")
+
+    def run(self) -> dict:
+        interval = 1 / self.args.rate
+        total = int(self.args.rate * self.args.duration)
+        started = time.perf_counter()
+        for i in range(total):
+            # Open loop: the schedule doesn't wait for the answers
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            event, payloads = self.new_event(i)
+            event.sent_at = time.perf_counter()
+            with self.lock:
+                self.events.append(event)
+                self.events_by_ts[(event.channel, event.ts)] = event
+                self.events_by_ts[(event.channel, event.reply_thread_ts)] = event
+            for payload in payloads:
+                self.dispatch(payload)
+        sent_at = time.perf_counter()
+        with self.lock:
+            self.sent_all = True
+            if self.done == len(self.events):
+                self.all_done.set()
+        self.all_done.wait(self.args.drain_timeout)
+        finished = time.perf_counter()
+        return self.report(started, sent_at, finished)
+
+    def report(self, started: float, sent_at: float, finished: float) -> dict:
+        with self.lock:
+            events = list(self.events)
+        done = [e for e in events if e.done_at is not None]
+        latencies = sorted(e.done_at - e.sent_at for e in done)
+        outcomes: dict[str, int] = {}
+        for e in events:
+            outcomes[e.outcome or "timeout"] = (
+                outcomes.get(e.outcome or "timeout", 0) + 1
+            )
+
+        def percentile(p: float, values: list = latencies) -> Optional[float]:
+            if not values:
+                return None
+            return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+        latency_by_kind = {}
+        for kind in sorted({e.kind for e in done}):
+            values = sorted(e.done_at - e.sent_at for e in done if e.kind == kind)
+            latency_by_kind[kind] = {
+                "p50": percentile(0.50, values),
+                "p95": percentile(0.95, values),
+            }
+
+        last_done = max((e.done_at for e in done), default=finished)
+        count = max(len(events), 1)
+        return {
+            "events": len(events),
+            "target_rate": self.args.rate,
+            "send_rate": len(events) / max(sent_at - started, 1e-9),
+            "throughput": len(done) / max(last_done - started, 1e-9),
+            "outcomes": outcomes,
+            "latency_ms": {
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+            "latency_ms_by_kind": latency_by_kind,
+            "queued": sum(e.queued for e in events),
+            "slack_calls_per_event": {
+                m: n / count for m, n in sorted(self.slack.calls.items())
+            },
+            "dify_calls_per_event": {
+                m: n / count for m, n in sorted(self.dify.calls.items())
+            },
+        }
+
+    def stop(self) -> None:
+        self.slack.stop()
+        self.dify.stop()
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, weight = item.split("=")
+        if kind not in ("mention", "dm", "thread"):
+            raise argparse.ArgumentTypeError(f"Unknown event kind: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency_ms"]
+
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.0f} ms"
+
+    print(
+        f"events: {report['events']} at {report['send_rate']:.1f}/s "
+        f"(target {report['target_rate']}/s)"
+    )
+    print(f"outcomes: {report['outcomes']}")
+    print(f"throughput: {report['throughput']:.2f} answers/s")
+    print(
+        f"latency: p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, "
+        f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}"
+    )
+    for kind, values in report["latency_ms_by_kind"].items():
+        print(f"  {kind}: p50 {ms(values['p50'])}, p95 {ms(values['p95'])}")
+    print(f"queued: {report['queued']} events showed a queue position")
+    for name in ("slack_calls_per_event", "dify_calls_per_event"):
+        calls = ", ".join(f"{m} {n:.2f}" for m, n in report[name].items())
+        print(f"{name.replace('_', ' ')}: {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=10, help="events per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix("mention=0.5,dm=0.3,thread=0.2"),
+        help="weights of the event kinds, e.g. mention=0.5,dm=0.3,thread=0.2",
+    )
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--words", type=int, default=20, help="words per question")
+    parser.add_argument(
+        "--questions", type=int, default=0, help="distinct questions; 0: all distinct"
+    )
+    parser.add_argument("--stream", help="recorded Dify stream to replay")
+    parser.add_argument(
+        "--tokens", type=int, default=100, help="answer tokens of the synthetic stream"
+    )
+    parser.add_argument(
+        "--token-rate", type=float, default=50, help="tokens per second"
+    )
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--dify-first-byte-ms", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slack-latency-ms", type=float, default=20)
+    parser.add_argument(
+        "--slack-rate-limit-factor",
+        type=float,
+        help="answer the Slack calls beyond the rate limits scaled by this factor "
+        "with 429 / Retry-After",
+    )
+    parser.add_argument(
+        "--no-slack-pacing",
+        action="store_true",
+        help="disable the app's Slack pacing and rely on 429 / Retry-After",
+    )
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p95-ms", type=float)
+    parser.add_argument(
+        "--max-dm-p95-ms",
+        type=float,
+        help="limit of the DM p95 latency, e.g. to check that DMs skip the queue",
+    )
+    parser.add_argument("--max-slack-calls-per-event", type=float)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    load_test = LoadTest(args)
+    try:
+        report = load_test.run()
+    finally:
+        load_test.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failures = []
+    p95 = report["latency_ms"]["p95"]
+    if args.max_p95_ms is not None and p95 is not None and p95 > args.max_p95_ms:
+        failures.append(f"p95 latency {p95:.0f} ms > {args.max_p95_ms} ms")
+    dm_p95 = report["latency_ms_by_kind"].get("dm", {}).get("p95")
+    if (
+        args.max_dm_p95_ms is not None
+        and dm_p95 is not None
+        and dm_p95 > args.max_dm_p95_ms
+    ):
+        failures.append(f"DM p95 latency {dm_p95:.0f} ms > {args.max_dm_p95_ms} ms")
+    slack_calls = sum(report["slack_calls_per_event"].values())
+    if (
+        args.max_slack_calls_per_event is not None
+        and slack_calls > args.max_slack_calls_per_event
+    ):
+        failures.append(
+            f"{slack_calls:.2f} Slack calls per event > {args.max_slack_calls_per_event}"
+        )
+    if report["outcomes"].get("timeout"):
+        failures.append(f"{report['outcomes']['timeout']} events were never answered")
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark of the Slack mrkdwn <-> markdown conversions.
+
+    uv run python benchmarks/markdown_conversion.py
+
+Compares app.markdown_conversion with the previous per-call regex
+implementation on small, typical and 40 KB inputs, and checks that both
+produce the same output.
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.markdown_conversion import markdown_to_slack, slack_to_markdown  # noqa: E402
+
+
+def previous_slack_to_markdown(content: str) -> str:
+    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    result = ""
+    for part in parts:
+        if part.startswith("```") or part.startswith("`"):
+            result += part
+        else:
+            for o, n in [
+                (r"\*(?!\s)([^\*\n]+?)(?<!\s)\*", r"**\1**"),
+                (r"_(?!\s)([^_\n]+?)(?<!\s)_", r"*\1*"),
+                (r"~(?!\s)([^~\n]+?)(?<!\s)~", r"~~\1~~"),
+            ]:
+                part = re.sub(o, n, part)
+            result += part
+    return result
+
+
+def previous_markdown_to_slack(content: str) -> str:
+    content = re.sub(r"```[a-zA-Z0-9]+\n", "```\n", content)
+    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    result = ""
+    for part in parts:
+        if part.startswith("```") or part.startswith("`"):
+            result += part
+        else:
+            part = re.sub(r"^(#{1,6}) (.+)", r"**\2**", part, flags=re.MULTILINE)
+            for o, n in [
+                (r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*", r"_*\1*_"),
+                (r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])", r"_\1_"),
+                (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),
+                (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),
+                (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),
+            ]:
+                part = re.sub(o, n, part)
+            result += part
+    return result
+
+
+SLACK_MESSAGE = (
+    "<@U012AB3CD> *デプロイ* の手順を教えてください。`make deploy-prod` を実行したら"
+    " _serverless_ のエラーが出ました。~昨日は~ 動いていました。\n"
+)
+MARKDOWN_ANSWER = """## 手順
+
+1. **AWS の認証情報** を確認します。
+2. `sls deploy --stage prod` を *もう一度* 実行します。
+
+```bash
+export AWS_PROFILE=serverless-servicename-agent
+sls deploy --stage prod --verbose
+```
+
+### 補足
+
+~~古い手順~~ は使わないでください。__重要__: ***必ず*** ログを確認してください。
+"""
+
+INPUTS = {
+    "small": ("ありがとうございます！", "了解です。"),
+    "typical": (SLACK_MESSAGE, MARKDOWN_ANSWER),
+    "40 KB": (
+        SLACK_MESSAGE * (40_000 // len(SLACK_MESSAGE.encode())),
+        MARKDOWN_ANSWER * (40_000 // len(MARKDOWN_ANSWER.encode())),
+    ),
+}
+
+
+def main():
+    for name, (slack_text, markdown_text) in INPUTS.items():
+        assert slack_to_markdown(slack_text) == previous_slack_to_markdown(slack_text)
+        assert markdown_to_slack(markdown_text) == previous_markdown_to_slack(
+            markdown_text
+        )
+
+        print(f"{name}:")
+        for label, previous, current, text in [
+            (
+                "slack_to_markdown",
+                previous_slack_to_markdown,
+                slack_to_markdown,
+                slack_text,
+            ),
+            (
+                "markdown_to_slack",
+                previous_markdown_to_slack,
+                markdown_to_slack,
+                markdown_text,
+            ),
+        ]:
+            number = 200 if len(text) > 10_000 else 20_000
+            before = timeit.timeit(lambda: previous(text), number=number) / number
+            after = timeit.timeit(lambda: current(text), number=number) / number
+            print(
+                f"  {label}: {before * 1e6:9.1f} us -> {after * 1e6:9.1f} us"
+                f" ({before / after:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
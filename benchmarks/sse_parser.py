@@ -0,0 +1,109 @@
+"""
+Micro-benchmark of the Dify stream parsing.
+
+    uv run python benchmarks/sse_parser.py [recorded_stream.txt ...]
+
+Compares iter_answer_from_streaming_response with the previous
+sseclient + json.loads-per-event implementation. Without arguments, a
+synthetic chatflow stream with large workflow node payloads, a long answer,
+retriever resources and TTS audio is used.
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sseclient import SSEClient  # noqa: E402
+
+from app.dify_ops import get_answer_from_streaming_response  # noqa: E402
+
+
+class RecordedResponse:
+    """Replays a recorded stream in network-sized chunks."""
+
+    def __init__(self, data: bytes, chunk_size: int = 1024):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i : i + self.chunk_size]
+
+    def iter_content(self, chunk_size=None):
+        return self._chunks()
+
+    def __iter__(self):
+        return self._chunks()
+
+
+def sseclient_answer(response) -> str:
+    answer = ""
+    for event in SSEClient(response).events():
+        data = json.loads(event.data)
+        if data["event"] == "message":
+            answer += data.get("answer", "")
+        elif data["event"] == "message_end":
+            break
+    return answer
+
+
+def synthetic_stream(answer_tokens: int = 4000) -> bytes:
+    base = {"task_id": "5ad4cb98", "conversation_id": "45701982", "message_id": "a8bd"}
+    events = [{"event": "workflow_started", "data": {"id": "5ad498"}}]
+    for i in range(20):
+        node = {"id": f"n{i}", "inputs": {"context": "x" * 20_000}}
+        events.append({"event": "node_started", "data": node})
+        events.append(
+            {
+                "event": "node_finished",
+                "data": {**node, "outputs": {"text": "y" * 20_000}},
+            }
+        )
+    events += [
+        {"event": "message", **base, "answer": f" token{i}"}
+        for i in range(answer_tokens)
+    ]
+    events += [
+        {"event": "tts_message", **base, "audio": "q" * 50_000} for _ in range(10)
+    ]
+    events.append(
+        {
+            "event": "message_end",
+            **base,
+            "metadata": {
+                "usage": {"total_tokens": 1168, "latency": 1.38},
+                "retriever_resources": [{"content": "z" * 10_000}] * 10,
+            },
+        }
+    )
+    return b"".join(f"data: {json.dumps(event)}\n\n".encode() for event in events)
+
+
+def main():
+    if len(sys.argv) > 1:
+        streams = {}
+        for path in sys.argv[1:]:
+            with open(path, "rb") as f:
+                streams[os.path.basename(path)] = f.read()
+    else:
+        streams = {"synthetic": synthetic_stream()}
+
+    for name, data in streams.items():
+        expected = sseclient_answer(RecordedResponse(data))
+        assert get_answer_from_streaming_response(RecordedResponse(data)) == expected
+
+        print(f"{name}: {len(data):,} bytes")
+        for label, parse in [
+            ("sseclient + json.loads", sseclient_answer),
+            ("iter_answer_from_streaming_response", get_answer_from_streaming_response),
+        ]:
+            runs = 5
+            elapsed = timeit.timeit(lambda: parse(RecordedResponse(data)), number=runs)
+            print(f"  {label:<38} {elapsed / runs * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
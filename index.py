@@ -1,10 +1,13 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from slack_bolt import App
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
 from slack_bolt.context import BoltContext
+from slack_sdk import WebClient
 
-from app.bolt_listeners import before_authorize, register_listeners
+from app.env import LISTENER_MAX_WORKERS, SLACK_API_BASE_URL
+from app.lazy_listeners import before_authorize, register_listeners
 
 slack_app_token = os.environ["SLACK_APP_TOKEN"]
 slack_bot_token = os.environ["SLACK_BOT_TOKEN"]
@@ -12,9 +15,16 @@ slack_signing_token = os.environ["SLACK_SIGNING_SECRET"]
 
 app = App(
     process_before_response=True,
-    token=slack_bot_token,
+    # The base URL is copied to the per-request clients; see SLACK_API_BASE_URL
+    client=WebClient(token=slack_bot_token, base_url=SLACK_API_BASE_URL),
     before_authorize=before_authorize,
     signing_secret=slack_signing_token,
+    # Skips the auth.test call at cold start; the authorization middleware
+    # still calls it once on the first request
+    token_verification_enabled=False,
+    # Running and queued generations each hold a listener thread; the
+    # generation scheduler, not this pool, decides which one runs
+    listener_executor=ThreadPoolExecutor(max_workers=LISTENER_MAX_WORKERS),
 )
 
 
@@ -24,14 +34,23 @@ def set_dify_api_key(context: BoltContext, next_):
     next_()
 
 
+# Registered once per process: a warm Lambda container reuses the app and
+# the handler for all its invocations
+register_listeners(app)
+
+# The handler runs the lazy listeners by invoking the function again, which
+# Socket Mode must not do
+slack_handler = SlackRequestHandler(app=app) if __name__ != "__main__" else None
+
+
 def lambda_handler(event, context):
-    register_listeners(app)
-    slack_handler = SlackRequestHandler(app=app)
     return slack_handler.handle(event, context)
 
 
 if __name__ == "__main__":
     from slack_bolt.adapter.socket_mode import SocketModeHandler
 
-    register_listeners(app)
+    from app.metrics import metrics
+
+    metrics.start_prometheus_server()
     SocketModeHandler(app, slack_app_token).start()
@@ -0,0 +1,57 @@
+import asyncio
+import os
+
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp, AsyncBoltContext
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.async_bolt_listeners import before_authorize, register_listeners
+from app.async_dify_ops import close_async_session
+from app.env import (
+    SLACK_API_BASE_URL,
+    SLACK_RATE_LIMIT_ENABLED,
+    SLACK_RATE_LIMIT_MAX_RETRIES,
+)
+from app.metrics import metrics
+
+# asyncio entry point for Socket Mode: every in-flight generation is a task on
+# one event loop instead of a blocked worker thread. Requires the `async` extra.
+
+slack_app_token = os.environ["SLACK_APP_TOKEN"]
+slack_bot_token = os.environ["SLACK_BOT_TOKEN"]
+
+app = AsyncApp(
+    client=AsyncWebClient(
+        token=slack_bot_token,
+        base_url=SLACK_API_BASE_URL,
+        # Retried after Retry-After when Slack answers 429
+        retry_handlers=(
+            [AsyncRateLimitErrorRetryHandler(SLACK_RATE_LIMIT_MAX_RETRIES)]
+            if SLACK_RATE_LIMIT_ENABLED
+            else None
+        ),
+    ),
+    before_authorize=before_authorize,
+)
+
+
+@app.middleware
+async def set_dify_api_key(context: AsyncBoltContext, next_):
+    context["DIFY_APP_API_KEY"] = os.environ["DIFY_APP_API_KEY"]
+    await next_()
+
+
+register_listeners(app)
+
+
+async def main():
+    metrics.start_prometheus_server()
+    try:
+        await AsyncSocketModeHandler(app, slack_app_token).start_async()
+    finally:
+        await close_async_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())